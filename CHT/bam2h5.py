@@ -53,7 +53,8 @@ Input Options:
        Path to HDF5 file containing SNP index. The SNP index is
        used to convert the genomic position of a SNP to its
        corresponding row in the haplotype and snp_tab
-       HDF5 files.
+       HDF5 files. Either a dense index or a compact index
+       (written by snp2h5 --compact_snp_index) can be used.
 
      --snp_tab SNP_TABLE_H5_FILE [required]
        Path to HDF5 file to read SNP information from. Each row of SNP
@@ -114,6 +115,7 @@ import pysam
 
 import chromosome
 import chromstat
+import snpindex
 
 
 # codes used by pysam for aligned read CIGAR strings
@@ -226,7 +228,7 @@ def get_sam_iter(samfile, chrom):
 
 
 
-def choose_overlap_snp(read, snp_tab, snp_index_array, hap_tab, ind_idx):
+def choose_overlap_snp(read, snp_tab, snp_index, hap_tab, ind_idx):
     """Picks out a single SNP from those that the read overlaps.
     Returns a tuple containing 4 elements: [0] the index of the SNP in
     the SNP table, [1] the offset into the read sequence, [2] flag
@@ -255,10 +257,10 @@ def choose_overlap_snp(read, snp_tab, snp_index_array, hap_tab, ind_idx):
             genome_end = genome_start_idx + op_len
 
             # get offsets of any SNPs that this read overlaps
-            idx = snp_index_array[genome_start_idx:genome_end]
-            is_def = np.where(idx != SNP_UNDEF)[0]
-            read_offsets.extend(read_start_idx + is_def)
-            snp_idx.extend(idx[is_def])
+            # (SNP positions are 1-based)
+            pos, idx = snp_index.lookup(genome_start_idx+1, genome_end)
+            read_offsets.extend(read_start_idx + pos - genome_start_idx - 1)
+            snp_idx.extend(idx)
 
             read_start_idx = read_end
             genome_start_idx = genome_end
@@ -342,7 +344,7 @@ def choose_overlap_snp(read, snp_tab, snp_index_array, hap_tab, ind_idx):
 
 
 def add_read_count(read, chrom, ref_array, alt_array, other_array,
-                   read_count_array, snp_index_array, snp_tab, hap_tab,
+                   read_count_array, snp_index, snp_tab, hap_tab,
                    warned_pos, max_count, ind_idx):
 
     # pysam positions start at 0
@@ -364,7 +366,7 @@ def add_read_count(read, chrom, ref_array, alt_array, other_array,
     # look for SNPs that overlap mapped read position, and if there
     # are more than one, choose one at random
     snp_idx, read_offset, is_split, overlap_indel = \
-      choose_overlap_snp(read, snp_tab, snp_index_array, hap_tab, ind_idx)
+      choose_overlap_snp(read, snp_tab, snp_index, hap_tab, ind_idx)
 
     if overlap_indel:
         return
@@ -437,7 +439,9 @@ def parse_args():
                         help="Path to HDF5 file containing SNP index. The "
                         "SNP index is used to convert the genomic position "
                         "of a SNP to its corresponding row in the haplotype "
-                        "and snp_tab HDF5 files.",
+                        "and snp_tab HDF5 files. Either a dense index or a "
+                        "compact index (written by snp2h5 "
+                        "--compact_snp_index) can be used.",
                         metavar="SNP_INDEX_H5_FILE",
                         required=True)
 
@@ -633,7 +637,8 @@ def main():
         sys.stderr.write("fetching SNPs\n")
 
         snp_tab = snp_tab_h5.getNode("/%s" % chrom.name)
-        snp_index_array = snp_index_h5.getNode("/%s" % chrom.name)[:]
+        node = snp_index_h5.getNode("/%s" % chrom.name)
+        snp_index = snpindex.SNPIndex.from_h5(node)
         if hap_h5:
             hap_tab = hap_h5.getNode("/%s" % chrom.name)
         else:
@@ -665,7 +670,7 @@ def main():
 
                 add_read_count(read, chrom, ref_array, alt_array,
                                other_array, read_count_array,
-                               snp_index_array, snp_tab, hap_tab,
+                               snp_index, snp_tab, hap_tab,
                                warned_pos, max_count, ind_idx)
 
             # store results for this chromosome
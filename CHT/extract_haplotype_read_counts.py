@@ -28,6 +28,7 @@ import tables
 import chromosome
 import chromstat
 import coord
+import snpindex
 import util
 
 SNP_UNDEF = -1
@@ -59,6 +60,21 @@ class DataFiles(object):
         self.geno_prob_h5 = tables.openFile(args.geno_prob, "r")
         self.hap_h5 = tables.openFile(args.haplotype, "r")
 
+        # SNP index for most recently requested chromosome
+        self.snp_index_chrom = None
+        self.snp_index = None
+
+
+    def get_snp_index(self, chrom_name):
+        """returns SNPIndex for chromosome, re-using the previous
+        one if it was for the same chromosome"""
+        if chrom_name != self.snp_index_chrom:
+            node = self.snp_index_h5.getNode("/%s" % chrom_name)
+            self.snp_index = snpindex.SNPIndex.from_h5(node)
+            self.snp_index_chrom = chrom_name
+
+        return self.snp_index
+
     
     def close(self):
         """closes all of the data files"""
@@ -219,7 +235,7 @@ def get_region_snps(data_files, region_list, ind_idx):
     snp_tab = data_files.snp_tab_h5.getNode(node_name)
     hap_tab = data_files.hap_h5.getNode(node_name)
     geno_tab = data_files.geno_prob_h5.getNode(node_name)
-    snp_idx_tab = data_files.snp_index_h5.getNode(node_name)
+    snp_index = data_files.get_snp_index(chrom.name)
     
     region_snps = []
     
@@ -228,12 +244,10 @@ def get_region_snps(data_files, region_list, ind_idx):
             raise CoordError("only regions on same chromosome are supported")
 
         # get index (which is row number in SNP tables) of SNPs in this region
-        snp_idx = snp_idx_tab[region.start-1:region.end]
-        offsets = np.where(snp_idx != SNP_UNDEF)[0]
+        snp_pos, snp_idx = snp_index.lookup(region.start, region.end)
         test_snp = None
 
-        for offset in offsets:
-            i = snp_idx[offset]
+        for i in snp_idx:
             snp_row = snp_tab[i]
 
             # extract geno probs and haplotypes for this individual
@@ -6,6 +6,7 @@ import numpy as np
 import tables
 
 import chromosome
+import snpindex
 import argparse
 
 import gzip
@@ -136,9 +137,10 @@ class CombinedFiles(object):
             is_homo_alt = (a_hap == 1) & (b_hap == 1)
             
             # get genomic location of SNPs
-            i = snp_files.snp_index_h5.getNode("/%s" % chrom.name)[:]
-            chrom_idx = np.where(i != SNP_UNDEF)[0]
-            snp_idx = i[chrom_idx]
+            node = snp_files.snp_index_h5.getNode("/%s" % chrom.name)
+            snp_index = snpindex.SNPIndex.from_h5(node)
+            chrom_idx = snp_index.pos - 1
+            snp_idx = snp_index.idx
 
             # add to total genotype counts
             node = self.ref_count_h5.getNode("/%s" % chrom.name)
@@ -456,19 +458,21 @@ def write_target_regions(out_f, args, chrom_list, combined_files, snp_files):
         read_counts = combined_files.read_count_h5.getNode(node_name)[:]
         as_read_counts = combined_files.as_count_h5.getNode(node_name)[:]
 
-        snp_idx = snp_files.snp_index_h5.getNode(node_name)
+        node = snp_files.snp_index_h5.getNode(node_name)
+        # rows in SNP table of possible test SNPs
+        snp_idx = snpindex.SNPIndex.from_h5(node).find(idx+1)
         snp_tab = snp_files.snp_tab_h5.getNode(node_name)
         
         n_region = 0
                             
-        for i in idx:
+        for i, snp_i in zip(idx, snp_idx):
             start = max(1, i+1 - args.target_region_size/2)
             end = min(chrom.length, i+1 + args.target_region_size/2)
 
             n_reads = np.sum(read_counts[start-1:end])
             n_as_reads = np.sum(as_read_counts[start-1:end])
 
-            snp_row = snp_tab[snp_idx[i]]
+            snp_row = snp_tab[snp_i]
 
             if (n_reads >= args.min_read_count) and (n_as_reads >= args.min_as_count):
                 # keep this target region
@@ -0,0 +1,118 @@
+import numpy as np
+
+SNP_UNDEF = -1
+
+# number of elements of dense (per-base) SNP index to read from HDF5
+# file at a time
+SNP_INDEX_CHUNK_LEN = 4 * 1024 * 1024
+
+
+class SNPIndex(object):
+    """Lookup from chromosome position to index of SNP/indel in
+    snp_pos, snp_allele1, etc. Rather than holding an array with an
+    element for every base of the chromosome, only the positions of
+    the SNPs are kept (in sorted order) and lookups are done by
+    binary search."""
+
+    def __init__(self, pos=None, idx=None, length=None):
+        # sorted 1-based chromosome positions of SNPs and
+        # corresponding SNP indices
+        if pos is None:
+            pos = []
+        if idx is None:
+            idx = []
+        self.pos = np.asarray(pos, dtype=np.int32)
+        self.idx = np.asarray(idx, dtype=np.int32)
+
+        if self.pos.shape != self.idx.shape:
+            raise ValueError("expected same number of SNP positions (%d) "
+                             "and SNP indices (%d)" %
+                             (self.pos.shape[0], self.idx.shape[0]))
+
+        # length of dense index that this index is equivalent to
+        if length is None:
+            length = self.pos[-1] if self.pos.shape[0] else 0
+        self.length = int(length)
+
+
+    @classmethod
+    def from_snp_pos(cls, snp_pos, length=None):
+        """Creates index from array of SNP positions. If there are
+        multiple SNPs at the same position the last one is used
+        (as it would be with a dense index)."""
+        snp_pos = np.asarray(snp_pos)
+        order = np.argsort(snp_pos, kind="mergesort")
+        pos = snp_pos[order]
+        # keep last of each run of duplicate positions
+        is_last = np.ones(pos.shape[0], dtype=np.bool_)
+        is_last[:-1] = pos[1:] != pos[:-1]
+        return cls(pos[is_last], order[is_last], length)
+
+
+    @classmethod
+    def from_dense(cls, snp_index, offset=0):
+        """Creates index from a dense array with an element for each
+        base, which is SNP_UNDEF where there is no SNP"""
+        snp_index = np.asarray(snp_index)
+        pos = np.where(snp_index != SNP_UNDEF)[0]
+        return cls(pos + offset + 1, snp_index[pos], snp_index.shape[0])
+
+
+    @classmethod
+    def from_h5(cls, node):
+        """Reads index from HDF5 array node. The node can either
+        be a compact index, which is a matrix with a row of 
+        (position, index) for each SNP, or a dense index with an 
+        element for each base of the chromosome. Dense indices
+        are read a chunk at a time, to limit memory usage."""
+        if len(node.shape) == 2:
+            data = node[:]
+            if data.shape[0] == 0:
+                return cls()
+            return cls(data[:, 0], data[:, 1])
+
+        length = node.shape[0]
+        pos_list = []
+        idx_list = []
+        for start in range(0, length, SNP_INDEX_CHUNK_LEN):
+            chunk = cls.from_dense(node[start:start+SNP_INDEX_CHUNK_LEN],
+                                   offset=start)
+            pos_list.append(chunk.pos)
+            idx_list.append(chunk.idx)
+
+        if pos_list:
+            return cls(np.concatenate(pos_list), np.concatenate(idx_list),
+                       length)
+        return cls(length=length)
+
+
+    def __len__(self):
+        return self.length
+
+
+    def lookup(self, start, end):
+        """Returns arrays of positions and indices of SNPs
+        in 1-based chromosome region start-end (inclusive)"""
+        lo = np.searchsorted(self.pos, start, side="left")
+        hi = np.searchsorted(self.pos, end, side="right")
+        return self.pos[lo:hi], self.idx[lo:hi]
+
+
+    def find(self, pos):
+        """Returns indices of SNPs at 1-based chromosome positions
+        (which may be an array), SNP_UNDEF where there is no SNP"""
+        pos = np.asarray(pos)
+        if self.pos.shape[0] == 0:
+            return np.zeros(pos.shape, dtype=np.int32) + SNP_UNDEF
+        i = np.searchsorted(self.pos, pos, side="left")
+        i = np.minimum(i, self.pos.shape[0]-1)
+        return np.where(self.pos[i] == pos, self.idx[i], SNP_UNDEF)
+
+
+    def to_dense(self):
+        """Returns dense index, with an element for every base
+        (up to length), that is SNP_UNDEF where there is no SNP"""
+        snp_index = np.empty(self.length, dtype=np.int32)
+        snp_index[:] = SNP_UNDEF
+        snp_index[self.pos-1] = self.idx
+        return snp_index
@@ -0,0 +1,115 @@
+import zlib
+import collections
+import multiprocessing.pool
+
+
+# default zlib compression level for output fastq files. 0 means
+# that fastq files are written uncompressed
+COMPRESS_LEVEL_DEFAULT = 6
+
+# default number of threads used to compress output fastq files. 0
+# means that compression is done in the main thread
+WRITER_THREADS_DEFAULT = 1
+
+# number of bytes of fastq records to buffer before compressing them
+FASTQ_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def compress_block(data, compress_level):
+    """compresses block of data into a single gzip member. Several
+    members can be concatenated to make a valid gzip file"""
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+
+class FastqWriter(object):
+    """Writes fastq records to a file. Records are buffered into large
+    blocks, each of which is compressed into a separate gzip member
+    by a pool of threads (zlib releases the GIL while compressing, so
+    this runs in parallel with the main thread). Blocks are written
+    to the file in the order that they were filled. If compress_level
+    is 0 the records are written uncompressed."""
+
+    def __init__(self, filename, compress_level=COMPRESS_LEVEL_DEFAULT,
+                 threads=WRITER_THREADS_DEFAULT,
+                 block_size=FASTQ_BLOCK_SIZE):
+        if compress_level < 0 or compress_level > 9:
+            raise ValueError("compression level should be between "
+                             "0 and 9, but got %d" % compress_level)
+
+        self.filename = filename
+        self.compress_level = compress_level
+        self.block_size = block_size
+        self.f = open(filename, "wb")
+
+        # records that have not been compressed yet
+        self.buf = []
+        self.buf_size = 0
+
+        # blocks that are being compressed by thread pool, in the
+        # order that they should be written
+        self.pending = collections.deque()
+        self.n_block = 0
+
+        if compress_level > 0 and threads > 0:
+            self.pool = multiprocessing.pool.ThreadPool(threads)
+            # limit number of blocks held in memory
+            self.max_pending = threads * 2
+        else:
+            self.pool = None
+            self.max_pending = 0
+
+
+    def write(self, record):
+        """adds record (or other string) to the file"""
+        self.buf.append(record)
+        self.buf_size += len(record)
+
+        if self.buf_size >= self.block_size:
+            self.flush_block()
+
+
+    def flush_block(self):
+        """compresses and writes buffered records"""
+        if self.buf_size == 0:
+            return
+
+        data = "".join(self.buf)
+        self.buf = []
+        self.buf_size = 0
+        self.n_block += 1
+
+        if self.compress_level == 0:
+            self.f.write(data)
+        elif self.pool is None:
+            self.f.write(compress_block(data, self.compress_level))
+        else:
+            self.pending.append(self.pool.apply_async(compress_block,
+                                                      (data,
+                                                       self.compress_level)))
+            # write completed blocks once too many are waiting
+            while len(self.pending) > self.max_pending:
+                self.f.write(self.pending.popleft().get())
+
+
+    def close(self):
+        """writes remaining records, waits for all blocks to be
+        compressed and written, and closes the file"""
+        self.flush_block()
+
+        while self.pending:
+            self.f.write(self.pending.popleft().get())
+
+        if self.n_block == 0 and self.compress_level > 0:
+            # write an empty gzip member, so that a file
+            # with no records is still a valid gzip file
+            self.f.write(compress_block("", self.compress_level))
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+        self.f.close()
@@ -2,8 +2,11 @@
 import argparse
 import sys
 
-import pysam
-
+import util
+import remapindex
+import remapdedup
+import flipcache
+import refcache
 
 
 def parse_options():
@@ -35,13 +38,46 @@ def parse_options():
                         "original set of reads that needed to "
                         "be remapped after having their alleles flipped."
                         " This file is output by the find_intersecting_snps.py "
-                        "script.")
+                        "script. A remap index file (written by "
+                        "find_intersecting_snps.py --remap_index) can be "
+                        "given instead, in which case the reads are read "
+                        "from the input BAM file that it points to.")
     parser.add_argument("remap_bam", help="input BAM file containing "
                         "remapped reads (with flipped alleles)")
     parser.add_argument("keep_bam", help="output BAM file to write "
-                        "filtered set of reads to")
+                        "filtered set of reads to (written as CRAM if "
+                        "name ends with .cram, which requires --reference)")
+    parser.add_argument("--dups", default=None, metavar="DUPS_FILE",
+                        help="file listing reads whose sequences were not "
+                        "remapped because they duplicate an earlier read "
+                        "(written by find_intersecting_snps.py "
+                        "--dedup_remap). Each duplicate is kept or "
+                        "discarded along with the earlier read.")
+    parser.add_argument("--flip_cache", default=None,
+                        metavar="FLIP_CACHE_DIR",
+                        help="directory holding record of whether remapped "
+                        "reads mapped back to the same location (as used by "
+                        "find_intersecting_snps.py --flip_cache). The "
+                        "results of the reads listed in the --flip_keys "
+                        "file are added to it.")
+    parser.add_argument("--flip_keys", default=None,
+                        metavar="FLIP_KEYS_FILE",
+                        help="file listing keys of remapped reads (written "
+                        "by find_intersecting_snps.py --flip_cache). Must "
+                        "be provided with --flip_cache.")
+    util.add_bam_threads_option(parser)
+    refcache.add_reference_options(parser)
+
+    options = parser.parse_args()
+    if options.threads < 1:
+        parser.error("--threads must be at least 1")
+    if util.is_cram(options.keep_bam) and not options.reference:
+        parser.error("--reference is needed to write CRAM file")
+    if bool(options.flip_cache) != bool(options.flip_keys):
+        parser.error("--flip_cache and --flip_keys must be provided "
+                     "together")
 
-    return parser.parse_args()
+    return options
 
 
 
@@ -161,15 +197,102 @@ def write_reads(to_remap_bam, keep_bam, keep_reads, bad_reads):
     sys.stderr.write("keep_reads: %d\n" % keep_count)
     sys.stderr.write("bad_reads: %d\n" % bad_count)
     sys.stderr.write("discard_reads: %d\n" % discard_count)
-    
 
+
+
+def write_reads_from_index(remap_index_path, keep_bam, keep_reads, bad_reads,
+                           threads=util.BAM_THREADS_DEFAULT):
+    """Same as write_reads, but reads the original reads that were
+    remapped using a remap index file. Only reads with names that
+    hash to a kept read are read, by seeking to their offsets in
+    the input BAM file that the remap index points into"""
+    bam_filename, records = remapindex.read_remap_index(remap_index_path)
+    input_bam = util.open_bam(bam_filename, "rb", threads=threads)
+
+    keep_hashes = set(remapindex.name_hash(name) for name in keep_reads)
+    bad_hashes = set(remapindex.name_hash(name) for name in bad_reads)
+
+    keep_count = 0
+    bad_count = 0
+    discard_count = 0
+
+    for offset, h in zip(records['offset'].tolist(),
+                         records['name_hash'].tolist()):
+        if h in keep_hashes:
+            input_bam.seek(offset)
+            read = next(input_bam)
+
+            # check name, in case hashes of different names collide
+            if read.qname in bad_reads:
+                bad_count += 1
+            elif read.qname in keep_reads:
+                keep_count += 1
+                keep_bam.write(read)
+            else:
+                discard_count += 1
+        elif h in bad_hashes:
+            bad_count += 1
+        else:
+            discard_count += 1
+
+    input_bam.close()
+
+    sys.stderr.write("keep_reads: %d\n" % keep_count)
+    sys.stderr.write("bad_reads: %d\n" % bad_count)
+    sys.stderr.write("discard_reads: %d\n" % discard_count)
     
-def main(to_remap_bam_path, remap_bam_path, keep_bam_path):
-    to_remap_bam = pysam.Samfile(to_remap_bam_path)
-    remap_bam = pysam.Samfile(remap_bam_path)
-    keep_bam = pysam.Samfile(keep_bam_path, "wb", template=to_remap_bam)
 
+    
+def filter_reads_dups(remap_bam, dups_path=None):
+    """runs filter_reads, then gives reads listed in dups file
+    the same result as their canonical reads"""
     keep_reads, bad_reads = filter_reads(remap_bam)
+    if dups_path:
+        remapdedup.apply_dups(remapdedup.read_dups(dups_path),
+                              keep_reads, bad_reads)
+    return keep_reads, bad_reads
+
+
+
+def main(to_remap_bam_path, remap_bam_path, keep_bam_path, dups_path=None,
+         flip_cache_dir=None, flip_keys_path=None,
+         threads=util.BAM_THREADS_DEFAULT, reference=None,
+         ref_cache_dir=None):
+    if ref_cache_dir:
+        refcache.use_ref_cache(ref_cache_dir, reference)
+
+    def open_bam(filename, mode="r", template=None):
+        return util.open_bam(filename, mode, template=template,
+                             threads=threads, reference=reference)
+
+    if remapindex.is_remap_index(to_remap_bam_path):
+        # header is taken from input BAM that index points into
+        f = open(to_remap_bam_path, "rb")
+        bam_filename = remapindex.read_header(f)
+        f.close()
+        template_bam = open_bam(bam_filename, "rb")
+        keep_bam = open_bam(keep_bam_path, "wb", template=template_bam)
+        template_bam.close()
+
+        remap_bam = open_bam(remap_bam_path)
+        keep_reads, bad_reads = filter_reads_dups(remap_bam, dups_path)
+        if flip_cache_dir:
+            flipcache.update_flip_cache(flip_cache_dir, flip_keys_path,
+                                        keep_reads)
+
+        write_reads_from_index(to_remap_bam_path, keep_bam,
+                               keep_reads, bad_reads, threads=threads)
+        keep_bam.close()
+        return
+    
+    to_remap_bam = open_bam(to_remap_bam_path)
+    remap_bam = open_bam(remap_bam_path)
+    keep_bam = open_bam(keep_bam_path, "wb", template=to_remap_bam)
+
+    keep_reads, bad_reads = filter_reads_dups(remap_bam, dups_path)
+    if flip_cache_dir:
+        flipcache.update_flip_cache(flip_cache_dir, flip_keys_path,
+                                    keep_reads)
     
     write_reads(to_remap_bam, keep_bam, keep_reads, bad_reads)
         
@@ -177,5 +300,8 @@ def main(to_remap_bam_path, remap_bam_path, keep_bam_path):
 
 if __name__ == "__main__":
     options = parse_options()
-    main(options.to_remap_bam, options.remap_bam, options.keep_bam)
+    main(options.to_remap_bam, options.remap_bam, options.keep_bam,
+         dups_path=options.dups, flip_cache_dir=options.flip_cache,
+         flip_keys_path=options.flip_keys, threads=options.threads,
+         reference=options.reference, ref_cache_dir=options.ref_cache)
 
@@ -1,18 +1,57 @@
 import sys
 import os
 import gzip
+import json
+import time
+import shutil
 import argparse
+import itertools
+import multiprocessing
+import collections
 import numpy as np
 
 import pysam
 
 import util
 import snptable
+import snpcache
+import readpaircache
+import fastqwriter
+import remapstream
+import remapindex
+import remapdedup
+import kmerindex
+import flipcache
+import refcache
+import filter_remapped_reads
 
 import tables
 
 MAX_SEQS_DEFAULT = 64
 MAX_SNPS_DEFAULT = 6
+PROCESSES_DEFAULT = 1
+
+# number of reads to look up overlapping SNPs for at once
+READ_BLOCK_SIZE = 10000
+
+# maximum number of sets of unique haplotypes to keep in cache
+HAPLOTYPE_CACHE_SIZE = 1000
+
+# suffix of files that mark that the output files for a chromosome
+# (or the sorted input BAM file) are complete, so that they can be
+# reused when a run is resumed
+CHECKPOINT_SUFFIX = ".done"
+
+# arguments of filter_reads and DataFiles that change the output files
+# for a chromosome. A checkpoint is only used if these match the
+# arguments of the run that wrote it
+CHECKPOINT_FILTER_ARGS = ['max_seqs', 'max_snps', 'samples']
+CHECKPOINT_FILE_ARGS = ['is_paired', 'compress_level', 'output_cram',
+                        'reference', 'dedup_remap', 'flip_cache_dir']
+
+# overlapping SNPs and indels for a read that does not overlap any
+# (same form as returned by SNPTable.get_overlapping_snps)
+NO_OVERLAPS = ((), (), (), ())
 
 
 class DataFiles(object):
@@ -22,7 +61,18 @@ class DataFiles(object):
     def __init__(self, bam_filename, is_sorted, is_paired,
                  output_dir=None, snp_dir=None,
                  snp_tab_filename=None, snp_index_filename=None,
-                 haplotype_filename=None, samples=None):
+                 haplotype_filename=None, samples=None,
+                 output_prefix=None, open_output=True,
+                 compress_level=fastqwriter.COMPRESS_LEVEL_DEFAULT,
+                 writer_threads=fastqwriter.WRITER_THREADS_DEFAULT,
+                 remap_command=None,
+                 sort_threads=util.SORT_THREADS_DEFAULT,
+                 sort_memory=util.SORT_MEMORY_DEFAULT, stream_sort=False,
+                 remap_index=False, snp_cache=True, snp_cache_dir=None,
+                 dedup_remap=False, kmer_index_filename=None,
+                 flip_cache_dir=None,
+                 bam_threads=util.BAM_THREADS_DEFAULT, reference=None,
+                 output_cram=False, resume=False):
         # flag indicating whether reads are paired-end
         self.is_paired = is_paired
         
@@ -35,6 +85,10 @@ class DataFiles(object):
         # (new file is created if input file is not
         #  already sorted)
         self.bam_sort_filename = None
+        # process sorting input BAM, if sorted reads are streamed
+        # through a named pipe (bam_sort_filename) rather than
+        # written to a file
+        self.sort_proc = None
         # pysam file handle for input BAM
         self.input_bam = None
 
@@ -42,9 +96,21 @@ class DataFiles(object):
         self.keep_filename = None
         self.remap_filename = None
 
-        # pysam file handles for output BAM filenames
+        # pysam file handles for output BAM filenames. If remap_index
+        # is True, remap_bam is instead a RemapIndexWriter, which
+        # records offsets of reads in the input BAM file
         self.keep_bam = None
         self.remap_bam = None
+        self.remap_index = remap_index
+
+        # number of threads htslib uses to decompress or compress
+        # each BAM file
+        self.bam_threads = bam_threads
+
+        # reference FASTA file used to read and write CRAM files, and
+        # flag indicating whether output files are written as CRAM
+        self.reference = reference
+        self.output_cram = output_cram
 
                 
         # name of output fastq files
@@ -55,8 +121,49 @@ class DataFiles(object):
         self.fastq2 = None
         self.fastq_single = None
 
-        # name of directory to read SNPs from
+        # if dedup_remap is True, the sequences of reads that duplicate
+        # an earlier read are not written for remapping. Instead the
+        # RemapDedup records them in the dups file
+        self.dedup_remap = dedup_remap
+        self.dups_filename = None
+        self.remap_dedup = None
+
+        # index of reference genome k-mers, used to find reads that
+        # do not need to be remapped
+        if kmer_index_filename:
+            self.kmer_index = kmerindex.KmerIndex.read(kmer_index_filename)
+        else:
+            self.kmer_index = None
+
+        # persistent record of reads that mapped back to the same
+        # location after being flipped, used to skip remapping reads
+        # that are known to be safe. The keys of reads that are
+        # remapped are written to the flip keys file, so that
+        # filter_remapped_reads.py can add their results to it
+        if flip_cache_dir:
+            self.flip_cache = flipcache.FlipCache(flip_cache_dir)
+        else:
+            self.flip_cache = None
+        self.flip_keys_filename = None
+        self.flip_key_writer = None
+
+        # compression level (0 for uncompressed) and number of
+        # compression threads for output fastq files
+        self.compress_level = compress_level
+        self.writer_threads = writer_threads
+
+        # aligner command that remap fastq records are streamed to
+        # (instead of being written to fastq files), the RemapStream
+        # running it, and name of BAM file that remapped reads that
+        # pass filtering are written to
+        self.remap_command = remap_command
+        self.remap_stream = None
+        self.remap_keep_filename = None
+
+        # name of directory to read SNPs from, and whether binary
+        # caches of the SNP text files are used
         self.snp_dir = snp_dir
+        self.snp_cache = snp_cache
 
         # paths to HDF5 files to read SNP info from
         self.snp_tab_filename = snp_tab_filename
@@ -72,95 +179,321 @@ class DataFiles(object):
             self.snp_index_h5 = None
             self.hap_h5 = None
 
-            
-        # separate input directory and bam filename
-        tokens = self.bam_filename.split("/")
-        bam_dir = "/".join(tokens[:-1])
-        filename = tokens[-1]
-
-        if output_dir is None:
-            # if no output dir specified, use same directory as input
-            # bam file
-            output_dir = bam_dir
+        # shared memory-mapped copies of SNP tables read from HDF5 files
+        if self.snp_tab_h5 and snp_cache_dir:
+            self.snp_h5_cache = snpcache.SNPTableCache(snp_cache_dir,
+                                                       self.snp_tab_h5,
+                                                       self.snp_index_h5,
+                                                       self.hap_h5)
         else:
-            if output_dir.endswith("/"):
-                # strip trailing '/' from output dir name
-                output_dir = output_dir[:-1]
-                
-        name_split = filename.split(".")
-        if len(name_split) > 1:
-           self.prefix = output_dir + "/" + ".".join(name_split[:-1])
+            self.snp_h5_cache = None
+
+            
+        if output_prefix:
+            # prefix was provided explicitly (e.g. for the per-chromosome
+            # output files written by worker processes)
+            self.prefix = output_prefix
         else:
-            self.prefix = output_dir + "/" + name_split[0]
-        
-        # create output dir if does not exist
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
+            # separate input directory and bam filename
+            tokens = self.bam_filename.split("/")
+            bam_dir = "/".join(tokens[:-1])
+            filename = tokens[-1]
+
+            if output_dir is None:
+                # if no output dir specified, use same directory as input
+                # bam file
+                output_dir = bam_dir
+            else:
+                if output_dir.endswith("/"):
+                    # strip trailing '/' from output dir name
+                    output_dir = output_dir[:-1]
+
+            name_split = filename.split(".")
+            if len(name_split) > 1:
+               self.prefix = output_dir + "/" + ".".join(name_split[:-1])
+            else:
+                self.prefix = output_dir + "/" + name_split[0]
+
+            # create output dir if does not exist
+            if not os.path.exists(output_dir):
+                os.makedirs(output_dir)
 
             
         # TODO: could allow names of output files to be specified
         # on command line rather than appending name to prefix
         sys.stderr.write("prefix: %s\n" % self.prefix)
         
-        if not is_sorted:
-            util.sort_bam(self.bam_filename, self.prefix)
+        if is_sorted:
+            self.bam_sort_filename = self.bam_filename
+        elif resume and read_checkpoint(self.prefix + ".sort.bam",
+                                        self.bam_filename):
+            # input BAM was sorted by an earlier run
             self.bam_sort_filename = self.prefix + ".sort.bam"
+            sys.stderr.write("using sorted BAM file from earlier run\n")
+        elif stream_sort:
+            self.bam_sort_filename, self.sort_proc = \
+                util.start_sort_bam(self.bam_filename, self.prefix,
+                                    threads=sort_threads, memory=sort_memory,
+                                    reference=reference)
         else:
-            self.bam_sort_filename = self.bam_filename
-
-        self.keep_filename = self.prefix + ".keep.bam"
-        self.remap_filename = self.prefix + ".to.remap.bam"
+            self.bam_sort_filename = \
+                util.sort_bam(self.bam_filename, self.prefix,
+                              threads=sort_threads, memory=sort_memory,
+                              reference=reference)
+            if resume:
+                write_checkpoint(self.bam_sort_filename, self.bam_filename,
+                                 [self.bam_sort_filename])
+
+        if self.remap_index and util.is_cram(self.bam_sort_filename):
+            raise ValueError("remap index cannot point into CRAM file "
+                             "'%s'" % self.bam_sort_filename)
+
+        bam_ext = ".cram" if self.output_cram else ".bam"
+        self.keep_filename = self.prefix + ".keep" + bam_ext
+        if self.remap_index:
+            self.remap_filename = self.prefix + ".to.remap.idx"
+        else:
+            self.remap_filename = self.prefix + ".to.remap" + bam_ext
+        if self.remap_command:
+            self.remap_keep_filename = self.prefix + ".remap.keep" + bam_ext
+        if self.dedup_remap:
+            self.dups_filename = self.prefix + ".remap.dups.txt.gz"
+        if self.flip_cache:
+            self.flip_keys_filename = self.prefix + ".remap.flips.txt.gz"
+
+        # uncompressed fastq files do not get .gz extension
+        fastq_ext = ".gz" if self.compress_level > 0 else ""
+        
+        if self.is_paired:
+            self.fastq1_filename = self.prefix + ".remap.fq1" + fastq_ext
+            self.fastq2_filename = self.prefix + ".remap.fq2" + fastq_ext
+            self.fastq_single_filename = self.prefix + ".remap.single.fq" + \
+                                         fastq_ext
+        else:
+            self.fastq_single_filename = self.prefix + ".remap.fq" + fastq_ext
 
         sys.stderr.write("reading reads from:\n  %s\n" %
                          self.bam_sort_filename)
+        try:
+            self.input_bam = self.open_bam(self.bam_sort_filename, "rb")
+        except (IOError, ValueError):
+            if self.sort_proc is not None:
+                # report failure of sort rather than of reading pipe
+                self.finish_sort()
+            raise
+
+        if open_output:
+            self.open_output_files()
+
+
+    def get_output_filenames(self):
+        """returns list of names of output files, in the order that
+        they are written to stderr"""
+        if self.is_paired:
+            filenames = [self.fastq1_filename, self.fastq2_filename,
+                         self.fastq_single_filename]
+        else:
+            filenames = [self.fastq_single_filename]
+
+        filenames = filenames + [self.keep_filename, self.remap_filename]
+
+        if self.dedup_remap:
+            filenames.append(self.dups_filename)
+        if self.flip_cache:
+            filenames.append(self.flip_keys_filename)
+
+        return filenames
+
+
+    def open_bam(self, filename, mode, template=None):
+        """opens BAM (or CRAM) file, using configured number of
+        threads and reference"""
+        return util.open_bam(filename, mode, template=template,
+                             threads=self.bam_threads,
+                             reference=self.reference)
+
+
+    def open_fastq(self, filename):
+        """opens fastq file for writing, using configured compression"""
+        return fastqwriter.FastqWriter(filename,
+                                       compress_level=self.compress_level,
+                                       threads=self.writer_threads)
+    
         
+    def open_output_files(self):
+        """opens output BAM and fastq files for writing"""
         sys.stderr.write("writing output files to:\n")
 
-        
-        if self.is_paired:
-            self.fastq1_filename = self.prefix + ".remap.fq1.gz"
-            self.fastq2_filename = self.prefix + ".remap.fq2.gz"
-            self.fastq1 = gzip.open(self.fastq1_filename, "wb")
-            self.fastq2 = gzip.open(self.fastq2_filename, "wb")
-            self.fastq_single_filename = self.prefix + ".remap.single.fq.gz"
-            self.fastq_single = gzip.open(self.fastq_single_filename, "wb")
+        if self.remap_command:
+            # stream reads to aligner rather than writing fastq files.
+            # Named pipes are created in same dir as output files
+            self.remap_stream = remapstream.RemapStream(
+                self.remap_command, self.is_paired,
+                tmp_dir=os.path.dirname(self.prefix) or None)
+            sys.stderr.write("  (streaming remap reads to aligner)\n")
+
+            if self.is_paired:
+                self.fastq1 = self.remap_stream.fastq1
+                self.fastq2 = self.remap_stream.fastq2
+                # aligner command only takes read pairs, so unpaired
+                # reads are still written to a fastq file
+                self.fastq_single = self.open_fastq(self.fastq_single_filename)
+                sys.stderr.write("  %s\n" % self.fastq_single_filename)
+            else:
+                self.fastq_single = self.remap_stream.fastq_single
+        elif self.is_paired:
+            self.fastq1 = self.open_fastq(self.fastq1_filename)
+            self.fastq2 = self.open_fastq(self.fastq2_filename)
+            self.fastq_single = self.open_fastq(self.fastq_single_filename)
             sys.stderr.write("  %s\n  %s\n  %s\n" %
                              (self.fastq1_filename,
                               self.fastq2_filename,
                               self.fastq_single_filename))
             
         else:
-            self.fastq_single_filename = self.prefix + ".remap.fq.gz"
-            self.fastq_single = gzip.open(self.fastq_single_filename, "wb")
+            self.fastq_single = self.open_fastq(self.fastq_single_filename)
             sys.stderr.write("  %s\n" % (self.fastq_single_filename))
 
-        self.input_bam = pysam.Samfile(self.bam_sort_filename, "rb")
-        self.keep_bam = pysam.Samfile(self.keep_filename, "wb",
+        self.keep_bam = self.open_bam(self.keep_filename, "wb",
                                       template=self.input_bam)
-        self.remap_bam = pysam.Samfile(self.remap_filename, "wb",
-                                       template=self.input_bam)
+        if self.remap_index:
+            self.remap_bam = remapindex.RemapIndexWriter(
+                self.remap_filename, self.bam_sort_filename)
+        else:
+            self.remap_bam = self.open_bam(self.remap_filename, "wb",
+                                           template=self.input_bam)
         sys.stderr.write("  %s\n  %s\n" % (self.keep_filename,
                                            self.remap_filename))
 
+        if self.dedup_remap:
+            self.remap_dedup = remapdedup.RemapDedup(self.dups_filename)
+            sys.stderr.write("  %s\n" % self.dups_filename)
+
+        if self.flip_cache:
+            self.flip_key_writer = \
+                flipcache.FlipKeyWriter(self.flip_keys_filename)
+            sys.stderr.write("  %s\n" % self.flip_keys_filename)
+
 
     
         
     def close(self):
         """close open filehandles"""
-        filehandles = [self.keep_bam, self.remap_bam, self.fastq1,
-                       self.fastq2, self.fastq_single,
-                       self.snp_tab_h5, self.snp_index_h5,
-                       self.hap_h5]
+        filehandles = [self.input_bam, self.keep_bam, self.remap_bam,
+                       self.fastq1, self.fastq2, self.fastq_single,
+                       self.remap_dedup, self.flip_key_writer,
+                       self.snp_tab_h5, self.snp_index_h5, self.hap_h5]
 
         for fh in filehandles:
             if fh:
                 fh.close()
 
+        if self.sort_proc is not None:
+            self.finish_sort()
+
+
+    def finish_sort(self):
+        """waits for process that is sorting input BAM into a named
+        pipe, and removes the pipe"""
+        self.sort_proc.join()
+        shutil.rmtree(os.path.dirname(self.bam_sort_filename))
+        exitcode = self.sort_proc.exitcode
+        self.sort_proc = None
+
+        if exitcode != 0:
+            raise IOError("sorting BAM file '%s' failed" % self.bam_filename)
+
+
+    def filter_remapped(self):
+        """waits for aligner that remap reads were streamed to, and
+        writes the original reads that mapped back to the same
+        location to the remap keep BAM file. Must be called after
+        close, so that the aligner has received all reads and the
+        to.remap BAM file is complete"""
+        keep_reads, bad_reads = self.remap_stream.finish()
+
+        if self.remap_dedup:
+            # duplicates get same result as their canonical reads
+            remapdedup.apply_dups(remapdedup.read_dups(self.dups_filename),
+                                  keep_reads, bad_reads)
+
+        if self.flip_cache:
+            flipcache.update_flip_cache(self.flip_cache.cache_dir,
+                                        self.flip_keys_filename, keep_reads)
+
+        if self.remap_index:
+            to_remap_bam = self.open_bam(self.bam_sort_filename, "rb")
+        else:
+            to_remap_bam = self.open_bam(self.remap_filename, "rb")
+        keep_bam = self.open_bam(self.remap_keep_filename, "wb",
+                                 template=to_remap_bam)
+        sys.stderr.write("writing remapped reads that passed filtering "
+                         "to:\n  %s\n" % self.remap_keep_filename)
+        if self.remap_index:
+            filter_remapped_reads.write_reads_from_index(
+                self.remap_filename, keep_bam, keep_reads, bad_reads,
+                threads=self.bam_threads)
+        else:
+            filter_remapped_reads.write_reads(to_remap_bam, keep_bam,
+                                              keep_reads, bad_reads)
+        keep_bam.close()
+        to_remap_bam.close()
+
+
+
+class HaplotypeCache(object):
+    """Least-recently-used cache of unique haplotypes, keyed on the
+    tuple of indices of SNPs that a read overlaps. Neighboring reads
+    usually overlap the same SNPs, so this avoids repeatedly reading
+    haplotypes and finding unique ones. The cache must be cleared
+    when SNPs for a new chromosome are read."""
+    
+    def __init__(self, max_size=HAPLOTYPE_CACHE_SIZE):
+        self.max_size = max_size
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        
+    def clear(self):
+        """removes all haplotypes from the cache and resets counts
+        of hits and misses"""
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
         
+    def get_unique_haplotypes(self, haplotypes, snp_idx):
+        """returns unique haplotypes for this set of SNPs, using
+        cached haplotypes if they are available"""
+        key = tuple(snp_idx)
+
+        if key in self.cache:
+            # move to end of cache, since most recently used
+            haps = self.cache.pop(key)
+            self.cache[key] = haps
+            self.hits += 1
+            return haps
+
+        self.misses += 1
+        haps = get_unique_haplotypes(haplotypes, snp_idx)
+        self.cache[key] = haps
+
+        if len(self.cache) > self.max_size:
+            # remove least recently used haplotypes
+            self.cache.popitem(last=False)
+
+        return haps
+
+    
+
 class ReadStats(object):
     """Track information about reads and SNPs that they overlap"""
 
     def __init__(self):
+        # number of reads read from input file
+        self.n_read = 0
+
         # number of read matches to reference allele
         self.ref_count = 0
         # number of read matches to alternative allele
@@ -205,8 +538,75 @@ class ReadStats(object):
         self.remap_single = 0
         # number of read pairs kept
         self.remap_pair = 0
+
+        # number of unique haplotype lookups that were found
+        # in / missing from haplotype cache
+        self.hap_cache_hit = 0
+        self.hap_cache_miss = 0
+
+        # peak number of reads waiting for their mates, number of
+        # these that were evicted because their mate was not seen
+        # where expected, and number that were spilled to disk
+        self.pair_cache_peak = 0
+        self.pair_cache_evict = 0
+        self.pair_cache_spill = 0
+
+        # number of sequences written for remapping (the
+        # remap fan-out is this divided by reads remapped)
+        self.remap_seqs = 0
+
+        # number of single reads and read pairs that were kept
+        # without remapping because the k-mers of the reads generated
+        # for them are unique in the genome (these are also counted
+        # as kept)
+        self.keep_kmer_unique = 0
+
+        # number of single reads that were kept without remapping
+        # because the flip cache records that reads with the same
+        # SNP, length, offset and alleles map back to the same location
+        self.keep_flip_safe = 0
+
+        # number of remapped single reads and read pairs whose
+        # sequences were not written because they duplicate an
+        # earlier read
+        self.remap_dup = 0
+
+        # seconds spent reading SNPs and processing reads
+        self.time_snp_load = 0.0
+        self.time_process = 0.0
         
 
+    def add(self, other):
+        """adds counts from another ReadStats object to this one
+        (e.g. to combine counts from worker processes)"""
+        for name, count in vars(other).items():
+            if name == "pair_cache_peak":
+                # peak is not additive, take largest
+                setattr(self, name, max(getattr(self, name), count))
+            else:
+                setattr(self, name, getattr(self, name) + count)
+
+
+    def to_dict(self):
+        """returns dict of counts and times, with read throughput
+        and remap fan-out (e.g. to write as JSON)"""
+        d = dict(vars(self))
+
+        total_time = self.time_snp_load + self.time_process
+        if total_time > 0:
+            d['reads_per_sec'] = self.n_read / total_time
+        else:
+            d['reads_per_sec'] = None
+
+        n_remap = self.remap_single + self.remap_pair
+        if n_remap > 0:
+            d['remap_fanout'] = float(self.remap_seqs) / n_remap
+        else:
+            d['remap_fanout'] = None
+
+        return d
+            
+
     def write(self, file_handle):
         sys.stderr.write("DISCARD reads:\n"
                          "  unmapped: %d\n"
@@ -241,6 +641,37 @@ class ReadStats(object):
         file_handle.write("read SNP ref matches: %d\n" % self.ref_count)
         file_handle.write("read SNP alt matches: %d\n" % self.alt_count)
         file_handle.write("read SNP mismatches: %d\n" % self.other_count)
+
+        n_remap = self.remap_single + self.remap_pair
+        if n_remap > 0:
+            file_handle.write("sequences per remapped read: %.2f\n" %
+                              (float(self.remap_seqs) / n_remap))
+        if self.remap_dup > 0:
+            file_handle.write("remapped reads duplicating earlier reads: "
+                              "%d\n" % self.remap_dup)
+        if self.keep_kmer_unique > 0:
+            file_handle.write("reads kept because generated reads have "
+                              "unique k-mers: %d\n" % self.keep_kmer_unique)
+        if self.keep_flip_safe > 0:
+            file_handle.write("reads kept because flip cache records them "
+                              "as safe: %d\n" % self.keep_flip_safe)
+        file_handle.write("time reading SNPs: %.1fs\n" % self.time_snp_load)
+        file_handle.write("time processing reads: %.1fs\n" %
+                          self.time_process)
+
+        if self.hap_cache_hit + self.hap_cache_miss > 0:
+            file_handle.write("haplotype cache hits: %d\n" %
+                              self.hap_cache_hit)
+            file_handle.write("haplotype cache misses: %d\n" %
+                              self.hap_cache_miss)
+
+        if self.pair_cache_peak > 0:
+            file_handle.write("read pair cache peak size: %d\n" %
+                              self.pair_cache_peak)
+            file_handle.write("read pair cache evictions: %d\n" %
+                              self.pair_cache_evict)
+            file_handle.write("read pair cache reads spilled to disk: %d\n" %
+                              self.pair_cache_spill)
         
         total = self.ref_count + self.alt_count + self.other_count
         if total > 0:
@@ -280,6 +711,43 @@ def parse_options():
                               ' is coordinate-sorted (default '
                               'is False).'))
     
+    parser.add_argument("--collated", action='store_true',
+                        default=False,
+                        help=("Indicates that the input BAM file is "
+                              "grouped by read name (e.g. as output by the "
+                              "aligner or by samtools collate), so that the "
+                              "two ends of each read pair are next to each "
+                              "other. The input file is not sorted, and "
+                              "SNPs for each chromosome are read when it is "
+                              "first needed and then kept in memory. Cannot "
+                              "be used with --processes."))
+    
+    parser.add_argument("--sort_threads", type=int,
+                        default=util.SORT_THREADS_DEFAULT,
+                        help="Number of threads used to sort the input BAM "
+                        "file if it is not already sorted (default=%d)."
+                        % util.SORT_THREADS_DEFAULT)
+
+    util.add_bam_threads_option(parser)
+
+    refcache.add_reference_options(parser)
+
+    parser.add_argument("--output_cram", action='store_true', default=False,
+                        help="Write the keep, to.remap and remap.keep "
+                        "files as CRAM rather than BAM (with .cram "
+                        "extensions). Requires --reference.")
+
+    parser.add_argument("--sort_memory", default=util.SORT_MEMORY_DEFAULT,
+                        help="Maximum memory per thread used to sort the "
+                        "input BAM file, with K, M or G suffix "
+                        "(default=%s)." % util.SORT_MEMORY_DEFAULT)
+
+    parser.add_argument("--stream_sort", action='store_true', default=False,
+                        help="Read sorted reads directly from the sort "
+                        "rather than writing a sorted BAM file and "
+                        "reading it back. Only used if --is_sorted is not "
+                        "given. Cannot be used with --processes.")
+    
     parser.add_argument("--max_seqs", type=int, default=MAX_SEQS_DEFAULT,
                         help="The maximum number of sequences with different "
                         "allelic combinations to consider remapping "
@@ -290,10 +758,147 @@ def parse_options():
     parser.add_argument("--max_snps", type=int, default=MAX_SNPS_DEFAULT,
                         help="The maximum number of SNPs allowed to overlap "
                         "a read before discarding the read. Allowing higher "
-                        "numbers will decrease speed and increase memory "
-                        "usage (default=%d)."
+                        "numbers may decrease speed. Reads with allelic "
+                        "combinations are generated one at a time, and "
+                        "generation stops once MAX_SEQS is exceeded, so "
+                        "memory usage does not grow with the number of "
+                        "SNPs (default=%d)."
                          % MAX_SNPS_DEFAULT)
     
+    parser.add_argument("--processes", type=int, default=PROCESSES_DEFAULT,
+                        help="Number of worker processes to use (default=%d). "
+                        "If greater than 1, chromosomes are divided among "
+                        "worker processes, which read their chromosomes "
+                        "through the BAM index and write separate output "
+                        "files that are merged at the end. The sorted "
+                        "input BAM file is indexed if an index does not "
+                        "already exist." % PROCESSES_DEFAULT)
+
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="Write a checkpoint file once the output files "
+                        "for each chromosome (and the sorted input BAM "
+                        "file) are complete, and skip the chromosomes that "
+                        "were completed by an earlier run that was started "
+                        "with this option and did not finish. As with "
+                        "--processes, chromosomes are read through the BAM "
+                        "index and written to separate output files that "
+                        "are merged at the end. A checkpoint is ignored if "
+                        "the input BAM file or SNP files have changed "
+                        "since it was written, or if it was written with "
+                        "options that change the output files (e.g. "
+                        "--max_seqs, --samples or --compress_level). "
+                        "Cannot be used with --collated, "
+                        "--remap_command, --remap_index or (unless input "
+                        "is sorted) --stream_sort.")
+
+    parser.add_argument("--pair_cache_size", type=int,
+                        default=readpaircache.READ_PAIR_CACHE_SIZE,
+                        help="Maximum number of paired-end reads to hold in "
+                        "memory while waiting for their mates (default=%d). "
+                        "Additional reads are written to a temporary "
+                        "on-disk store in the output directory. Reads are "
+                        "discarded once the position of their mate has "
+                        "passed without the mate being seen." %
+                        readpaircache.READ_PAIR_CACHE_SIZE)
+
+    parser.add_argument("--compress_level", type=int,
+                        default=fastqwriter.COMPRESS_LEVEL_DEFAULT,
+                        help="zlib compression level (1-9) for output "
+                        "fastq files (default=%d). If 0, fastq files "
+                        "are written uncompressed and their names do not "
+                        "end with .gz" % fastqwriter.COMPRESS_LEVEL_DEFAULT)
+
+    parser.add_argument("--writer_threads", type=int,
+                        default=fastqwriter.WRITER_THREADS_DEFAULT,
+                        help="Number of threads used to compress each "
+                        "output fastq file (default=%d). Fastq records are "
+                        "buffered into large blocks which are compressed "
+                        "as separate gzip members. If 0, compression is "
+                        "done by the main thread." %
+                        fastqwriter.WRITER_THREADS_DEFAULT)
+
+    parser.add_argument("--remap_command", default=None,
+                        help="Aligner command to stream reads for remapping "
+                        "to, instead of writing them to fastq files. The "
+                        "command is run by the shell and should write SAM "
+                        "or BAM to stdout. For single-end reads it must "
+                        "contain {fastq}, for paired-end reads {fastq1} "
+                        "and {fastq2}. These are replaced with named pipes "
+                        "that can be read like uncompressed fastq files. "
+                        "The aligner output is filtered as it is written "
+                        "(as by filter_remapped_reads.py) and reads that "
+                        "pass are written to PREFIX.remap.keep.bam. Cannot "
+                        "be used with --processes.")
+
+    parser.add_argument("--dedup_remap", action='store_true', default=False,
+                        help="Write the sequences for remapping only once "
+                        "for reads (e.g. PCR or optical duplicates) that "
+                        "would be remapped with the same sequences at the "
+                        "same position as an earlier read. The names of "
+                        "the duplicates and of the earlier reads are "
+                        "written to PREFIX.remap.dups.txt.gz, which should "
+                        "be passed to filter_remapped_reads.py with --dups "
+                        "so that duplicates are kept or discarded along "
+                        "with the earlier reads.")
+
+    parser.add_argument("--kmer_index", default=None,
+                        metavar="KMER_INDEX_FILE",
+                        help="K-mer index of the reference genome, "
+                        "written by kmerindex.py. Reads are kept without "
+                        "remapping if every k-mer of their generated reads "
+                        "that overlaps an alternate allele is absent from "
+                        "the genome, every other k-mer occurs at most "
+                        "once, and each generated read has fewer than "
+                        "READ_LEN / K flipped alleles, so that no other "
+                        "location matches the generated reads as well as "
+                        "the read's own location.")
+
+    parser.add_argument("--flip_cache", default=None,
+                        metavar="FLIP_CACHE_DIR",
+                        help="Directory holding a record of whether "
+                        "remapped reads mapped back to the same location, "
+                        "keyed on SNP position, read length, offset of the "
+                        "SNP in the read and flipped allele. It is shared "
+                        "by all samples mapped to the same reference (e.g. "
+                        "kept next to the SNP HDF5 files), and updated by "
+                        "filter_remapped_reads.py --flip_cache. Single-end "
+                        "reads that overlap one SNP are kept without "
+                        "remapping if reads with the same keys have mapped "
+                        "back to the same location at least %d times and "
+                        "have never failed to. The keys of remapped reads "
+                        "are written to PREFIX.remap.flips.txt.gz." %
+                        flipcache.FLIP_CACHE_MIN_PASS)
+
+    parser.add_argument("--metrics", default=None, metavar="METRICS_FILE",
+                        help="Write counts of reads kept, remapped and "
+                        "discarded (by reason), read throughput, time spent "
+                        "reading SNPs and processing reads, remap fan-out "
+                        "and read pair cache size, in total and for each "
+                        "chromosome, to this JSON file.")
+
+    parser.add_argument("--progress", type=int, default=None,
+                        help="Write a progress line to stderr every "
+                        "PROGRESS reads.")
+
+    parser.add_argument("--remap_index", action='store_true', default=False,
+                        help="Instead of copying reads that need remapping "
+                        "to PREFIX.to.remap.bam, write a compact index "
+                        "PREFIX.to.remap.idx with the offset of each read in "
+                        "the sorted input BAM file. filter_remapped_reads.py "
+                        "accepts this index in place of the to.remap BAM "
+                        "file, and reads the kept reads from the input BAM "
+                        "file, which must not be moved or deleted. Cannot be "
+                        "used with --processes or --stream_sort.")
+
+    parser.add_argument("--no_snp_cache", action='store_true', default=False,
+                        help="Do not read or write binary caches of the "
+                        "SNP text files in --snp_dir. By default the SNPs "
+                        "for each chromosome are saved to "
+                        "CHROM.snps.txt.gz%s the first time they are read, "
+                        "and later runs load them from this file unless "
+                        "the text file has since changed." %
+                        snptable.SNP_CACHE_SUFFIX)
+
     parser.add_argument("--output_dir", default=None,
                         help="Directory to write output files to. If not "
                         "specified, output files are written to the "
@@ -324,7 +929,9 @@ def parse_options():
                         help="Path to HDF5 file containing SNP index. The "
                         "SNP index is used to convert the genomic position "
                         "of a SNP to its corresponding row in the haplotype "
-                        "and snp_tab HDF5 files.",
+                        "and snp_tab HDF5 files. Either a dense index or a "
+                        "compact index (written by snp2h5 "
+                        "--compact_snp_index) can be used.",
                         metavar="SNP_INDEX_H5_FILE",
                         default=None)
     
@@ -336,6 +943,15 @@ def parse_options():
                         metavar="HAPLOTYPE_H5_FILE",
                         default=None)
 
+    parser.add_argument("--snp_cache_dir", default=None,
+                        help="Directory to keep memory-mapped copies of "
+                        "the SNP tables and haplotypes read from the "
+                        "--snp_tab, --snp_index and --haplotype files. "
+                        "Each chromosome is copied once, and jobs that "
+                        "use the same directory share a single copy in "
+                        "memory. The copies are rebuilt if the HDF5 files "
+                        "change.", metavar="SNP_CACHE_DIR")
+
     parser.add_argument("--samples",
                         help="Use only haplotypes and SNPs that are "
                         "polymorphic in these samples. "
@@ -365,6 +981,60 @@ def parse_options():
                          "--snp_index AND --haplotype) arguments must be "
                          "provided")
     
+    if options.processes < 1:
+        parser.error("--processes must be at least 1")
+
+    if options.pair_cache_size < 1:
+        parser.error("--pair_cache_size must be at least 1")
+
+    if options.compress_level < 0 or options.compress_level > 9:
+        parser.error("--compress_level must be between 0 and 9")
+
+    if options.writer_threads < 0:
+        parser.error("--writer_threads must be at least 0")
+
+    if options.progress is not None and options.progress < 1:
+        parser.error("--progress must be at least 1")
+
+    if options.sort_threads < 1:
+        parser.error("--sort_threads must be at least 1")
+
+    if options.threads < 1:
+        parser.error("--threads must be at least 1")
+
+    if options.output_cram and not options.reference:
+        parser.error("--output_cram requires --reference")
+
+    if options.stream_sort and options.processes > 1:
+        parser.error("--stream_sort cannot be used with --processes "
+                     "greater than 1")
+
+    if options.remap_index and options.processes > 1:
+        parser.error("--remap_index cannot be used with --processes "
+                     "greater than 1")
+
+    if options.remap_index and options.stream_sort and \
+       not options.is_sorted and not options.collated:
+        parser.error("--remap_index cannot be used with --stream_sort")
+
+    if options.collated and options.processes > 1:
+        parser.error("--collated cannot be used with --processes "
+                     "greater than 1")
+
+    if options.remap_command and options.processes > 1:
+        parser.error("--remap_command cannot be used with --processes "
+                     "greater than 1")
+
+    if options.resume:
+        if options.collated:
+            parser.error("--resume cannot be used with --collated")
+        if options.remap_command:
+            parser.error("--resume cannot be used with --remap_command")
+        if options.remap_index:
+            parser.error("--resume cannot be used with --remap_index")
+        if options.stream_sort and not options.is_sorted:
+            parser.error("--resume cannot be used with --stream_sort")
+    
     if options.samples and not options.haplotype:
         # warn because no way to use samples if haplotype file not specified
         sys.stderr.write("WARNING: ignoring --samples argument "
@@ -400,24 +1070,30 @@ def write_read(read, snp_tab, snp_idx, read_pos):
 
 
 def count_ref_alt_matches(read, read_stats, snp_tab, snp_idx, read_pos):
-    ref_alleles = snp_tab.snp_allele1[snp_idx]
-    alt_alleles = snp_tab.snp_allele2[snp_idx]
-    
-    for i in range(len(snp_idx)):
-        if ref_alleles[i] == read.query_sequence[read_pos[i]-1]:
-            # read matches reference allele
-            read_stats.ref_count += 1
-        elif alt_alleles[i] == read.query_sequence[read_pos[i]-1]:
-            # read matches non-reference allele
-            read_stats.alt_count += 1
-        else:
-            # read matches neither ref nor other
-            read_stats.other_count += 1
+    ref_codes = snp_tab.snp_code1[snp_idx]
+    alt_codes = snp_tab.snp_code2[snp_idx]
+
+    # nucleotide codes of read bases that overlap SNPs
+    read_codes = snptable.get_seq_codes(read.query_sequence)
+    read_codes = read_codes[np.array(read_pos, dtype=np.int64) - 1]
+
+    # read matches reference allele
+    is_ref = (read_codes == ref_codes)
+    # read matches non-reference allele
+    is_alt = ~is_ref & (read_codes == alt_codes)
+    
+    read_stats.ref_count += int(np.sum(is_ref))
+    read_stats.alt_count += int(np.sum(is_alt))
+    # read matches neither ref nor other
+    read_stats.other_count += len(snp_idx) - int(np.sum(is_ref | is_alt))
             
 
 
 def get_unique_haplotypes(haplotypes, snp_idx):
     """returns list of vectors of unique haplotypes for this set of SNPs"""
+    if isinstance(haplotypes, snptable.PackedHaplotypes):
+        return haplotypes.get_unique_columns(snp_idx)
+    
     haps = haplotypes[snp_idx,:].T
     
     # create view of data that joins all elements of column
@@ -434,36 +1110,37 @@ def get_unique_haplotypes(haplotypes, snp_idx):
 
             
 def generate_haplo_reads(read_seq, snp_idx, read_pos, ref_alleles, alt_alleles,
-                         haplo_tab):
-    haps = get_unique_haplotypes(haplo_tab, snp_idx)
+                         haplo_tab, hap_cache=None):
+    """Generator that yields reads using observed haplotypes. ref_alleles
+    and alt_alleles are arrays of nucleotide codes (see 
+    SNPTable.snp_code1 and snp_code2). If a HaplotypeCache is provided
+    it is used to lookup unique haplotypes."""
+    if hap_cache is not None:
+        haps = hap_cache.get_unique_haplotypes(haplo_tab, snp_idx)
+    else:
+        haps = get_unique_haplotypes(haplo_tab, snp_idx)
 
     # sys.stderr.write("UNIQUE haplotypes: %s\n"
     #                  "read_pos: %s\n"
     #                 % (repr(haps), read_pos))
     
-    read_len = len(read_seq)
-
-    new_read_list = []
-
+    # ASCII values of alleles
+    ref_bytes = [snptable.NUC_ASCII[c] for c in ref_alleles]
+    alt_bytes = [snptable.NUC_ASCII[c] for c in alt_alleles]
+    
     # loop over haplotypes
     for hap in haps:
-        new_read = []
-        cur_pos = 1
-
+        new_read = bytearray(read_seq.encode("ascii"))
         missing_data = False
 
         # loop over the SNPs to get alleles that make up this haplotype
         for i in range(len(hap)):
-            if read_pos[i] > cur_pos:
-                # add segment of read
-                new_read.append(read_seq[cur_pos-1:read_pos[i]-1])
-            # add segment for appropriate allele
             if hap[i] == 0:
                 # reference allele
-                new_read.append(ref_alleles[i])
+                new_read[read_pos[i]-1] = ref_bytes[i]
             elif hap[i] == 1:
                 # alternate allele
-                new_read.append(alt_alleles[i])
+                new_read[read_pos[i]-1] = alt_bytes[i]
             else:
                 # haplotype has unknown genotype or phasing so skip it...
                 # not sure if this is the best thing to do, could instead
@@ -472,59 +1149,93 @@ def generate_haplo_reads(read_seq, snp_idx, read_pos, ref_alleles, alt_alleles,
                 missing_data = True
                 break
             
-            cur_pos = read_pos[i] + 1
-
-        if read_len >= cur_pos:
-            # add final segment
-            new_read.append(read_seq[cur_pos-1:read_len])
-            
         if not missing_data:
-            new_seq = "".join(new_read)
+            yield bytes(new_read)
 
-            # sanity check: read should be same length as original
-            if len(new_seq) != read_len:
-                raise ValueError("Expected read len to be %d but "
-                                 "got %d.\n"
-                                 "ref_alleles: %s\n"
-                                 "alt_alleles: %s\n"
-                                 "read_pos: %s\n"
-                                 "snp_idx: %s\n"
-                                 "haps: %s\n" 
-                                 % (read_len, len(new_seq),
-                                    repr(ref_alleles), repr(alt_alleles),
-                                    repr(read_pos), repr(snp_idx),
-                                    repr(haps)))
+    
 
-            new_read_list.append("".join(new_seq))
 
-    return new_read_list
+def generate_haplo_pairs(read_seqs, snp_idx, read_pos, ref_alleles,
+                         alt_alleles, haplo_tab, hap_cache=None):
+    """Generator that yields read pairs using observed haplotypes.
+    Arguments are pairs (one element for each end of the read pair)
+    of read sequences, and of the indices, read positions and allele
+    codes of the SNPs that each end overlaps. Unique haplotypes are
+    found once for the union of SNPs overlapping both ends, so that
+    only read pairs that occur together on an observed haplotype are
+    generated (rather than every combination of the reads generated
+    for each end). Haplotypes with unknown genotype or phasing at any
+    of the SNPs are skipped."""
+    union_idx = np.union1d(np.asarray(snp_idx[0], dtype=np.int64),
+                           np.asarray(snp_idx[1], dtype=np.int64))
+
+    if hap_cache is not None:
+        haps = hap_cache.get_unique_haplotypes(haplo_tab, union_idx)
+    else:
+        haps = get_unique_haplotypes(haplo_tab, union_idx)
 
-    
+    # columns of union haplotypes that give alleles of each end,
+    # and ASCII values of alleles
+    cols = [np.searchsorted(union_idx, idx) for idx in snp_idx]
+    ref_bytes = [[snptable.NUC_ASCII[c] for c in a] for a in ref_alleles]
+    alt_bytes = [[snptable.NUC_ASCII[c] for c in a] for a in alt_alleles]
 
+    for hap in haps:
+        if np.any(hap < 0):
+            continue
+
+        new_pair = []
+        for end in range(2):
+            new_read = bytearray(read_seqs[end].encode("ascii"))
+            for i in range(len(cols[end])):
+                if hap[cols[end][i]] == 0:
+                    new_read[read_pos[end][i]-1] = ref_bytes[end][i]
+                else:
+                    new_read[read_pos[end][i]-1] = alt_bytes[end][i]
+            new_pair.append(bytes(new_read))
+
+        yield tuple(new_pair)
             
-def generate_reads(read_seq, read_pos, ref_alleles, alt_alleles, i):
-    """Recursively generate set of reads with all possible combinations
-    of alleles (i.e. 2^n combinations where n is the number of snps overlapping
-    the reads)
-    """
-    # TODO: this would use a lot less memory if re-implemented
-    # to not use recursion
-    
-    # create new version of this read with both reference and
-    # alternative versions of allele at this index
-    idx = read_pos[i]-1
-    ref_read = read_seq[:idx] + ref_alleles[i] + read_seq[idx+1:]
-    alt_read = read_seq[:idx] + alt_alleles[i] + read_seq[idx+1:]
-
-    if i == len(read_pos)-1:
-        # this was the last SNP
-        return [ref_read, alt_read]
-
-    # continue recursively with other SNPs overlapping this read
-    reads1 = generate_reads(ref_read, read_pos, ref_alleles, alt_alleles, i+1)
-    reads2 = generate_reads(alt_read, read_pos, ref_alleles, alt_alleles,  i+1)
-
-    return reads1 + reads2
+
+            
+def generate_reads(read_seq, read_pos, ref_alleles, alt_alleles):
+    """Generator that yields reads with all possible combinations
+    of alleles (i.e. 2^n combinations where n is the number of snps
+    overlapping the reads). Reads are generated one at a time
+    by modifying a single buffer, so callers can stop early
+    without generating all combinations. The first SNP varies
+    slowest and the last SNP varies fastest. ref_alleles and
+    alt_alleles are arrays of nucleotide codes."""
+    n_snp = len(read_pos)
+    
+    # ASCII values of alleles and offsets of SNPs in read
+    ref_bytes = [snptable.NUC_ASCII[c] for c in ref_alleles]
+    alt_bytes = [snptable.NUC_ASCII[c] for c in alt_alleles]
+    idx = [pos-1 for pos in read_pos]
+
+    # start with reference allele at every SNP
+    new_read = bytearray(read_seq.encode("ascii"))
+    for i in range(n_snp):
+        new_read[idx[i]] = ref_bytes[i]
+    is_alt = [False] * n_snp
+
+    while True:
+        yield bytes(new_read)
+
+        # advance to next combination like an odometer: reset trailing
+        # alt alleles to ref, then switch next SNP from ref to alt
+        i = n_snp - 1
+        while i >= 0 and is_alt[i]:
+            is_alt[i] = False
+            new_read[idx[i]] = ref_bytes[i]
+            i -= 1
+
+        if i < 0:
+            # all combinations have been generated
+            return
+
+        is_alt[i] = True
+        new_read[idx[i]] = alt_bytes[i]
                 
 
 
@@ -576,41 +1287,112 @@ def write_pair_fastq(fastq_file1, fastq_file2, orig_read1, orig_read2,
         
     
 def filter_reads(files, max_seqs=MAX_SEQS_DEFAULT, max_snps=MAX_SNPS_DEFAULT,
-                 samples=None):
+                 samples=None, chroms=None,
+                 pair_cache_size=readpaircache.READ_PAIR_CACHE_SIZE,
+                 chrom_stats=None, progress=None):
+    """Reads through input BAM file, writing reads to keep and
+    remap output files. If a list of chromosomes is provided, only
+    reads from these chromosomes are read (using the BAM index).
+    If a chrom_stats dict is provided, a ReadStats object for each
+    chromosome is added to it (unmapped reads without a chromosome
+    are counted under '*'). If progress is provided, a progress line
+    is written every progress reads. Returns a ReadStats object with
+    counts summed over chromosomes."""
     cur_chrom = None
     cur_tid = None
     seen_chrom = set([])
 
+    if chrom_stats is None:
+        chrom_stats = collections.OrderedDict()
+
     snp_tab = snptable.SNPTable()
-    read_stats = ReadStats()
-    read_pair_cache = {}
-    cache_size = 0
+    read_stats = None
+    hap_cache = HaplotypeCache()
+    # reads that are waiting for their mates. If the cache grows too
+    # large reads are spilled to disk, in same dir as output files
+    read_pair_cache = readpaircache.ReadPairCache(
+        files.input_bam.header, max_size=pair_cache_size,
+        tmp_dir=os.path.dirname(files.prefix) or None)
     read_count = 0
+
+    # if writing a remap index, virtual offset of next read in input
+    # BAM, and offsets of reads in pair cache (keyed on name)
+    if files.remap_index:
+        next_offset = files.input_bam.tell()
+    mate_offsets = {}
+
+    # time that current chromosome was started, and number of
+    # pair cache evictions and spills before it was started
+    chrom_start_time = None
+    chrom_start_evict = 0
+    chrom_start_spill = 0
+
+    # reads and read pairs that are waiting to be processed. SNPs
+    # that overlap reads are looked up a block at a time because
+    # this is much faster than looking them up one read at a time
+    read_block = []
+    read_block_size = 0
+
+    def finish_chrom():
+        """processes remaining reads from current chromosome, and
+        records its haplotype and pair cache counts and timing"""
+        process_read_block(read_block, read_stats, files, snp_tab,
+                           max_seqs, max_snps, hap_cache)
+
+        read_stats.hap_cache_hit += hap_cache.hits
+        read_stats.hap_cache_miss += hap_cache.misses
+        hap_cache.clear()
+
+        n_missing = read_pair_cache.clear()
+        if n_missing != 0:
+            sys.stderr.write("WARNING: failed to find pairs for %d "
+                             "reads on this chromosome\n" % n_missing)
+            read_stats.discard_missing_pair += n_missing
+
+        mate_offsets.clear()
+
+        read_stats.pair_cache_peak = read_pair_cache.peak_size
+        read_stats.pair_cache_evict = read_pair_cache.n_evict - \
+                                      chrom_start_evict
+        read_stats.pair_cache_spill = read_pair_cache.n_spill_total - \
+                                      chrom_start_spill
+        read_pair_cache.peak_size = 0
+
+        read_stats.time_process = time.time() - chrom_start_time - \
+                                  read_stats.time_snp_load
+
+    if chroms is None:
+        reads = files.input_bam
+    else:
+        reads = itertools.chain.from_iterable(files.input_bam.fetch(chrom)
+                                              for chrom in chroms)
     
-    for read in files.input_bam:
-        read_count += 1
-        # if (read_count % 100000) == 0:
-        #     sys.stderr.write("\nread_count: %d\n" % read_count)
-        #     sys.stderr.write("cache_size: %d\n" % cache_size)
+    for read in reads:
+        if files.remap_index:
+            # reads are read in order, so the read starts
+            # where the previous one ended
+            offset = next_offset
+            next_offset = files.input_bam.tell()
 
         # TODO: need to change this to use new pysam API calls
         # but need to check pysam version for backward compatibility
         if read.tid == -1:
             # unmapped read
-            read_stats.discard_unmapped += 1
+            if "*" not in chrom_stats:
+                chrom_stats["*"] = ReadStats()
+            chrom_stats["*"].n_read += 1
+            chrom_stats["*"].discard_unmapped += 1
             continue
         
         if (cur_tid is None) or (read.tid != cur_tid):
-            # this is a new chromosome
+            # this is a new chromosome, process remaining reads
+            # from previous chromosome before SNPs are replaced
+            if read_stats is not None:
+                finish_chrom()
+            read_block = []
+            read_block_size = 0
+            
             cur_chrom = files.input_bam.getrname(read.tid)
-
-            if len(read_pair_cache) != 0:
-                sys.stderr.write("WARNING: failed to find pairs for %d "
-                                 "reads on this chromosome\n" %
-                                 len(read_pair_cache))
-                read_stats.discard_missing_pair += len(read_pair_cache)
-            read_pair_cache = {}
-            cache_size = 0
             read_count = 0
             
             if cur_chrom in seen_chrom:
@@ -621,20 +1403,37 @@ def filter_reads(files, max_seqs=MAX_SEQS_DEFAULT, max_snps=MAX_SNPS_DEFAULT,
             cur_tid = read.tid
             sys.stderr.write("starting chromosome %s\n" % cur_chrom)
 
-            # use HDF5 files if they are provided, otherwise use text
-            # files from SNP dir
-            if files.snp_tab_h5:
-                sys.stderr.write("reading SNPs from file '%s'\n" %
-                                 files.snp_tab_h5.filename)
-                snp_tab.read_h5(files.snp_tab_h5, files.snp_index_h5,
-                                files.hap_h5, cur_chrom, samples)
-            else:
-                snp_filename = "%s/%s.snps.txt.gz" % (files.snp_dir, cur_chrom)
-                sys.stderr.write("reading SNPs from file '%s'\n" % snp_filename)
-                snp_tab.read_file(snp_filename)
+            read_stats = ReadStats()
+            chrom_stats[cur_chrom] = read_stats
+            chrom_start_time = time.time()
+            chrom_start_evict = read_pair_cache.n_evict
+            chrom_start_spill = read_pair_cache.n_spill_total
+
+            read_chrom_snps(files, snp_tab, cur_chrom, samples)
+            read_stats.time_snp_load = time.time() - chrom_start_time
             
             sys.stderr.write("processing reads\n")
 
+        read_count += 1
+        read_stats.n_read += 1
+        if progress and (read_count % progress) == 0:
+            elapsed = time.time() - chrom_start_time - \
+                      read_stats.time_snp_load
+            sys.stderr.write("progress: chromosome %s reads: %d "
+                             "reads/sec: %.0f pair cache size: %d\n" %
+                             (cur_chrom, read_count,
+                              read_count / max(elapsed, 1e-6),
+                              len(read_pair_cache)))
+
+        # discard cached reads whose mates should have been seen
+        # before this position
+        evicted = read_pair_cache.evict(read.reference_start)
+        if evicted:
+            read_stats.discard_missing_pair += len(evicted)
+            if files.remap_index:
+                for name in evicted:
+                    del mate_offsets[name]
+
         if read.is_secondary:
             # this is a secondary alignment (i.e. read was aligned more than
             # once and this has align score that <= best score)
@@ -660,58 +1459,575 @@ def filter_reads(files, max_seqs=MAX_SEQS_DEFAULT, max_snps=MAX_SNPS_DEFAULT,
                     continue
                 # sys.stderr.write(' => proper\n')
 
-                if read.qname in read_pair_cache:
-                    # we already saw prev pair, retrieve from cache
-                    read1 = read_pair_cache[read.qname]
+                read1 = read_pair_cache.pop(read.qname)
+                if read1 is not None:
+                    # we already saw prev pair, retrieved from cache
                     read2 = read
-                    del read_pair_cache[read.qname]
-                    cache_size -= 1
+                    if files.remap_index:
+                        read1_offset = mate_offsets.pop(read.qname)
 
                     if read2.next_reference_start != read1.reference_start:
                         sys.stderr.write("WARNING: read pair positions "
                                          "do not match for pair %s\n" %
                                          read.qname)
                     else:
-                        process_paired_read(read1, read2, read_stats,
-                                            files, snp_tab, max_seqs,
-                                            max_snps)
+                        if files.remap_index:
+                            files.remap_bam.set_offset(read1, read1_offset)
+                            files.remap_bam.set_offset(read2, offset)
+                        read_block.append((read1, read2))
+                        read_block_size += 2
                 else:
                     # we need to wait for next pair
-                    read_pair_cache[read.qname] = read
-
-                    cache_size += 1
+                    read_pair_cache.add(read)
+                    if files.remap_index:
+                        mate_offsets[read.qname] = offset
 
-                    
             else:
                 # other side of pair mapped to different
                 # chromosome, discard this read
                 read_stats.discard_different_chromosome += 1
 
         else:
-            process_single_read(read, read_stats, files, snp_tab,
-                                max_seqs, max_snps)
+            if files.remap_index:
+                files.remap_bam.set_offset(read, offset)
+            read_block.append((read,))
+            read_block_size += 1
+
+        if read_block_size >= READ_BLOCK_SIZE:
+            process_read_block(read_block, read_stats, files, snp_tab,
+                               max_seqs, max_snps, hap_cache)
+            read_block = []
+            read_block_size = 0
+
+    if read_stats is not None:
+        finish_chrom()
+    read_pair_cache.close()
+
+    total_stats = ReadStats()
+    for stats in chrom_stats.values():
+        total_stats.add(stats)
+    
+    return total_stats
+
+
+
+def read_chrom_snps(files, snp_tab, chrom, samples=None):
+    """reads SNPs for a chromosome into snp_tab. HDF5 files are used
+    if they are provided, otherwise text files from SNP dir"""
+    if files.snp_h5_cache:
+        sys.stderr.write("reading SNPs from cache '%s'\n" %
+                         files.snp_h5_cache.cache_dir)
+        files.snp_h5_cache.read(snp_tab, chrom, samples)
+    elif files.snp_tab_h5:
+        sys.stderr.write("reading SNPs from file '%s'\n" %
+                         files.snp_tab_h5.filename)
+        snp_tab.read_h5(files.snp_tab_h5, files.snp_index_h5,
+                        files.hap_h5, chrom, samples)
+    else:
+        snp_filename = "%s/%s.snps.txt.gz" % (files.snp_dir, chrom)
+        sys.stderr.write("reading SNPs from file '%s'\n" % snp_filename)
+        snp_tab.read_file(snp_filename, use_cache=files.snp_cache)
+
+
+
+def filter_reads_collated(files, max_seqs=MAX_SEQS_DEFAULT,
+                          max_snps=MAX_SNPS_DEFAULT, samples=None,
+                          chrom_stats=None, progress=None):
+    """Reads through a name-collated input BAM file (e.g. as written
+    by the aligner, or by samtools collate), where the two ends of a
+    read pair are next to each other, and writes reads to keep and
+    remap output files. Reads are collected into blocks for each
+    chromosome. SNPs for a chromosome are read the first time its
+    block is processed, and kept until all reads have been read.
+    Neither sorting nor a read pair cache is needed. chrom_stats
+    and progress are used as by filter_reads. Returns a ReadStats
+    object with counts summed over chromosomes."""
+    if chrom_stats is None:
+        chrom_stats = collections.OrderedDict()
+
+    hd = files.input_bam.header.get('HD', {})
+    if hd.get('SO') == 'coordinate':
+        sys.stderr.write("WARNING: input BAM file is coordinate-sorted, "
+                         "so ends of read pairs are unlikely to be next to "
+                         "each other\n")
+
+    # SNP tables and haplotype caches for chromosomes that have
+    # been seen so far, and blocks of reads waiting to be processed
+    # for each chromosome
+    snp_tabs = {}
+    hap_caches = {}
+    read_blocks = collections.defaultdict(list)
+    read_block_sizes = collections.defaultdict(int)
+
+    def get_chrom_stats(chrom):
+        if chrom not in chrom_stats:
+            chrom_stats[chrom] = ReadStats()
+        return chrom_stats[chrom]
+
+    def process_chrom_block(chrom):
+        read_stats = get_chrom_stats(chrom)
+
+        if chrom not in snp_tabs:
+            sys.stderr.write("reading SNPs for chromosome %s\n" % chrom)
+            start_time = time.time()
+            snp_tabs[chrom] = snptable.SNPTable()
+            read_chrom_snps(files, snp_tabs[chrom], chrom, samples)
+            hap_caches[chrom] = HaplotypeCache()
+            read_stats.time_snp_load += time.time() - start_time
+
+        start_time = time.time()
+        process_read_block(read_blocks[chrom], read_stats, files,
+                           snp_tabs[chrom], max_seqs, max_snps,
+                           hap_caches[chrom])
+        read_stats.time_process += time.time() - start_time
+        read_blocks[chrom] = []
+        read_block_sizes[chrom] = 0
+
+    # first end of read pair, waiting for its mate which
+    # should be the next primary alignment
+    mate_read = None
+    read_count = 0
+    start_time = time.time()
+
+    # if writing a remap index, virtual offset of next read
+    # in input BAM, and offset of mate_read
+    if files.remap_index:
+        next_offset = files.input_bam.tell()
+    mate_offset = None
+
+    for read in files.input_bam:
+        if files.remap_index:
+            offset = next_offset
+            next_offset = files.input_bam.tell()
+
+        read_count += 1
+        if progress and (read_count % progress) == 0:
+            sys.stderr.write("progress: reads: %d reads/sec: %.0f\n" %
+                             (read_count, read_count /
+                              max(time.time() - start_time, 1e-6)))
+
+        if mate_read is not None and read.qname != mate_read.qname:
+            # mate was not next to first end of pair
+            get_chrom_stats(files.input_bam.getrname(mate_read.tid)).\
+                discard_missing_pair += 1
+            mate_read = None
+
+        if read.tid == -1:
+            # unmapped read
+            read_stats = get_chrom_stats("*")
+            read_stats.n_read += 1
+            read_stats.discard_unmapped += 1
+            continue
+
+        chrom = files.input_bam.getrname(read.tid)
+        read_stats = get_chrom_stats(chrom)
+        read_stats.n_read += 1
+
+        if read.is_secondary or read.is_supplementary:
+            # supplementary alignments are grouped with the ends of
+            # the pair, so must be skipped here to find the mate
+            read_stats.discard_secondary += 1
+            continue
+
+        if read.is_paired:
+            if read.mate_is_unmapped:
+                read_stats.discard_mate_unmapped += 1
+                continue
+            if read.next_reference_id != read.tid:
+                read_stats.discard_different_chromosome += 1
+                continue
+            if not read.is_proper_pair:
+                read_stats.discard_improper_pair += 1
+                continue
+
+            if mate_read is None:
+                # wait for other end of pair
+                mate_read = read
+                mate_offset = offset if files.remap_index else None
+                continue
+
+            if files.remap_index:
+                files.remap_bam.set_offset(mate_read, mate_offset)
+                files.remap_bam.set_offset(read, offset)
+
+            # order ends of pair by position, as they would be
+            # in a coordinate-sorted file
+            if read.reference_start < mate_read.reference_start:
+                read1, read2 = read, mate_read
+            else:
+                read1, read2 = mate_read, read
+            mate_read = None
+
+            if read2.next_reference_start != read1.reference_start:
+                sys.stderr.write("WARNING: read pair positions "
+                                 "do not match for pair %s\n" %
+                                 read.qname)
+                continue
+
+            read_blocks[chrom].append((read1, read2))
+            read_block_sizes[chrom] += 2
+        else:
+            if files.remap_index:
+                files.remap_bam.set_offset(read, offset)
+            read_blocks[chrom].append((read,))
+            read_block_sizes[chrom] += 1
+
+        if read_block_sizes[chrom] >= READ_BLOCK_SIZE:
+            process_chrom_block(chrom)
+
+    if mate_read is not None:
+        get_chrom_stats(files.input_bam.getrname(mate_read.tid)).\
+            discard_missing_pair += 1
+
+    # process remaining reads, in the order chromosomes
+    # appear in the BAM header
+    for chrom in files.input_bam.references:
+        if read_blocks.get(chrom):
+            process_chrom_block(chrom)
+
+    for chrom, hap_cache in hap_caches.items():
+        chrom_stats[chrom].hap_cache_hit += hap_cache.hits
+        chrom_stats[chrom].hap_cache_miss += hap_cache.misses
+
+    total_stats = ReadStats()
+    for stats in chrom_stats.values():
+        total_stats.add(stats)
+
+    if total_stats.discard_missing_pair != 0:
+        sys.stderr.write("WARNING: failed to find pairs for %d reads\n" %
+                         total_stats.discard_missing_pair)
+
+    return total_stats
+
+
+
+def filter_reads_chrom(args):
+    """Worker function used by filter_reads_parallel. Runs filter_reads
+    on a single chromosome, writing output to files that start with
+    the provided prefix. Returns the name of the chromosome, the
+    names of the output files and a ReadStats object"""
+    chrom, part_prefix, file_args, filter_args = args
+
+    files = DataFiles(output_prefix=part_prefix, **file_args)
+    read_stats = filter_reads(files, chroms=[chrom], **filter_args)
+    files.close()
+
+    return chrom, files.get_output_filenames(), read_stats
+
+
+
+def index_bam(bam_filename):
+    """creates index for BAM (or CRAM) file if one does not
+    already exist"""
+    if os.path.exists(bam_filename + ".bai") or \
+       os.path.exists(bam_filename + ".csi") or \
+       os.path.exists(bam_filename + ".crai"):
+        return
+
+    sys.stderr.write("creating index for %s\n" % bam_filename)
+    pysam.index(bam_filename)
 
-    if len(read_pair_cache) != 0:
-        sys.stderr.write("WARNING: failed to find pairs for %d "
-                         "reads on this chromosome\n" %
-                         len(read_pair_cache))
-        read_stats.discard_missing_pair += len(read_pair_cache)
     
-    read_stats.write(sys.stderr)
+
+def concatenate_files(filenames, output_filename):
+    """concatenates files into a single output file. This works for
+    uncompressed fastq files, and for gzipped fastq files because a
+    gzip file can be made up of several gzip 'members'."""
+    out_f = open(output_filename, "wb")
+    for filename in filenames:
+        f = open(filename, "rb")
+        shutil.copyfileobj(f, out_f)
+        f.close()
+    out_f.close()
+
+
+
+def merge_part_files(files, part_filenames_list):
+    """merges output files written by worker processes (in the order
+    provided) into the final output files, then deletes them"""
+    output_filenames = files.get_output_filenames()
+
+    for i in range(len(output_filenames)):
+        part_filenames = [p[i] for p in part_filenames_list]
+
+        is_bam = output_filenames[i].endswith(".bam") or \
+                 util.is_cram(output_filenames[i])
+
+        if is_bam and part_filenames:
+            # concatenate BAMs (or CRAMs) without decompressing
+            # and recompressing
+            pysam.cat("-o", output_filenames[i], *part_filenames)
+        elif is_bam:
+            # no reads on any chromosome, write empty BAM with header
+            bam = files.open_bam(output_filenames[i], "wb",
+                                 template=files.input_bam)
+            bam.close()
+        else:
+            concatenate_files(part_filenames, output_filenames[i])
+
+        for filename in part_filenames:
+            os.remove(filename)
+
+
+
+def get_source_info(filename):
+    """returns dict identifying a file by its absolute path, size
+    and modification time"""
+    st = os.stat(filename)
+    return {'filename' : os.path.abspath(filename),
+            'size' : st.st_size,
+            'mtime' : st.st_mtime}
+
+
+
+def get_checkpoint_settings(chrom, file_args, filter_args):
+    """returns dict of the settings and input files (other than the
+    sorted input BAM file) that the output files for a chromosome
+    depend on, in the form that it is read back from a checkpoint"""
+    settings = {}
+    for name in CHECKPOINT_FILTER_ARGS:
+        settings[name] = filter_args.get(name)
+    for name in CHECKPOINT_FILE_ARGS:
+        settings[name] = file_args.get(name)
+
+    input_filenames = [file_args.get('snp_tab_filename'),
+                       file_args.get('snp_index_filename'),
+                       file_args.get('haplotype_filename'),
+                       file_args.get('kmer_index_filename')]
+    if file_args.get('snp_dir'):
+        input_filenames.append("%s/%s.snps.txt.gz" %
+                               (file_args['snp_dir'], chrom))
+    settings['input_files'] = [get_source_info(filename)
+                               for filename in input_filenames
+                               if filename and os.path.exists(filename)]
+
+    # e.g. tuples become lists when written as JSON
+    return json.loads(json.dumps(settings))
+
+
+
+def write_checkpoint(prefix, source_filename, output_filenames,
+                     read_stats=None, settings=None):
+    """writes file that marks that output files (starting with prefix)
+    made from source_filename are complete. The counts of a ReadStats
+    object, and the settings used to make the output files, can be
+    saved with it. The file is written under a temporary name and
+    renamed, so that it only exists once complete"""
+    checkpoint = {'source' : get_source_info(source_filename),
+                  'settings' : settings,
+                  'output_filenames' : list(output_filenames),
+                  'read_stats' : None}
+    if read_stats is not None:
+        checkpoint['read_stats'] = vars(read_stats)
+
+    checkpoint_filename = prefix + CHECKPOINT_SUFFIX
+    f = open(checkpoint_filename + ".tmp", "w")
+    json.dump(checkpoint, f)
+    f.close()
+    os.rename(checkpoint_filename + ".tmp", checkpoint_filename)
+
+
+
+def read_checkpoint(prefix, source_filename, settings=None):
+    """returns dict read from file written by write_checkpoint, or None
+    if there is no such file, if source_filename has changed since it
+    was written, if it was written with different settings, or if any
+    of the output files are missing"""
+    checkpoint_filename = prefix + CHECKPOINT_SUFFIX
+    if not os.path.exists(checkpoint_filename):
+        return None
+
+    f = open(checkpoint_filename)
+    checkpoint = json.load(f)
+    f.close()
+
+    if checkpoint['source'] != get_source_info(source_filename):
+        return None
+    if checkpoint.get('settings') != settings:
+        return None
+    for filename in checkpoint['output_filenames']:
+        if not os.path.exists(filename):
+            return None
+
+    if checkpoint['read_stats'] is not None:
+        read_stats = ReadStats()
+        for name, value in checkpoint['read_stats'].items():
+            setattr(read_stats, name, value)
+        checkpoint['read_stats'] = read_stats
+
+    return checkpoint
+
+
+
+def filter_reads_parallel(files, file_args, filter_args, processes,
+                          chrom_stats=None, resume=False):
+    """Divides chromosomes among worker processes, each of which
+    writes separate output files. Output files are then merged in
+    the order that chromosomes appear in the BAM header. If a
+    chrom_stats dict is provided, the ReadStats object for each
+    chromosome is added to it. Returns a ReadStats object with
+    counts summed over chromosomes.
+
+    If resume is True, a checkpoint file is written once the output
+    files of each chromosome are complete, and chromosomes that were
+    completed by an earlier run are skipped (chromosomes are read
+    through the BAM index, so the reads of skipped chromosomes are
+    never read). Checkpoints are removed once output files are
+    merged."""
+    index_bam(files.bam_sort_filename)
+
+    # re-open input BAM so that index is used
+    files.input_bam.close()
+    files.input_bam = files.open_bam(files.bam_sort_filename, "rb")
+
+    # only consider chromosomes with mapped reads, and process
+    # chromosomes with most reads first to balance load across
+    # worker processes
+    idx_stats = [s for s in files.input_bam.get_index_statistics()
+                 if s.total > 0]
+    idx_stats.sort(key=lambda s: s.total, reverse=True)
+
+    tasks = []
+    part_prefixes = {}
+    for s in idx_stats:
+        tid = files.input_bam.gettid(s.contig)
+        part_prefix = "%s.part%d" % (files.prefix, tid)
+        part_prefixes[s.contig] = part_prefix
+        tasks.append((s.contig, part_prefix, file_args, filter_args))
+
+    read_stats = ReadStats()
+    chrom_filenames = {}
+
+    def finish_chrom(chrom, filenames, stats):
+        chrom_filenames[chrom] = filenames
+        if chrom_stats is not None:
+            chrom_stats[chrom] = stats
+        read_stats.add(stats)
+
+    if resume:
+        # skip chromosomes that were completed by an earlier run
+        # with the same settings and input files
+        chrom_settings = {}
+        remaining_tasks = []
+        for task in tasks:
+            chrom, part_prefix = task[0], task[1]
+            chrom_settings[chrom] = get_checkpoint_settings(chrom, file_args,
+                                                            filter_args)
+            checkpoint = read_checkpoint(part_prefix,
+                                         files.bam_sort_filename,
+                                         chrom_settings[chrom])
+            if checkpoint:
+                sys.stderr.write("skipping chromosome %s, which was "
+                                 "completed by an earlier run\n" % chrom)
+                finish_chrom(chrom, checkpoint['output_filenames'],
+                             checkpoint['read_stats'])
+            else:
+                remaining_tasks.append(task)
+        tasks = remaining_tasks
+
+    sys.stderr.write("processing %d chromosomes using %d processes\n" %
+                     (len(tasks), processes))
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(filter_reads_chrom, tasks)
+    else:
+        pool = None
+        results = (filter_reads_chrom(task) for task in tasks)
+
+    for chrom, filenames, stats in results:
+        sys.stderr.write("finished chromosome %s\n" % chrom)
+        if resume:
+            write_checkpoint(part_prefixes[chrom], files.bam_sort_filename,
+                             filenames, stats, chrom_settings[chrom])
+        finish_chrom(chrom, filenames, stats)
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    # reads without coordinates are not returned by fetch, but
+    # are counted as unmapped when reading through entire file
+    read_stats.discard_unmapped += files.input_bam.nocoordinate
+    read_stats.n_read += files.input_bam.nocoordinate
+    if chrom_stats is not None and files.input_bam.nocoordinate > 0:
+        chrom_stats["*"] = ReadStats()
+        chrom_stats["*"].n_read = files.input_bam.nocoordinate
+        chrom_stats["*"].discard_unmapped = files.input_bam.nocoordinate
+
+    # merge output from each chromosome, in the order that chromosomes
+    # appear in the BAM header
+    merge_part_files(files, [chrom_filenames[chrom]
+                             for chrom in files.input_bam.references
+                             if chrom in chrom_filenames])
+
+    for part_prefix in part_prefixes.values():
+        if os.path.exists(part_prefix + CHECKPOINT_SUFFIX):
+            os.remove(part_prefix + CHECKPOINT_SUFFIX)
+    
+    return read_stats
                      
 
+def process_read_block(read_block, read_stats, files, snp_tab,
+                       max_seqs, max_snps, hap_cache=None):
+    """Looks up SNPs and indels that overlap a block of reads all at
+    once, then processes each single read or read pair in the
+    block in order. Each element of read_block is a tuple containing
+    either a single read or a read pair"""
+    if len(read_block) == 0:
+        return
+    
+    reads = [read for block_reads in read_block for read in block_reads]
+
+    # Most reads do not touch any block of the chromosome that
+    # contains SNPs. Only look up overlapping SNPs for the remaining
+    # reads, the others go straight to the keep path.
+    may_overlap = snp_tab.may_overlap_snps(reads)
+    check_reads = [reads[i] for i in np.where(may_overlap)[0]]
+    check_overlaps = iter(snp_tab.get_overlapping_snps_reads(check_reads))
+    overlaps = [next(check_overlaps) if m else NO_OVERLAPS
+                for m in may_overlap]
+
+    i = 0
+    for block_reads in read_block:
+        if len(block_reads) == 2:
+            process_paired_read(block_reads[0], block_reads[1], read_stats,
+                                files, snp_tab, max_seqs, max_snps,
+                                overlaps=overlaps[i:i+2],
+                                hap_cache=hap_cache)
+        else:
+            process_single_read(block_reads[0], read_stats, files, snp_tab,
+                                max_seqs, max_snps, overlaps=overlaps[i],
+                                hap_cache=hap_cache)
+        i += len(block_reads)
+
+    if files.remap_index:
+        # offsets are no longer needed once reads are processed
+        files.remap_bam.discard_offsets(reads)
+
+
+    
 def process_paired_read(read1, read2, read_stats, files,
-                        snp_tab, max_seqs, max_snps):
+                        snp_tab, max_seqs, max_snps, overlaps=None,
+                        hap_cache=None):
     """Checks if either end of read pair overlaps SNPs or indels
     and writes read pair (or generated read pairs) to appropriate 
-    output files"""
-
-    new_reads = []    
-    for read in (read1, read2):
+    output files. Overlapping SNPs and indels for the two reads
+    can optionally be provided (as returned by 
+    SNPTable.get_overlapping_snps_reads), as can a HaplotypeCache.
+    When haplotypes are used, read pairs are generated from the
+    haplotypes observed across the SNPs overlapped by both reads"""
+
+    if overlaps is None:
+        overlaps = [snp_tab.get_overlapping_snps(read1),
+                    snp_tab.get_overlapping_snps(read2)]
+
+    # indices, read positions and allele codes of SNPs
+    # overlapping each read
+    snp_info = []
+    for read, read_overlaps in zip((read1, read2), overlaps):
         # check if either read overlaps SNPs or indels
-        # check if read overlaps SNPs or indels
-        snp_idx, snp_read_pos, \
-            indel_idx, indel_read_pos = snp_tab.get_overlapping_snps(read)
+        snp_idx, snp_read_pos, indel_idx, indel_read_pos = read_overlaps
         
         if len(indel_idx) > 0:
             # for now discard this read pair, we want to improve this to handle
@@ -720,42 +2036,52 @@ def process_paired_read(read1, read2, read_stats, files,
             # TODO: add option to handle indels instead of throwing out reads
             return
 
-        if len(snp_idx) > 0:
-            ref_alleles = snp_tab.snp_allele1[snp_idx]
-            alt_alleles = snp_tab.snp_allele2[snp_idx]
+        ref_alleles = snp_tab.snp_code1[snp_idx]
+        alt_alleles = snp_tab.snp_code2[snp_idx]
 
+        if len(snp_idx) > 0:
             count_ref_alt_matches(read, read_stats, snp_tab, snp_idx,
                                   snp_read_pos)
 
-            # limit recursion here by discarding reads that
-            # overlap too many SNPs
+            # discard reads that overlap too many SNPs
             if len(snp_read_pos) > max_snps:
                 read_stats.discard_excess_snps += 1
                 return
 
-            if files.hap_h5:
-                # generate reads using observed set of haplotypes
-                read_seqs = generate_haplo_reads(read.query_sequence,
-                                                 snp_idx,
-                                                 snp_read_pos,
-                                                 ref_alleles, alt_alleles,
-                                                 snp_tab.haplotypes)
-            else:
-                # generate all possible allelic combinations of reads
-                read_seqs = generate_reads(read.query_sequence, snp_read_pos,
-                                           ref_alleles, alt_alleles, 0)
-            
-            new_reads.append(read_seqs)
-        else:
-            # no SNPs or indels overlap this read
-            new_reads.append([])
-            
-    if len(new_reads[0]) == 0 and len(new_reads[1]) == 0:
+        snp_info.append((snp_idx, snp_read_pos, ref_alleles, alt_alleles))
+
+    if len(snp_info[0][0]) == 0 and len(snp_info[1][0]) == 0:
         # neither read overlapped SNPs or indels
         files.keep_bam.write(read1)
         files.keep_bam.write(read2)
         read_stats.keep_pair += 1
+        return
+
+    orig_pair = (read1.query_sequence, read2.query_sequence)
+    
+    if files.hap_h5:
+        # generate read pairs using observed set of haplotypes
+        # across the SNPs overlapped by both reads
+        new_pairs = generate_haplo_pairs(orig_pair,
+                                         [x[0] for x in snp_info],
+                                         [x[1] for x in snp_info],
+                                         [x[2] for x in snp_info],
+                                         [x[3] for x in snp_info],
+                                         snp_tab.haplotypes, hap_cache)
     else:
+        # generate all possible allelic combinations of each read
+        new_reads = []
+        for read_seq, (snp_idx, snp_read_pos, ref_alleles, alt_alleles) \
+                in zip(orig_pair, snp_info):
+            if len(snp_idx) > 0:
+                read_seqs = generate_reads(read_seq, snp_read_pos,
+                                           ref_alleles, alt_alleles)
+                # Only generate up to max_seqs reads. If there are more
+                # than this, the read pair is discarded below anyway.
+                new_reads.append(list(itertools.islice(read_seqs, max_seqs)))
+            else:
+                new_reads.append([])
+
         # add original version of both sides of pair
         new_reads[0].append(read1.query_sequence)
         new_reads[1].append(read2.query_sequence)
@@ -765,37 +2091,62 @@ def process_paired_read(read1, read2, read_stats, files,
             read_stats.discard_excess_reads += 2
             return 
 
-        # collect all unique combinations of read pairs
-        unique_pairs = set([])
-        n_unique_pairs = 0
-        for new_read1 in new_reads[0]:
-            for new_read2 in new_reads[1]:
-                pair = (new_read1, new_read2)
-                if pair in unique_pairs:
-                    pass
-                else:
-                    n_unique_pairs += 1
-                    if n_unique_pairs > max_seqs:
-                        read_stats.discard_excess_reads += 2
-                        return
-                    unique_pairs.add(pair)
-
-        # remove original read pair, if present
-        orig_pair = (read1.query_sequence, read2.query_sequence)
-                                 
-        if orig_pair in unique_pairs:
-            unique_pairs.remove(orig_pair)
+        # pair every version of first read with every version of second
+        new_pairs = itertools.product(new_reads[0], new_reads[1])
+
+    # collect all unique combinations of read pairs
+    unique_pairs = set([])
+    for pair in new_pairs:
+        if pair not in unique_pairs:
+            unique_pairs.add(pair)
+            if len(unique_pairs) > max_seqs:
+                read_stats.discard_excess_reads += 2
+                return
+
+    # remove original read pair, if present
+    if orig_pair in unique_pairs:
+        unique_pairs.remove(orig_pair)
+
+    if len(unique_pairs) == 0:
+        # only read pairs generated match original (e.g. all observed
+        # haplotypes carry the same alleles as the reads), so keep
+        # original read pair
+        files.keep_bam.write(read1)
+        files.keep_bam.write(read2)
+        read_stats.keep_pair += 1
+        return
+
+    if files.kmer_index and \
+       all(files.kmer_index.is_unique(set(p[end] for p in unique_pairs),
+                                      snp_info[end][1], snp_info[end][2],
+                                      snp_info[end][3])
+           for end in range(2)):
+        # generated read pairs cannot map anywhere else, so
+        # keep original read pair without remapping
+        files.keep_bam.write(read1)
+        files.keep_bam.write(read2)
+        read_stats.keep_pair += 1
+        read_stats.keep_kmer_unique += 1
+        return
             
+    if files.remap_dedup and files.remap_dedup.is_duplicate(
+            read1.qname, (read1.tid, min(read1.pos, read2.pos),
+                          max(read1.pos, read2.pos),
+                          frozenset(unique_pairs))):
+        # same read pairs were already written for an earlier pair
+        read_stats.remap_dup += 1
+    else:
         # write read pair to fastqs for remapping
         write_pair_fastq(files.fastq1, files.fastq2, read1, read2,
                          unique_pairs)
-
-        # Write read to 'remap' BAM for consistency with previous
-        # implementation of script. Probably not needed and will result in
-        # BAM that is not coordinate sorted. Possibly remove this...
-        files.remap_bam.write(read1)
-        files.remap_bam.write(read2)
-        read_stats.remap_pair += 1
+        read_stats.remap_seqs += len(unique_pairs)
+
+    # Write read to 'remap' BAM for consistency with previous
+    # implementation of script. Probably not needed and will result in
+    # BAM that is not coordinate sorted. Possibly remove this...
+    files.remap_bam.write(read1)
+    files.remap_bam.write(read2)
+    read_stats.remap_pair += 1
         
 
         
@@ -804,13 +2155,16 @@ def process_paired_read(read1, read2, read_stats, files,
     
 
 def process_single_read(read, read_stats, files, snp_tab, max_seqs,
-                        max_snps):
+                        max_snps, overlaps=None, hap_cache=None):
     """Check if a single read overlaps SNPs or indels, and writes
-    this read (or generated read pairs) to appropriate output files"""
+    this read (or generated read pairs) to appropriate output files.
+    Overlapping SNPs and indels can optionally be provided (as returned
+    by SNPTable.get_overlapping_snps), as can a HaplotypeCache"""
                 
     # check if read overlaps SNPs or indels
-    snp_idx, snp_read_pos, \
-        indel_idx, indel_read_pos = snp_tab.get_overlapping_snps(read)
+    if overlaps is None:
+        overlaps = snp_tab.get_overlapping_snps(read)
+    snp_idx, snp_read_pos, indel_idx, indel_read_pos = overlaps
 
     
     if len(indel_idx) > 0:
@@ -821,14 +2175,13 @@ def process_single_read(read, read_stats, files, snp_tab, max_seqs,
         return
 
     if len(snp_idx) > 0:
-        ref_alleles = snp_tab.snp_allele1[snp_idx]
-        alt_alleles = snp_tab.snp_allele2[snp_idx]
+        ref_alleles = snp_tab.snp_code1[snp_idx]
+        alt_alleles = snp_tab.snp_code2[snp_idx]
 
         count_ref_alt_matches(read, read_stats, snp_tab, snp_idx,
                               snp_read_pos)
 
-        # limit recursion here by discarding reads that
-        # overlap too many SNPs
+        # discard reads that overlap too many SNPs
         if len(snp_read_pos) > max_snps:
             read_stats.discard_excess_snps += 1
             return
@@ -837,25 +2190,67 @@ def process_single_read(read, read_stats, files, snp_tab, max_seqs,
             read_seqs = generate_haplo_reads(read.query_sequence, snp_idx,
                                              snp_read_pos,
                                              ref_alleles, alt_alleles,
-                                             snp_tab.haplotypes)
+                                             snp_tab.haplotypes, hap_cache)
         else:
             read_seqs = generate_reads(read.query_sequence,  snp_read_pos,
-                                       ref_alleles, alt_alleles, 0)
+                                       ref_alleles, alt_alleles)
 
         # make set of unique reads, we don't want to remap
-        # duplicates, or the read that matches original
-        unique_reads = set(read_seqs)
+        # duplicates, or the read that matches original. Stop
+        # generating reads as soon as there are max_seqs of them,
+        # because then the read is discarded
+        unique_reads = set([])
+        n_orig = 0
+        for read_seq in read_seqs:
+            unique_reads.add(read_seq)
+            if read_seq == read.query_sequence:
+                n_orig = 1
+            if len(unique_reads) - n_orig >= max_seqs:
+                break
+                
         if read.query_sequence in unique_reads:
             unique_reads.remove(read.query_sequence)
+
+        # keys used to look up and record read in flip cache
+        flip_keys = None
+        if files.flip_cache and 0 < len(unique_reads) < max_seqs:
+            chrom = files.input_bam.getrname(read.tid)
+            flip_keys = flipcache.get_flip_keys(snp_tab.snp_pos[snp_idx],
+                                                snp_read_pos, unique_reads)
         
         if len(unique_reads) == 0:
             # only read generated matches original read,
             # so keep original
             files.keep_bam.write(read)
             read_stats.keep_single += 1
+        elif len(unique_reads) < max_seqs and files.kmer_index and \
+             files.kmer_index.is_unique(unique_reads, snp_read_pos,
+                                        ref_alleles, alt_alleles):
+            # generated reads cannot map anywhere else, so keep
+            # original read without remapping
+            files.keep_bam.write(read)
+            read_stats.keep_single += 1
+            read_stats.keep_kmer_unique += 1
+        elif flip_keys and files.flip_cache.is_safe(chrom, flip_keys):
+            # reads like this one have always mapped back to the
+            # same location, so keep original read without remapping
+            files.keep_bam.write(read)
+            read_stats.keep_single += 1
+            read_stats.keep_flip_safe += 1
         elif len(unique_reads) < max_seqs:
-            # write read to fastq file for remapping
-            write_fastq(files.fastq_single, read, unique_reads)
+            if files.remap_dedup and files.remap_dedup.is_duplicate(
+                    read.qname, (read.tid, read.pos,
+                                 frozenset(unique_reads))):
+                # same reads were already written for an earlier read
+                read_stats.remap_dup += 1
+            else:
+                # write read to fastq file for remapping
+                write_fastq(files.fastq_single, read, unique_reads)
+                read_stats.remap_seqs += len(unique_reads)
+                if flip_keys:
+                    # result of remapping is added to flip cache
+                    files.flip_key_writer.write(read.qname, chrom,
+                                                flip_keys)
 
             # write read to 'to remap' BAM
             # this is probably not necessary with new implmentation
@@ -875,6 +2270,25 @@ def process_single_read(read, read_stats, files, snp_tab, max_seqs,
 
 
 
+def write_metrics(filename, read_stats, chrom_stats, settings=None):
+    """writes counts and times from ReadStats objects, summed over
+    chromosomes and for each chromosome, to a JSON file. settings
+    (e.g. numbers of threads) can optionally be recorded with them"""
+    metrics = collections.OrderedDict()
+    if settings is not None:
+        metrics['settings'] = settings
+    metrics['total'] = read_stats.to_dict()
+    metrics['chromosomes'] = collections.OrderedDict(
+        (chrom, stats.to_dict()) for chrom, stats in chrom_stats.items())
+
+    sys.stderr.write("writing metrics to %s\n" % filename)
+    f = open(filename, "w")
+    json.dump(metrics, f, indent=2, sort_keys=False)
+    f.write("\n")
+    f.close()
+
+
+
 def parse_samples(samples_str):
     """Gets list of samples from --samples argument. This may be 
     a comma-delimited string or a path to a file. If a file is provided 
@@ -919,23 +2333,143 @@ def parse_samples(samples_str):
 
         
 def main(bam_filenames, is_paired_end=False,
-         is_sorted=False, max_seqs=MAX_SEQS_DEFAULT,
+         is_sorted=False, is_collated=False, max_seqs=MAX_SEQS_DEFAULT,
          max_snps=MAX_SNPS_DEFAULT, output_dir=None,
          snp_dir=None, snp_tab_filename=None,
          snp_index_filename=None,
-         haplotype_filename=None, samples=None):
-
-    files = DataFiles(bam_filenames,  is_sorted, is_paired_end,
+         haplotype_filename=None, samples=None,
+         processes=PROCESSES_DEFAULT,
+         pair_cache_size=readpaircache.READ_PAIR_CACHE_SIZE,
+         compress_level=fastqwriter.COMPRESS_LEVEL_DEFAULT,
+         writer_threads=fastqwriter.WRITER_THREADS_DEFAULT,
+         remap_command=None, sort_threads=util.SORT_THREADS_DEFAULT,
+         sort_memory=util.SORT_MEMORY_DEFAULT, stream_sort=False,
+         metrics_filename=None, progress=None, remap_index=False,
+         snp_cache=True, snp_cache_dir=None, dedup_remap=False,
+         kmer_index_filename=None, flip_cache_dir=None,
+         bam_threads=util.BAM_THREADS_DEFAULT, reference=None,
+         ref_cache_dir=None, output_cram=False, resume=False):
+
+    if remap_command and processes > 1:
+        raise ValueError("remap_command cannot be used with more "
+                         "than one process")
+    if is_collated and processes > 1:
+        raise ValueError("collated input cannot be used with more "
+                         "than one process")
+    if stream_sort and not is_sorted and processes > 1:
+        raise ValueError("stream_sort cannot be used with more "
+                         "than one process")
+    if remap_index and processes > 1:
+        raise ValueError("remap_index cannot be used with more "
+                         "than one process")
+    if remap_index and stream_sort and not (is_sorted or is_collated):
+        raise ValueError("remap_index needs sorted reads to be "
+                         "written to a file, so cannot be used "
+                         "with stream_sort")
+
+    if resume and (is_collated or remap_command or remap_index or
+                   (stream_sort and not is_sorted)):
+        raise ValueError("resume cannot be used with collated input, "
+                         "remap_command, remap_index or stream_sort")
+
+    if output_cram and not reference:
+        raise ValueError("reference is needed to write CRAM files")
+
+    # with resume, each chromosome is written to separate output
+    # files, as when there are several processes
+    is_segmented = (processes > 1) or resume
+
+    if ref_cache_dir:
+        refcache.use_ref_cache(ref_cache_dir, reference)
+
+    # collated input does not need to be sorted
+    files = DataFiles(bam_filenames, is_sorted or is_collated, is_paired_end,
                       output_dir=output_dir,
                       snp_dir=snp_dir,
                       snp_tab_filename=snp_tab_filename,
                       snp_index_filename=snp_index_filename,
-                      haplotype_filename=haplotype_filename)
+                      haplotype_filename=haplotype_filename,
+                      open_output=not is_segmented,
+                      compress_level=compress_level,
+                      writer_threads=writer_threads,
+                      remap_command=remap_command,
+                      sort_threads=sort_threads,
+                      sort_memory=sort_memory,
+                      stream_sort=stream_sort,
+                      remap_index=remap_index,
+                      snp_cache=snp_cache,
+                      snp_cache_dir=snp_cache_dir,
+                      dedup_remap=dedup_remap,
+                      kmer_index_filename=kmer_index_filename,
+                      flip_cache_dir=flip_cache_dir,
+                      bam_threads=bam_threads,
+                      reference=reference,
+                      output_cram=output_cram,
+                      resume=resume)
+
+    filter_args = {'max_seqs' : max_seqs,
+                   'max_snps' : max_snps,
+                   'samples' : samples,
+                   'pair_cache_size' : pair_cache_size,
+                   'progress' : progress}
+
+    # ReadStats for each chromosome
+    chrom_stats = collections.OrderedDict()
     
-    filter_reads(files, max_seqs=max_seqs, max_snps=max_snps,
-                 samples=samples)
+    if is_segmented:
+        # worker processes open their own copies of the input
+        # files, using the already sorted BAM
+        file_args = {'bam_filename' : files.bam_sort_filename,
+                     'is_sorted' : True,
+                     'is_paired' : is_paired_end,
+                     'snp_dir' : snp_dir,
+                     'snp_cache' : snp_cache,
+                     'snp_cache_dir' : snp_cache_dir,
+                     'dedup_remap' : dedup_remap,
+                     'kmer_index_filename' : kmer_index_filename,
+                     'flip_cache_dir' : flip_cache_dir,
+                     'snp_tab_filename' : snp_tab_filename,
+                     'snp_index_filename' : snp_index_filename,
+                     'haplotype_filename' : haplotype_filename,
+                     'compress_level' : compress_level,
+                     'writer_threads' : writer_threads,
+                     'bam_threads' : bam_threads,
+                     'reference' : reference,
+                     'output_cram' : output_cram}
+        read_stats = filter_reads_parallel(files, file_args, filter_args,
+                                           processes, chrom_stats=chrom_stats,
+                                           resume=resume)
+    else:
+        try:
+            if is_collated:
+                read_stats = filter_reads_collated(files, max_seqs=max_seqs,
+                                                   max_snps=max_snps,
+                                                   samples=samples,
+                                                   chrom_stats=chrom_stats,
+                                                   progress=progress)
+            else:
+                read_stats = filter_reads(files, chrom_stats=chrom_stats,
+                                          **filter_args)
+        except:
+            if files.remap_stream:
+                files.remap_stream.kill()
+            raise
+
+    read_stats.write(sys.stderr)
+
+    if metrics_filename:
+        settings = collections.OrderedDict()
+        settings['processes'] = processes
+        settings['bam_threads'] = bam_threads
+        settings['sort_threads'] = sort_threads
+        settings['writer_threads'] = writer_threads
+        write_metrics(metrics_filename, read_stats, chrom_stats,
+                      settings=settings)
 
     files.close()
+
+    if files.remap_stream:
+        files.filter_remapped()
     
     
 
@@ -953,12 +2487,33 @@ if __name__ == '__main__':
     
     main(options.bam_filename,
          is_paired_end=options.is_paired_end, is_sorted=options.is_sorted,
+         is_collated=options.collated,
          max_seqs=options.max_seqs, max_snps=options.max_snps,
          output_dir=options.output_dir,
          snp_dir=options.snp_dir,
          snp_tab_filename=options.snp_tab,
          snp_index_filename=options.snp_index,
          haplotype_filename=options.haplotype,
-         samples=samples)
+         samples=samples, processes=options.processes,
+         pair_cache_size=options.pair_cache_size,
+         compress_level=options.compress_level,
+         writer_threads=options.writer_threads,
+         remap_command=options.remap_command,
+         sort_threads=options.sort_threads,
+         sort_memory=options.sort_memory,
+         stream_sort=options.stream_sort,
+         metrics_filename=options.metrics,
+         progress=options.progress,
+         remap_index=options.remap_index,
+         snp_cache=not options.no_snp_cache,
+         snp_cache_dir=options.snp_cache_dir,
+         dedup_remap=options.dedup_remap,
+         kmer_index_filename=options.kmer_index,
+         flip_cache_dir=options.flip_cache,
+         bam_threads=options.threads,
+         reference=options.reference,
+         ref_cache_dir=options.ref_cache,
+         output_cram=options.output_cram,
+         resume=options.resume)
          
     
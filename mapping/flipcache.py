@@ -0,0 +1,215 @@
+import os
+import sys
+import gzip
+import fcntl
+import tempfile
+
+import numpy as np
+
+import util
+import snptable
+
+
+# number of times that reads with a combination of SNP, read length,
+# offset and allele must map back to the same location after being
+# flipped (without ever failing to) before the combination is
+# considered safe. Remapping also depends on the other bases of a
+# read (e.g. sequencing errors), so one passing read is not enough
+FLIP_CACHE_MIN_PASS = 3
+
+# reads longer than this are not recorded in the cache, because their
+# length does not fit in the bits reserved for it in the keys
+FLIP_KEY_MAX_READ_LEN = (1 << 14) - 1
+
+# name of lock file held while cache is updated
+FLIP_CACHE_LOCK_FILENAME = ".lock"
+
+
+
+def get_flip_keys(snp_pos, read_pos, seqs):
+    """Returns list of keys for the sequences generated for a read,
+    each combining the position of the SNP, the read length, the
+    (1-based) offset of the SNP in the read and the allele in the
+    generated sequence. Returns None if the read cannot be recorded
+    in the cache because it overlaps more than one SNP (in which case
+    remapping also depends on the combination of alleles), is too
+    long, or has a generated allele that is not a nucleotide."""
+    if len(snp_pos) != 1:
+        return None
+    seqs = list(seqs)
+    read_len = len(seqs[0])
+    if read_len > FLIP_KEY_MAX_READ_LEN:
+        return None
+    offset = int(read_pos[0])
+
+    keys = []
+    for seq in seqs:
+        code = int(snptable.NUC_CODE_LOOKUP[ord(seq[offset-1])])
+        if code == snptable.NUC_UNDEF:
+            return None
+        keys.append((int(snp_pos[0]) << 30) | (read_len << 16) |
+                    (offset << 2) | code)
+    keys.sort()
+    return keys
+
+
+
+class FlipKeyWriter(object):
+    """Writes the keys of reads that are written for remapping to a
+    gzipped text file, with a tab-delimited line per read giving its
+    name, chromosome and comma-delimited keys. filter_remapped_reads.py
+    uses this file to record whether each read mapped back to the
+    same location in the FlipCache."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = gzip.open(filename, "wb")
+
+
+    def write(self, name, chrom, keys):
+        self.f.write("%s\t%s\t%s\n" % (name, chrom,
+                                       ",".join([str(k) for k in keys])))
+
+
+    def close(self):
+        self.f.close()
+
+
+
+def read_flip_keys(filename):
+    """Generator that yields (name, chromosome, keys) for each read
+    in file written by FlipKeyWriter"""
+    f = gzip.open(filename, "rb")
+    for line in f:
+        name, chrom, keys_str = line.rstrip("\n").split("\t")
+        yield name, chrom, [int(k) for k in keys_str.split(",")]
+    f.close()
+
+
+
+class FlipCache(object):
+    """Persistent record of whether reads overlapping a SNP mapped
+    back to the same location after their alleles were flipped,
+    keyed on the SNP position, read length, offset of the SNP in
+    the read and flipped allele (see get_flip_keys). The cache
+    directory holds a CHROM.flips.npz file per chromosome with the
+    sorted keys and the number of reads that passed and failed for
+    each key. The directory is shared by all samples that are mapped
+    to the same reference genome (e.g. it can be kept next to the SNP
+    HDF5 files), so reads with keys that have passed often enough
+    can skip remapping. Updates hold a lock file, so several runs of
+    filter_remapped_reads.py can update the same cache."""
+
+    def __init__(self, cache_dir, min_pass=FLIP_CACHE_MIN_PASS):
+        self.cache_dir = cache_dir
+        self.min_pass = min_pass
+
+        # sorted array of keys known to be safe, for each chromosome
+        self.safe_keys = {}
+
+
+    def get_chrom_filename(self, chrom):
+        return os.path.join(self.cache_dir, "%s.flips.npz" % chrom)
+
+
+    def read_chrom(self, chrom):
+        """returns arrays of keys, and number of reads that passed and
+        failed for each key, for a chromosome"""
+        filename = self.get_chrom_filename(chrom)
+        if not os.path.exists(filename):
+            return (np.array([], dtype=np.uint64),
+                    np.array([], dtype=np.uint32),
+                    np.array([], dtype=np.uint32))
+
+        data = np.load(filename)
+        return data['keys'], data['n_pass'], data['n_fail']
+
+
+    def is_safe(self, chrom, keys):
+        """returns True if all keys are known to be safe, i.e. reads
+        with each key have passed at least min_pass times and have
+        never failed"""
+        if chrom not in self.safe_keys:
+            chrom_keys, n_pass, n_fail = self.read_chrom(chrom)
+            self.safe_keys[chrom] = \
+                chrom_keys[(n_pass >= self.min_pass) & (n_fail == 0)]
+        safe_keys = self.safe_keys[chrom]
+        if safe_keys.shape[0] == 0:
+            return False
+
+        keys = np.array(keys, dtype=np.uint64)
+        idx = np.searchsorted(safe_keys, keys)
+        idx[idx == safe_keys.shape[0]] = 0
+        return bool(np.all(safe_keys[idx] == keys))
+
+
+    def update(self, results):
+        """adds results to the cache. results is a dictionary keyed on
+        chromosome, with values that are tuples of a list of keys and a
+        list of flags indicating whether the read with each key passed"""
+        util.makedirs(self.cache_dir)
+
+        lock_f = open(os.path.join(self.cache_dir,
+                                   FLIP_CACHE_LOCK_FILENAME), "w")
+        try:
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+
+            for chrom, (keys, passed) in results.items():
+                self.update_chrom(chrom, np.array(keys, dtype=np.uint64),
+                                  np.array(passed, dtype=np.bool_))
+        finally:
+            lock_f.close()
+
+
+    def update_chrom(self, chrom, keys, passed):
+        """merges results for a chromosome with those already in the
+        cache. Must be called while holding the lock"""
+        old_keys, old_pass, old_fail = self.read_chrom(chrom)
+
+        all_keys = np.concatenate([old_keys, keys])
+        all_pass = np.concatenate([old_pass, passed.astype(np.uint32)])
+        all_fail = np.concatenate([old_fail, (~passed).astype(np.uint32)])
+
+        new_keys, inv = np.unique(all_keys, return_inverse=True)
+        n_pass = np.bincount(inv, weights=all_pass,
+                             minlength=new_keys.shape[0]).astype(np.uint32)
+        n_fail = np.bincount(inv, weights=all_fail,
+                             minlength=new_keys.shape[0]).astype(np.uint32)
+
+        # write to temporary file that is renamed once complete, so
+        # that readers never see a partial file
+        fd, tmp_filename = tempfile.mkstemp(prefix=chrom + ".tmp.",
+                                            suffix=".npz",
+                                            dir=self.cache_dir)
+        f = os.fdopen(fd, "wb")
+        try:
+            np.savez(f, keys=new_keys, n_pass=n_pass, n_fail=n_fail)
+            f.close()
+            os.rename(tmp_filename, self.get_chrom_filename(chrom))
+        except:
+            f.close()
+            os.remove(tmp_filename)
+            raise
+
+        self.safe_keys.pop(chrom, None)
+
+
+
+def update_flip_cache(cache_dir, flip_keys_filename, keep_reads):
+    """records in the FlipCache in cache_dir whether each read listed
+    in flip_keys_filename passed filtering (i.e. is in keep_reads).
+    Reads that are not kept (because a flipped version mapped
+    elsewhere, or failed to map) count as failures."""
+    results = {}
+    n_read = 0
+    for name, chrom, keys in read_flip_keys(flip_keys_filename):
+        if chrom not in results:
+            results[chrom] = ([], [])
+        chrom_keys, chrom_passed = results[chrom]
+        chrom_keys.extend(keys)
+        chrom_passed.extend([name in keep_reads] * len(keys))
+        n_read += 1
+
+    sys.stderr.write("updating flip cache '%s' with %d reads\n" %
+                     (cache_dir, n_read))
+    FlipCache(cache_dir).update(results)
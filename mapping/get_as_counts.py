@@ -5,11 +5,17 @@ import pysam
 
 import util
 import snptable
+import snpcache
 
 import tables
 
 import os
 
+
+# number of reads to look up overlapping SNPs for at once
+READ_BLOCK_SIZE = 10000
+
+
 def write_results(out_f, chrom_name, snp_tab, ref_matches,
                   alt_matches, oth_matches, geno_sample):
 
@@ -45,6 +51,43 @@ def write_results(out_f, chrom_name, snp_tab, ref_matches,
                      oth_matches[i]))
 
 
+def count_block_matches(reads, snp_tab, ref_matches, alt_matches,
+                        oth_matches):
+    """Looks up the SNPs that overlap a block of reads and adds
+    counts of reads that match the reference, alternative or
+    other alleles to the provided arrays"""
+    if len(reads) == 0:
+        return
+
+    read_start, cigar_count, cigar_op, cigar_len, query_len = \
+        snptable.get_read_arrays(reads)
+
+    snp_read, snp_idx, snp_read_pos = \
+        snp_tab.get_overlapping_snps_batch(read_start, cigar_count,
+                                           cigar_op, cigar_len,
+                                           query_len)[0:3]
+
+    # concatenate read sequences so that the base at each overlapping
+    # SNP can be obtained without looping over reads
+    seq_codes = snptable.get_seq_codes("".join([read.query_sequence
+                                                for read in reads]))
+    seq_offset = np.concatenate(([0], np.cumsum(query_len)[:-1]))
+    read_codes = seq_codes[seq_offset[snp_read] + snp_read_pos - 1]
+
+    is_ref = (snp_tab.snp_code1[snp_idx] == read_codes)
+    is_alt = ~is_ref & (snp_tab.snp_code2[snp_idx] == read_codes)
+    is_oth = ~is_ref & ~is_alt
+
+    n_snp = ref_matches.shape[0]
+    ref_matches += np.bincount(snp_idx[is_ref],
+                               minlength=n_snp).astype(ref_matches.dtype)
+    alt_matches += np.bincount(snp_idx[is_alt],
+                               minlength=n_snp).astype(alt_matches.dtype)
+    oth_matches += np.bincount(snp_idx[is_oth],
+                               minlength=n_snp).astype(oth_matches.dtype)
+    
+
+
 def write_header(out_f):
     out_f.write("CHROM SNP.POS REF.ALLELE ALT.ALLELE GENOTYPE REF.COUNT "
                 "ALT.COUNT OTHER.COUNT\n")
@@ -136,7 +179,9 @@ def parse_options():
                         help="Path to HDF5 file containing SNP index. The "
                         "SNP index is used to convert the genomic position "
                         "of a SNP to its corresponding row in the haplotype "
-                        "and snp_tab HDF5 files.",
+                        "and snp_tab HDF5 files. Either a dense index or a "
+                        "compact index (written by snp2h5 "
+                        "--compact_snp_index) can be used.",
                         metavar="SNP_INDEX_H5_FILE",
                         default=None)
     
@@ -148,6 +193,15 @@ def parse_options():
                         metavar="HAPLOTYPE_H5_FILE",
                         default=None)
 
+    parser.add_argument("--snp_cache_dir", default=None,
+                        help="Directory to keep memory-mapped copies of "
+                        "the SNP tables and haplotypes read from the "
+                        "--snp_tab, --snp_index and --haplotype files. "
+                        "Each chromosome is copied once, and jobs that "
+                        "use the same directory share a single copy in "
+                        "memory. The copies are rebuilt if the HDF5 files "
+                        "change.", metavar="SNP_CACHE_DIR")
+
     parser.add_argument("--samples",
                         help="Use only haplotypes and SNPs that are "
                         "polymorphic in these samples. "
@@ -178,8 +232,12 @@ def parse_options():
                         help="Coordinate-sorted input BAM file "
                         "containing mapped reads.")
 
+    util.add_bam_threads_option(parser)
 
     options = parser.parse_args()
+
+    if options.threads < 1:
+        parser.error("--threads must be at least 1")
     
     if options.snp_dir:
         if(options.snp_tab or options.snp_index or options.haplotype):
@@ -197,11 +255,12 @@ def parse_options():
 
 def main(bam_filename, snp_dir=None, snp_tab_filename=None,
          snp_index_filename=None, haplotype_filename=None, samples=None,
-         geno_sample=None):
+         geno_sample=None, snp_cache_dir=None,
+         threads=util.BAM_THREADS_DEFAULT):
 
     out_f = sys.stdout
     
-    bam = pysam.Samfile(bam_filename)
+    bam = util.open_bam(bam_filename, threads=threads)
         
     cur_chrom = None
     cur_tid = None
@@ -210,11 +269,14 @@ def main(bam_filename, snp_dir=None, snp_tab_filename=None,
     snp_tab = snptable.SNPTable()
     read_pair_cache = {}
 
+    # block of reads to count SNP matches for
+    read_block = []
+
     # keep track of number of ref matches, non-ref matches, and other
     # for each SNP
     snp_ref_match = None
     snp_alt_match = None
-    snp_other_match = None
+    snp_oth_match = None
 
     
     if geno_sample and not haplotype_filename:
@@ -235,10 +297,23 @@ def main(bam_filename, snp_dir=None, snp_tab_filename=None,
         snp_tab_h5 = None
         snp_index_h5 = None
         hap_h5 = None
+
+    if snp_tab_h5 and snp_cache_dir:
+        snp_h5_cache = snpcache.SNPTableCache(snp_cache_dir, snp_tab_h5,
+                                              snp_index_h5, hap_h5)
+    else:
+        snp_h5_cache = None
         
     for read in bam:
+        if read.is_unmapped:
+            # unmapped reads cannot overlap SNPs
+            continue
+        
         if (cur_tid is None) or (read.tid != cur_tid):
             # this is a new chromosome
+            count_block_matches(read_block, snp_tab, snp_ref_match,
+                                snp_alt_match, snp_oth_match)
+            read_block = []
 
             if cur_chrom:
                 # write out results from last chromosome
@@ -256,7 +331,10 @@ def main(bam_filename, snp_dir=None, snp_tab_filename=None,
             sys.stderr.write("starting chromosome %s\n" % cur_chrom)
 
             # read SNPs for next chromomsome
-            if snp_tab_h5:
+            if snp_h5_cache:
+                # read SNPs from memory-mapped copy of HDF5 files
+                snp_h5_cache.read(snp_tab, cur_chrom, samples=samples)
+            elif snp_tab_h5:
                 # read SNPs from HDF5 files, reduce to set that are
                 # polymorphic in specified samples
                 snp_tab.read_h5(snp_tab_h5, snp_index_h5, hap_h5,
@@ -282,22 +360,17 @@ def main(bam_filename, snp_dir=None, snp_tab_filename=None,
             # once and this has align score that <= best score)
             continue
 
-        # loop over all SNP that overlap this read
-        snp_idx, snp_read_pos, \
-            indel_idx, indel_read_pos = snp_tab.get_overlapping_snps(read)
+        read_block.append(read)
 
-        for snp_i, read_pos in zip(snp_idx, snp_read_pos):
-            snp_pos = snp_tab.snp_pos[snp_i]
-            ref_allele = snp_tab.snp_allele1[snp_i]
-            alt_allele = snp_tab.snp_allele2[snp_i]
-            
-            if ref_allele == read.query_sequence[read_pos-1]:
-                snp_ref_match[snp_i] += 1
-            elif alt_allele == read.query_sequence[read_pos-1]:
-                snp_alt_match[snp_i] += 1
-            else:
-                snp_oth_match[snp_i] += 1
+        if len(read_block) >= READ_BLOCK_SIZE:
+            # count matches to SNPs that overlap this block of reads
+            count_block_matches(read_block, snp_tab, snp_ref_match,
+                                snp_alt_match, snp_oth_match)
+            read_block = []
 
+    count_block_matches(read_block, snp_tab, snp_ref_match,
+                        snp_alt_match, snp_oth_match)
+            
     if cur_chrom:
         # write results for final chromosome
         write_results(out_f, cur_chrom, snp_tab, snp_ref_match,
@@ -319,7 +392,9 @@ if __name__ == "__main__":
          snp_tab_filename=options.snp_tab,
          snp_index_filename=options.snp_index,
          haplotype_filename=options.haplotype,
-         samples=samples, geno_sample=options.genotype_sample)
+         samples=samples, geno_sample=options.genotype_sample,
+         snp_cache_dir=options.snp_cache_dir,
+         threads=options.threads)
     
 
     
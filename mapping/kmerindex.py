@@ -0,0 +1,360 @@
+import os
+import sys
+import shutil
+import struct
+import argparse
+import tempfile
+
+import numpy as np
+import tables
+
+import util
+import snptable
+
+
+# first bytes of a k-mer index file
+KMER_INDEX_MAGIC = "WASPKMI2"
+
+# default length of k-mers. A location that differs from a read of
+# length L at fewer than L // k bases shares at least one k-mer with
+# it, so reads whose k-mers are unique cannot align elsewhere with
+# fewer than L // k mismatches
+KMER_SIZE_DEFAULT = 25
+
+# k-mers are split into 2**bits buckets by their leading bases while
+# the index is built, and each bucket is sorted separately, so that
+# only one bucket (about 8 bytes per genome position / 2**bits) is
+# held in memory at a time
+KMER_BUCKET_BITS_DEFAULT = 6
+
+# number of genome positions to get k-mers for at a time
+KMER_CHUNK_LEN = 16 * 1024 * 1024
+
+# lookup table from ASCII value to nucleotide code that also
+# accepts lower case (soft-masked) genome sequence
+GENOME_CODE_LOOKUP = snptable.NUC_CODE_LOOKUP.copy()
+for i in range(4):
+    GENOME_CODE_LOOKUP[ord(snptable.NUCLEOTIDE_CODES[i].lower())] = i
+
+
+
+def get_kmers(codes, k):
+    """Takes 2D array of nucleotide codes (one row per sequence) and
+    returns 2D arrays of canonical k-mers (the smaller of the k-mer
+    and its reverse complement, encoded with 2 bits per base), and
+    flags indicating which k-mers do not contain Ns."""
+    n_kmer = codes.shape[1] - k + 1
+    two = np.uint64(2)
+    fwd = np.zeros((codes.shape[0], n_kmer), dtype=np.uint64)
+    rev = np.zeros((codes.shape[0], n_kmer), dtype=np.uint64)
+    n_count = np.zeros((codes.shape[0], n_kmer), dtype=np.int32)
+
+    for j in range(k):
+        c = codes[:, j:j+n_kmer]
+        is_n = c == snptable.NUC_UNDEF
+        n_count += is_n
+        c = (c & 3).astype(np.uint64)
+        fwd = (fwd << two) | c
+        # complement of base j is at position k-j-1 of reverse complement
+        rev |= (np.uint64(3) - c) << np.uint64(2*j)
+
+    return np.minimum(fwd, rev), n_count == 0
+
+
+
+def in_sorted(values, keys):
+    """returns boolean array indicating which keys are in sorted
+    array of values"""
+    if values.shape[0] == 0:
+        return np.zeros(keys.shape, dtype=np.bool_)
+    idx = np.searchsorted(values, keys)
+    idx[idx == values.shape[0]] = 0
+    return values[idx] == keys
+
+
+
+def read_seq_h5(filename):
+    """Generator that yields (name, sequence) for each chromosome
+    in a sequence HDF5 file written by fasta2h5. Sequences are
+    numpy arrays of ASCII values"""
+    h5f = tables.openFile(filename, "r")
+    for node in h5f.listNodes("/"):
+        yield node.name, node[:].view(np.uint8)
+    h5f.close()
+
+
+
+class KmerIndex(object):
+    """Records which k-mers of a reference genome are unique (present
+    once, on either strand) and which are repeated (present more than
+    once). The canonical k-mers of each kind are stored exactly, as
+    sorted arrays, so k-mers are never mistaken for present or
+    repeated when they are not. The index file takes 8 bytes per
+    distinct k-mer (about 20GB for 25-mers of a human genome), and
+    is memory-mapped.
+
+    This is used to find reads that are certain to map back to the
+    same location after their alleles are flipped, so that they do
+    not need to be remapped: if every k-mer of each flipped read that
+    overlaps an alternate allele is absent from the genome, and every
+    other k-mer is not repeated, then no other location shares a
+    k-mer with the read."""
+
+    def __init__(self, k, unique, repeated):
+        self.k = k
+        self.unique = unique
+        self.repeated = repeated
+
+
+    @classmethod
+    def read(cls, filename):
+        """reads index from file, memory-mapping the k-mer arrays so
+        that processes using the same index share a single copy"""
+        f = open(filename, "rb")
+        magic = f.read(len(KMER_INDEX_MAGIC))
+        if magic != KMER_INDEX_MAGIC:
+            raise ValueError("expected k-mer index file to start with %s" %
+                             KMER_INDEX_MAGIC)
+        k, n_unique, n_repeated = struct.unpack("<QQQ", f.read(24))
+        offset = f.tell()
+        f.close()
+
+        arrays = []
+        for n in (n_unique, n_repeated):
+            if n == 0:
+                arrays.append(np.zeros(0, dtype=np.uint64))
+            else:
+                arrays.append(np.memmap(filename, dtype=np.uint64, mode="r",
+                                        offset=offset, shape=(n,)))
+            offset += n * 8
+
+        return cls(k, arrays[0], arrays[1])
+
+
+    def is_unique(self, seqs, read_pos, ref_alleles, alt_alleles):
+        """Takes a list of sequences generated for a read (with flipped
+        alleles at the 1-based read positions provided) and returns
+        True if they can only map to the location of the read: every
+        k-mer that overlaps an alternate allele must be absent from the
+        genome, every other k-mer must not be repeated, and each
+        sequence must have fewer than seq_len // k alternate alleles.
+        ref_alleles and alt_alleles are arrays of nucleotide codes."""
+        seqs = list(seqs)
+        if len(seqs) == 0:
+            return True
+        seq_len = len(seqs[0])
+        if seq_len < self.k:
+            return False
+
+        codes = snptable.get_seq_codes("".join(seqs))
+        codes = codes.reshape((len(seqs), seq_len))
+        kmers, valid = get_kmers(codes, self.k)
+        if not np.all(valid):
+            return False
+
+        # count alternate alleles before each position, to find
+        # which k-mers overlap them
+        pos = np.array(read_pos, dtype=np.int64) - 1
+        is_alt = np.zeros((len(seqs), seq_len + 1), dtype=np.int32)
+        if pos.shape[0] > 0:
+            is_alt[:, pos + 1] = (codes[:, pos] == alt_alleles) & \
+                                 (codes[:, pos] != ref_alleles)
+        n_alt = np.cumsum(is_alt, axis=1)
+
+        # a sequence with this many alternate alleles differs from the
+        # read's own location at as many bases as it may differ from
+        # another location that shares none of its k-mers, so that
+        # location could be an equally good (or better) alignment
+        if np.any(n_alt[:, -1] >= seq_len // self.k):
+            return False
+
+        overlaps_alt = (n_alt[:, self.k:] - n_alt[:, :-self.k]) > 0
+
+        is_repeated = in_sorted(self.repeated, kmers)
+        if np.any(is_repeated):
+            return False
+        return not np.any(overlaps_alt & in_sorted(self.unique, kmers))
+
+
+
+class KmerIndexBuilder(object):
+    """Builds a KmerIndex from the sequences of a genome. The k-mers of
+    each sequence are written to temporary bucket files (8 bytes per
+    genome position) in tmp_dir, according to their leading bases.
+    write() then sorts and counts the k-mers of one bucket at a time,
+    so buckets are written to the index in sorted order."""
+
+    def __init__(self, k=KMER_SIZE_DEFAULT, tmp_dir=None,
+                 bucket_bits=KMER_BUCKET_BITS_DEFAULT):
+        self.k = k
+        self.bucket_bits = min(bucket_bits, 2*k)
+        self.n_bucket = 1 << self.bucket_bits
+
+        # number of k-mers without Ns that have been added
+        self.n_kmer = 0
+
+        self.tmp_dir = tempfile.mkdtemp(prefix="kmerindex.", dir=tmp_dir)
+        self.bucket_filenames = [os.path.join(self.tmp_dir, "%d.kmers" % i)
+                                 for i in range(self.n_bucket)]
+        self.bucket_files = [open(filename, "wb")
+                             for filename in self.bucket_filenames]
+
+
+    def add_seq(self, seq):
+        """adds k-mers of a sequence (string or array of ASCII
+        values) to the index"""
+        if isinstance(seq, str):
+            seq = np.frombuffer(seq, dtype=np.uint8)
+        codes = GENOME_CODE_LOOKUP[seq]
+        shift = np.uint64(2*self.k - self.bucket_bits)
+
+        # chunks overlap by k-1 so every k-mer is in one chunk
+        for start in range(0, max(1, codes.shape[0] - self.k + 1),
+                           KMER_CHUNK_LEN):
+            chunk = codes[start:start + KMER_CHUNK_LEN + self.k - 1]
+            if chunk.shape[0] < self.k:
+                break
+            kmers, valid = get_kmers(chunk.reshape((1, -1)), self.k)
+            kmers = kmers[valid]
+            self.n_kmer += kmers.shape[0]
+
+            buckets = (kmers >> shift).astype(np.int64)
+            order = np.argsort(buckets, kind="mergesort")
+            kmers = kmers[order]
+            ends = np.searchsorted(buckets[order],
+                                   np.arange(self.n_bucket + 1))
+            for i in range(self.n_bucket):
+                if ends[i+1] > ends[i]:
+                    kmers[ends[i]:ends[i+1]].tofile(self.bucket_files[i])
+
+
+    def write(self, filename):
+        """writes index to file, and removes temporary files. Returns
+        the number of unique and repeated k-mers"""
+        for f in self.bucket_files:
+            f.close()
+
+        f = open(filename, "wb")
+        f.write(KMER_INDEX_MAGIC)
+        f.write(struct.pack("<QQQ", self.k, 0, 0))
+
+        # unique k-mers are written straight to the index, and
+        # repeated k-mers are appended from a temporary file after them
+        repeated_filename = os.path.join(self.tmp_dir, "repeated.kmers")
+        repeated_f = open(repeated_filename, "wb")
+        n_unique = 0
+        n_repeated = 0
+        for bucket_filename in self.bucket_filenames:
+            kmers = np.fromfile(bucket_filename, dtype=np.uint64)
+            os.remove(bucket_filename)
+            if kmers.shape[0] == 0:
+                continue
+            kmers.sort()
+
+            starts = np.concatenate(([0], np.where(kmers[1:] !=
+                                                   kmers[:-1])[0] + 1))
+            counts = np.diff(np.append(starts, kmers.shape[0]))
+            kmers = kmers[starts]
+
+            unique = kmers[counts == 1]
+            unique.tofile(f)
+            n_unique += unique.shape[0]
+
+            repeated = kmers[counts > 1]
+            repeated.tofile(repeated_f)
+            n_repeated += repeated.shape[0]
+
+        repeated_f.close()
+        repeated_f = open(repeated_filename, "rb")
+        shutil.copyfileobj(repeated_f, f)
+        repeated_f.close()
+
+        f.seek(len(KMER_INDEX_MAGIC))
+        f.write(struct.pack("<QQQ", self.k, n_unique, n_repeated))
+        f.close()
+
+        self.close()
+        return n_unique, n_repeated
+
+
+    def close(self):
+        """removes temporary files"""
+        for f in self.bucket_files:
+            f.close()
+        if os.path.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+
+
+
+def main(output_filename, fasta_filename=None, seq_h5_filename=None,
+         k=KMER_SIZE_DEFAULT, tmp_dir=None,
+         bucket_bits=KMER_BUCKET_BITS_DEFAULT):
+    if k > 32:
+        raise ValueError("k-mer size cannot be greater than 32")
+
+    if tmp_dir is None:
+        tmp_dir = os.path.dirname(output_filename) or None
+    builder = KmerIndexBuilder(k, tmp_dir=tmp_dir, bucket_bits=bucket_bits)
+
+    try:
+        if seq_h5_filename:
+            seqs = read_seq_h5(seq_h5_filename)
+        else:
+            seqs = util.read_fasta(fasta_filename)
+
+        for name, seq in seqs:
+            sys.stderr.write("adding k-mers of %s\n" % name)
+            builder.add_seq(seq)
+
+        sys.stderr.write("writing k-mer index to %s\n" % output_filename)
+        n_kmer = builder.n_kmer
+        n_unique, n_repeated = builder.write(output_filename)
+    finally:
+        builder.close()
+
+    # reads can only skip remapping if all of their k-mers are at
+    # these positions, so this is an upper bound on the skip rate
+    sys.stderr.write("%d unique k-mers, %d repeated k-mers\n"
+                     "%.1f%% of genome positions have unique k-mers\n" %
+                     (n_unique, n_repeated,
+                      100.0 * n_unique / max(1, n_kmer)))
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds an index of "
+                                     "the k-mers of a reference genome that "
+                                     "find_intersecting_snps.py --kmer_index "
+                                     "uses to skip remapping reads whose "
+                                     "flipped versions can only map to the "
+                                     "same location.")
+    parser.add_argument("--fasta", default=None,
+                        help="FASTA file (optionally gzipped) containing "
+                        "reference genome")
+    parser.add_argument("--seq_h5", default=None,
+                        help="HDF5 file containing reference genome, "
+                        "written by fasta2h5")
+    parser.add_argument("--kmer_size", type=int, default=KMER_SIZE_DEFAULT,
+                        help="length of k-mers (at most 32, default=%d). "
+                        "Should be at most half the read length." %
+                        KMER_SIZE_DEFAULT)
+    parser.add_argument("--tmp_dir", default=None,
+                        help="directory for temporary files, which take "
+                        "8 bytes per genome position (default is "
+                        "directory of output file)")
+    parser.add_argument("--bucket_bits", type=int,
+                        default=KMER_BUCKET_BITS_DEFAULT,
+                        help="k-mers are sorted in 2**BUCKET_BITS "
+                        "separate buckets (default=%d). Each bucket takes "
+                        "about 8 bytes per genome position / "
+                        "2**BUCKET_BITS of memory while it is sorted." %
+                        KMER_BUCKET_BITS_DEFAULT)
+    parser.add_argument("output", help="k-mer index file to write")
+
+    options = parser.parse_args()
+    if bool(options.fasta) == bool(options.seq_h5):
+        parser.error("exactly one of --fasta or --seq_h5 must be provided")
+
+    main(options.output, fasta_filename=options.fasta,
+         seq_h5_filename=options.seq_h5, k=options.kmer_size,
+         tmp_dir=options.tmp_dir, bucket_bits=options.bucket_bits)
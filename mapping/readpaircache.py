@@ -0,0 +1,158 @@
+import os
+import heapq
+import shelve
+import shutil
+import tempfile
+
+import pysam
+
+
+# default maximum number of reads to hold in memory while waiting
+# for their mates
+READ_PAIR_CACHE_SIZE = 1000000
+
+
+class ReadPairCache(object):
+    """Holds reads that are waiting for their mates, keyed on read
+    name. Reads must be added in order of position (i.e. from a
+    coordinate-sorted BAM). The cache keeps a heap of the positions
+    of the mates it is waiting for, so that reads whose mate should
+    already have been seen can be evicted (see evict). When more
+    than max_size reads are held in memory, additional reads are
+    spilled (as SAM text) to an on-disk store in tmp_dir."""
+
+    def __init__(self, header, max_size=READ_PAIR_CACHE_SIZE, tmp_dir=None):
+        # header of BAM file that reads are from, needed to
+        # re-create reads that were spilled to disk
+        self.header = header
+        self.max_size = max_size
+        self.tmp_dir = tmp_dir
+
+        # reads held in memory, keyed on read name
+        self.reads = {}
+
+        # heap of (mate start, read name) for reads in the cache. Entries
+        # for reads that have already been retrieved (or replaced by a
+        # later read with the same name) are removed lazily
+        self.heap = []
+
+        # on-disk store for reads spilled from memory, and directory
+        # that it is written to. These are created on first spill
+        self.spill = None
+        self.spill_dir = None
+        self.n_spill = 0
+
+        # peak number of reads in cache, number of reads evicted
+        # because mate was not found, number of reads spilled to disk
+        self.peak_size = 0
+        self.n_evict = 0
+        self.n_spill_total = 0
+
+
+    def __len__(self):
+        return len(self.reads) + self.n_spill
+
+
+    def __contains__(self, name):
+        if name in self.reads:
+            return True
+        return self.n_spill > 0 and name in self.spill
+
+
+    def add(self, read):
+        """adds read to the cache, where it waits for its mate"""
+        name = read.query_name
+        heapq.heappush(self.heap, (read.next_reference_start, name))
+
+        if self.n_spill > 0 and name in self.spill:
+            # replace spilled read that has same name
+            self.spill[name] = read.to_string()
+        elif (len(self.reads) < self.max_size) or (name in self.reads):
+            self.reads[name] = read
+        else:
+            # memory cap has been reached, write read to disk
+            self.get_spill()[name] = read.to_string()
+            self.n_spill += 1
+            self.n_spill_total += 1
+
+        self.peak_size = max(self.peak_size, len(self))
+
+
+    def pop(self, name):
+        """removes read with this name from the cache and returns it,
+        or returns None if there is no read with this name"""
+        if name in self.reads:
+            return self.reads.pop(name)
+
+        if self.n_spill > 0 and name in self.spill:
+            sam_str = self.spill[name]
+            del self.spill[name]
+            self.n_spill -= 1
+            return pysam.AlignedSegment.fromstring(sam_str, self.header)
+
+        return None
+
+
+    def get_mate_start(self, name):
+        """returns mate start of read with this name in the cache,
+        or None if there is no read with this name"""
+        if name in self.reads:
+            return self.reads[name].next_reference_start
+
+        if self.n_spill > 0 and name in self.spill:
+            read = pysam.AlignedSegment.fromstring(self.spill[name],
+                                                   self.header)
+            return read.next_reference_start
+
+        return None
+
+
+    def evict(self, pos):
+        """removes reads with mates that start before pos (0-based),
+        since their mates should already have been seen. Returns a
+        list of the names of the reads that were evicted."""
+        evicted = []
+        heap = self.heap
+        while heap and heap[0][0] < pos:
+            mate_start, name = heapq.heappop(heap)
+            # entry is stale if read was retrieved, and a later read
+            # with the same name (and a different mate) was added
+            if self.get_mate_start(name) != mate_start:
+                continue
+            if self.pop(name) is not None:
+                evicted.append(name)
+
+        self.n_evict += len(evicted)
+        return evicted
+
+
+    def clear(self):
+        """removes all reads from the cache (e.g. at end of a
+        chromosome). Returns the number of reads that were removed"""
+        n_read = len(self)
+        self.reads = {}
+        self.heap = []
+        self.close()
+        return n_read
+
+
+    def get_spill(self):
+        """returns on-disk store for spilled reads, creating
+        it if it does not exist yet"""
+        if self.spill is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="read_pair_cache.",
+                                              dir=self.tmp_dir)
+            self.spill = shelve.open(os.path.join(self.spill_dir, "reads"),
+                                     "n")
+            self.n_spill = 0
+        return self.spill
+
+
+    def close(self):
+        """closes and deletes on-disk store, if there is one"""
+        if self.spill is not None:
+            self.spill.close()
+            shutil.rmtree(self.spill_dir)
+            self.spill = None
+            self.spill_dir = None
+            self.n_spill = 0
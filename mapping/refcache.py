@@ -0,0 +1,115 @@
+import os
+import sys
+import hashlib
+import tempfile
+
+import util
+
+
+# format of paths to reference sequences in a cache directory, as
+# used by htslib (and samtools seq_cache_populate.pl). Each sequence
+# is stored in a file named by the MD5 of the sequence, split into
+# two levels of subdirectories
+REF_CACHE_PATH_FORMAT = "%2s/%2s/%s"
+
+
+
+def get_ref_path(cache_dir):
+    """returns value for htslib REF_PATH and REF_CACHE environment
+    variables that looks up sequences in cache_dir"""
+    return os.path.join(os.path.abspath(cache_dir), REF_CACHE_PATH_FORMAT)
+
+
+
+def get_seq_md5(seq):
+    """returns MD5 of a reference sequence, as given by the M5 tag of
+    the @SQ header lines of CRAM files"""
+    return hashlib.md5(seq.upper()).hexdigest()
+
+
+
+def get_seq_filename(cache_dir, md5):
+    return os.path.join(cache_dir, md5[0:2], md5[2:4], md5[4:])
+
+
+
+def get_populated_filename(cache_dir, fasta_filename):
+    """returns name of file that marks that cache_dir contains the
+    sequences of a FASTA file, named by a hash of the absolute path,
+    size and modification time of the FASTA file"""
+    st = os.stat(fasta_filename)
+    md5 = hashlib.md5()
+    md5.update("%s\t%d\t%r\n" % (os.path.abspath(fasta_filename),
+                                 st.st_size, st.st_mtime))
+    return os.path.join(cache_dir, ".populated." + md5.hexdigest())
+
+
+
+def populate_ref_cache(fasta_filename, cache_dir):
+    """Writes each sequence of a (possibly gzipped) FASTA file to
+    the reference cache directory, in upper case without line breaks.
+    Nothing is done if the cache was already populated from the same
+    FASTA file."""
+    populated_filename = get_populated_filename(cache_dir, fasta_filename)
+    if os.path.exists(populated_filename):
+        return
+
+    sys.stderr.write("adding sequences of '%s' to reference cache '%s'\n" %
+                     (fasta_filename, cache_dir))
+    for name, seq in util.read_fasta(fasta_filename):
+        seq = seq.upper()
+        seq_filename = get_seq_filename(cache_dir, get_seq_md5(seq))
+        if os.path.exists(seq_filename):
+            continue
+
+        seq_dir = os.path.dirname(seq_filename)
+        util.makedirs(seq_dir)
+
+        # write to temporary file that is renamed once complete,
+        # so that other processes never read a partial sequence
+        fd, tmp_filename = tempfile.mkstemp(prefix=".tmp.", dir=seq_dir)
+        f = os.fdopen(fd, "wb")
+        try:
+            f.write(seq)
+            f.close()
+            os.rename(tmp_filename, seq_filename)
+        except:
+            f.close()
+            os.remove(tmp_filename)
+            raise
+
+    f = open(populated_filename, "w")
+    f.close()
+
+
+
+def use_ref_cache(cache_dir, fasta_filename=None):
+    """Sets the htslib REF_PATH and REF_CACHE environment variables so
+    that the reference sequences of CRAM files are only looked up in
+    cache_dir, and never downloaded from the network. If a FASTA file
+    is provided, the cache is first populated with its sequences.
+    Child processes inherit these settings."""
+    util.makedirs(cache_dir)
+    if fasta_filename:
+        populate_ref_cache(fasta_filename, cache_dir)
+
+    ref_path = get_ref_path(cache_dir)
+    os.environ["REF_PATH"] = ref_path
+    os.environ["REF_CACHE"] = ref_path
+
+
+
+def add_reference_options(parser):
+    """adds --reference and --ref_cache options, used to read and
+    write CRAM files, to an argparse parser"""
+    parser.add_argument("--reference", default=None, metavar="FASTA",
+                        help="Reference genome FASTA file, used to read "
+                        "and write CRAM files (files with names ending in "
+                        ".cram).")
+    parser.add_argument("--ref_cache", default=None, metavar="REF_CACHE_DIR",
+                        help="Directory of reference sequences keyed on "
+                        "their MD5 (as used by htslib). Reference sequences "
+                        "of CRAM files are only looked up in this "
+                        "directory, so they are never downloaded from the "
+                        "network. If --reference is also given, its "
+                        "sequences are added to the directory.")
@@ -0,0 +1,82 @@
+import gzip
+import collections
+
+
+# number of distinct remapped reads (or read pairs) to remember
+# when looking for duplicates. Duplicates usually start at the same
+# position, so are processed close together
+REMAP_DEDUP_CACHE_SIZE = 10000
+
+
+
+class RemapDedup(object):
+    """Finds reads that need remapping that are duplicates of an
+    earlier read, because they would be remapped with the same set
+    of sequences at the same position (e.g. PCR or optical duplicates).
+    Only the first (canonical) read of each such set needs to have its
+    sequences written for remapping. The names of the duplicates and
+    of their canonical reads are written to a gzipped text file, with
+    a tab-delimited line per duplicate. filter_remapped_reads.py uses
+    this file to give each duplicate the same result as its canonical
+    read."""
+
+    def __init__(self, filename, max_size=REMAP_DEDUP_CACHE_SIZE):
+        self.filename = filename
+        self.max_size = max_size
+
+        # least-recently-used cache giving name of canonical
+        # read for each key
+        self.cache = collections.OrderedDict()
+        self.n_dup = 0
+
+        self.f = gzip.open(filename, "wb")
+
+
+    def is_duplicate(self, name, key):
+        """returns True if an earlier read had the same key, in which
+        case this read is recorded as a duplicate of it. Otherwise the
+        read is remembered as the canonical read for this key and
+        False is returned. key should be made from the sequences that
+        are remapped and the position they are expected to map to."""
+        if key in self.cache:
+            canonical_name = self.cache.pop(key)
+            self.cache[key] = canonical_name
+
+            self.f.write("%s\t%s\n" % (name, canonical_name))
+            self.n_dup += 1
+            return True
+
+        self.cache[key] = name
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+        return False
+
+
+    def close(self):
+        self.f.close()
+        self.cache = collections.OrderedDict()
+
+
+
+def read_dups(filename):
+    """reads file written by RemapDedup, returns dictionary giving
+    name of canonical read for each duplicate"""
+    dups = {}
+    f = gzip.open(filename, "rb")
+    for line in f:
+        dup_name, canonical_name = line.rstrip("\n").split("\t")
+        dups[dup_name] = canonical_name
+    f.close()
+    return dups
+
+
+
+def apply_dups(dups, keep_reads, bad_reads):
+    """adds duplicate reads to the sets of reads to keep and bad reads
+    if their canonical reads are in these sets"""
+    for dup_name, canonical_name in dups.items():
+        if canonical_name in bad_reads:
+            bad_reads.add(dup_name)
+        elif canonical_name in keep_reads:
+            keep_reads.add(dup_name)
@@ -0,0 +1,113 @@
+import os
+import struct
+import hashlib
+
+import numpy as np
+
+
+# first bytes of a remap index file
+REMAP_INDEX_MAGIC = "WASPRMI1"
+
+# each record is the BGZF virtual offset of a read in the input BAM
+# file, and a hash of the read name
+RECORD_DTYPE = np.dtype([('offset', '<u8'), ('name_hash', '<u8')])
+
+# number of records to buffer before writing them
+RECORD_BUFFER_SIZE = 100000
+
+
+def name_hash(name):
+    """returns 64-bit hash of a read name"""
+    return struct.unpack("<Q", hashlib.md5(name).digest()[:8])[0]
+
+
+
+def is_remap_index(filename):
+    """returns True if file is a remap index (rather than a BAM file)"""
+    f = open(filename, "rb")
+    magic = f.read(len(REMAP_INDEX_MAGIC))
+    f.close()
+    return magic == REMAP_INDEX_MAGIC
+
+
+
+def read_header(f):
+    """reads header from open remap index file, returns name of
+    BAM file that offsets point into"""
+    magic = f.read(len(REMAP_INDEX_MAGIC))
+    if magic != REMAP_INDEX_MAGIC:
+        raise ValueError("expected remap index file to start with %s" %
+                         REMAP_INDEX_MAGIC)
+    (name_len,) = struct.unpack("<I", f.read(4))
+    return f.read(name_len)
+
+
+
+def read_remap_index(filename):
+    """returns name of BAM file that offsets point into, and
+    array of (offset, name_hash) records, in the order that
+    reads were written"""
+    f = open(filename, "rb")
+    bam_filename = read_header(f)
+    records = np.fromfile(f, dtype=RECORD_DTYPE)
+    f.close()
+    return bam_filename, records
+
+
+
+class RemapIndexWriter(object):
+    """Writes a compact sidecar file that replaces the to.remap BAM
+    file. Rather than copying reads that need remapping, it stores
+    the virtual offset of each read in the input BAM file (from
+    which the read can be retrieved with seek), and a hash of its
+    name. Has the same write method as a pysam BAM file, but the
+    offset of each read must first be registered with set_offset,
+    as it cannot be obtained from the read itself."""
+
+    def __init__(self, filename, bam_filename):
+        self.filename = filename
+        self.bam_filename = os.path.abspath(bam_filename)
+
+        # offsets of reads that may be written, keyed on
+        # read name and flag (so that ends of pairs differ)
+        self.offsets = {}
+
+        self.buf = []
+
+        self.f = open(filename, "wb")
+        self.f.write(REMAP_INDEX_MAGIC)
+        self.f.write(struct.pack("<I", len(self.bam_filename)))
+        self.f.write(self.bam_filename)
+
+
+    def set_offset(self, read, offset):
+        """records virtual offset of read in input BAM file"""
+        self.offsets[(read.query_name, read.flag)] = offset
+
+
+    def discard_offsets(self, reads):
+        """forgets offsets of reads (once they have been processed)"""
+        for read in reads:
+            self.offsets.pop((read.query_name, read.flag), None)
+
+
+    def write(self, read):
+        """adds record for read, which must have had its offset set"""
+        name = read.query_name
+        self.buf.append((self.offsets[(name, read.flag)], name_hash(name)))
+
+        if len(self.buf) >= RECORD_BUFFER_SIZE:
+            self.flush()
+
+
+    def flush(self):
+        """writes buffered records to file"""
+        if self.buf:
+            np.array(self.buf, dtype=RECORD_DTYPE).tofile(self.f)
+            self.buf = []
+
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        self.offsets = {}
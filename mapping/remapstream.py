@@ -0,0 +1,249 @@
+import os
+import sys
+import time
+import errno
+import fcntl
+import pipes
+import shutil
+import tempfile
+import threading
+import subprocess
+import collections
+import multiprocessing.pool
+
+import pysam
+
+import filter_remapped_reads
+
+
+# placeholders in the aligner command that are replaced with the
+# paths of the named pipes that fastq records are written to
+FASTQ_PLACEHOLDER = "{fastq}"
+FASTQ1_PLACEHOLDER = "{fastq1}"
+FASTQ2_PLACEHOLDER = "{fastq2}"
+
+# number of fastq records to buffer before writing them to a pipe.
+# Blocks are counted in records rather than bytes so that the two
+# pipes of a read pair are always flushed at the same records,
+# otherwise the aligner could wait on one pipe while we wait on the other
+PIPE_BLOCK_RECORDS = 10000
+
+# maximum number of blocks waiting to be written to each pipe
+PIPE_MAX_PENDING = 4
+
+# seconds to wait between attempts to open a pipe before the
+# aligner has opened it for reading
+PIPE_OPEN_WAIT = 0.05
+
+
+
+class FastqPipe(object):
+    """Writes fastq records to a named pipe that is read by an aligner.
+    Records are buffered into blocks, which are written to the pipe
+    by a separate thread so that the caller does not block while the
+    aligner is busy. Has the same write / close interface as
+    fastqwriter.FastqWriter."""
+
+    def __init__(self, path, proc, block_records=PIPE_BLOCK_RECORDS):
+        self.path = path
+        self.proc = proc
+        self.block_records = block_records
+        self.f = None
+
+        # records that have not been written yet
+        self.buf = []
+
+        # blocks that are being written by the thread, in order
+        self.pending = collections.deque()
+        self.pool = multiprocessing.pool.ThreadPool(1)
+
+
+    def open_pipe(self):
+        """opens the pipe for writing, once the aligner has opened it
+        for reading. Raises an IOError if the aligner exits first"""
+        while True:
+            try:
+                fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+            # pipe has not been opened for reading yet
+            if self.proc.poll() is not None:
+                raise IOError("aligner exited before reading from %s" %
+                              self.path)
+            time.sleep(PIPE_OPEN_WAIT)
+
+        # writes should block when pipe is full
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+        self.f = os.fdopen(fd, "wb")
+
+
+    def write_block(self, data):
+        """writes block of records to the pipe (called by thread)"""
+        if self.f is None:
+            self.open_pipe()
+        if data:
+            self.f.write(data)
+
+
+    def close_pipe(self):
+        """closes the pipe so the aligner sees end of file (called
+        by thread). The pipe is opened first if nothing was written,
+        otherwise the aligner would wait for it forever"""
+        if self.f is None:
+            self.open_pipe()
+        self.f.close()
+
+
+    def write(self, record):
+        """adds record (or other string) to the pipe"""
+        self.buf.append(record)
+
+        if len(self.buf) >= self.block_records:
+            self.flush_block()
+
+
+    def flush_block(self):
+        """passes buffered records to the thread to be written"""
+        if len(self.buf) == 0:
+            return
+
+        data = "".join(self.buf)
+        self.buf = []
+        self.pending.append(self.pool.apply_async(self.write_block, (data,)))
+
+        # wait for writes once too many blocks are waiting. This
+        # also raises any error from the thread
+        while len(self.pending) > PIPE_MAX_PENDING:
+            self.pending.popleft().get()
+
+
+    def close(self):
+        """writes remaining records, waits for them to be written
+        and closes the pipe"""
+        self.flush_block()
+        self.pending.append(self.pool.apply_async(self.close_pipe))
+
+        try:
+            while self.pending:
+                self.pending.popleft().get()
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+
+
+class RemapStream(object):
+    """Runs an aligner command as a subprocess and streams fastq
+    records for remapping to it through named pipes. The SAM or BAM
+    output that the aligner writes to stdout is read by a separate
+    thread, which runs filter_remapped_reads.filter_reads on it while
+    records are still being written. No intermediate fastq or BAM
+    files are written.
+
+    The command is run by the shell. For single-end reads it must
+    contain {fastq}, for paired-end reads {fastq1} and {fastq2}. These
+    are replaced by paths to the pipes, which can be read like
+    uncompressed fastq files. For example:
+
+        bowtie2 -x index -1 {fastq1} -2 {fastq2} | samtools view -b -q 10 -
+    """
+
+    def __init__(self, command, is_paired, tmp_dir=None):
+        self.is_paired = is_paired
+
+        if is_paired:
+            placeholders = [FASTQ1_PLACEHOLDER, FASTQ2_PLACEHOLDER]
+        else:
+            placeholders = [FASTQ_PLACEHOLDER]
+
+        for placeholder in placeholders:
+            if placeholder not in command:
+                raise ValueError("expected aligner command to contain %s "
+                                 "but got: %s" % (placeholder, command))
+
+        # directory containing named pipes
+        self.pipe_dir = tempfile.mkdtemp(prefix="remap_pipes.", dir=tmp_dir)
+
+        pipe_paths = []
+        for placeholder in placeholders:
+            path = os.path.join(self.pipe_dir,
+                                placeholder.strip("{}") + ".fq")
+            os.mkfifo(path)
+            command = command.replace(placeholder, pipes.quote(path))
+            pipe_paths.append(path)
+
+        self.command = command
+        sys.stderr.write("running aligner command: %s\n" % self.command)
+        self.proc = subprocess.Popen(self.command, shell=True,
+                                     stdout=subprocess.PIPE)
+
+        self.fastq1 = None
+        self.fastq2 = None
+        self.fastq_single = None
+
+        if is_paired:
+            self.fastq1 = FastqPipe(pipe_paths[0], self.proc)
+            self.fastq2 = FastqPipe(pipe_paths[1], self.proc)
+        else:
+            self.fastq_single = FastqPipe(pipe_paths[0], self.proc)
+
+        # result of filtering remapped reads, or exception raised
+        # while filtering them
+        self.keep_reads = None
+        self.bad_reads = None
+        self.error = None
+
+        self.thread = threading.Thread(target=self.filter_remapped)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def filter_remapped(self):
+        """reads remapped reads from aligner stdout and records which
+        original reads should be kept (run by thread)"""
+        try:
+            remap_bam = pysam.Samfile(self.proc.stdout, "r")
+            self.keep_reads, self.bad_reads = \
+                filter_remapped_reads.filter_reads(remap_bam)
+            remap_bam.close()
+        except Exception as e:
+            self.error = e
+            # stop aligner, otherwise it would block writing output
+            # that nothing is reading
+            if self.proc.poll() is None:
+                self.proc.kill()
+
+
+    def finish(self):
+        """waits for the aligner to finish and for its output to be
+        filtered. The fastq pipes must already be closed. Returns
+        the sets of names of reads to keep and of bad reads (as
+        returned by filter_remapped_reads.filter_reads)"""
+        self.thread.join()
+        ret = self.proc.wait()
+        self.cleanup()
+
+        if self.error is not None:
+            raise self.error
+        if ret != 0:
+            raise IOError("aligner command exited with status %d: %s" %
+                          (ret, self.command))
+
+        return self.keep_reads, self.bad_reads
+
+
+    def kill(self):
+        """stops the aligner (e.g. after an error) and removes pipes"""
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        self.cleanup()
+
+
+    def cleanup(self):
+        """removes directory containing named pipes"""
+        if os.path.exists(self.pipe_dir):
+            shutil.rmtree(self.pipe_dir)
@@ -4,26 +4,43 @@ import os
 import sys
 import argparse
 
+import util
+import refcache
+
 parser = argparse.ArgumentParser()
-parser.add_argument('input_bam', help="input BAM or SAM file (must be sorted!)")
-parser.add_argument("output_bam", help="output BAM or SAM file")
+parser.add_argument('input_bam', help="input BAM, CRAM or SAM file "
+                    "(must be sorted!)")
+parser.add_argument("output_bam", help="output BAM, CRAM or SAM file")
+util.add_bam_threads_option(parser)
+refcache.add_reference_options(parser)
 
 options = parser.parse_args()
+if options.threads < 1:
+    parser.error("--threads must be at least 1")
+if util.is_cram(options.output_bam) and not options.reference:
+    parser.error("--reference is needed to write CRAM file")
+
+if options.ref_cache:
+    refcache.use_ref_cache(options.ref_cache, options.reference)
 
 if options.input_bam.endswith(".sam") or options.input_bam.endswith("sam.gz"):
-    infile = pysam.Samfile(options.input_bam, "r")
+    infile = util.open_bam(options.input_bam, "r", threads=options.threads)
 else:
-    # assume binary BAM file
-    infile = pysam.Samfile(options.input_bam, "rb")
+    # assume binary BAM (or CRAM) file
+    infile = util.open_bam(options.input_bam, "rb", threads=options.threads,
+                           reference=options.reference)
 
 if options.output_bam.endswith(".sam"):
     # output in text SAM format
-    outfile = pysam.Samfile(options.output_bam, "w", template=infile)
-elif options.output_bam.endswith(".bam"):
-    # output in binary compressed BAM format
-    outfile = pysam.Samfile(options.output_bam, "wb", template=infile)
+    outfile = util.open_bam(options.output_bam, "w", template=infile,
+                            threads=options.threads)
+elif options.output_bam.endswith(".bam") or util.is_cram(options.output_bam):
+    # output in binary compressed BAM (or CRAM) format
+    outfile = util.open_bam(options.output_bam, "wb", template=infile,
+                            threads=options.threads,
+                            reference=options.reference)
 else:
-    raise ValueError("name of output file must end with .bam or .sam")
+    raise ValueError("name of output file must end with .bam, .cram or .sam")
 
 
 chr=""
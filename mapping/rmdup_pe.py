@@ -5,6 +5,7 @@ import sys
 import argparse
 
 import util
+import refcache
 
 
 class ReadStats(object):
@@ -65,21 +66,29 @@ class ReadStats(object):
                 
 
 
-def main(input_bam, output_bam):
+def main(input_bam, output_bam, threads=util.BAM_THREADS_DEFAULT,
+         reference=None, ref_cache_dir=None):
+    if ref_cache_dir:
+        refcache.use_ref_cache(ref_cache_dir, reference)
+
     if input_bam.endswith(".sam") or input_bam.endswith("sam.gz"):
-        infile = pysam.Samfile(input_bam, "r")
+        infile = util.open_bam(input_bam, "r", threads=threads)
     else:
-        # assume binary BAM file
-        infile = pysam.Samfile(input_bam, "rb")
+        # assume binary BAM (or CRAM) file
+        infile = util.open_bam(input_bam, "rb", threads=threads,
+                               reference=reference)
 
     if output_bam.endswith(".sam"):
         # output in text SAM format
-        outfile = pysam.Samfile(output_bam, "w", template=infile)
-    elif output_bam.endswith(".bam"):
-        # output in binary compressed BAM format
-        outfile = pysam.Samfile(output_bam, "wb", template=infile)
+        outfile = util.open_bam(output_bam, "w", template=infile,
+                                threads=threads)
+    elif output_bam.endswith(".bam") or util.is_cram(output_bam):
+        # output in binary compressed BAM (or CRAM) format
+        outfile = util.open_bam(output_bam, "wb", template=infile,
+                                threads=threads, reference=reference)
     else:
-        raise ValueError("name of output file must end with .bam or .sam")
+        raise ValueError("name of output file must end with .bam, "
+                         ".cram or .sam")
 
     filter_reads(infile, outfile)
 
@@ -281,9 +290,16 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('input_bam', help="input BAM or SAM file (must "
                         "be sorted!)")
-    parser.add_argument("output_bam", help="output BAM or SAM file (not "
-                        "sorted!)")
+    parser.add_argument("output_bam", help="output BAM, CRAM or SAM file "
+                        "(not sorted!)")
+    util.add_bam_threads_option(parser)
+    refcache.add_reference_options(parser)
     
     options = parser.parse_args()
+    if options.threads < 1:
+        parser.error("--threads must be at least 1")
+    if util.is_cram(options.output_bam) and not options.reference:
+        parser.error("--reference is needed to write CRAM file")
     
-    main(options.input_bam, options.output_bam)
+    main(options.input_bam, options.output_bam, threads=options.threads,
+         reference=options.reference, ref_cache_dir=options.ref_cache)
@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import fcntl
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+
+import util
+import snptable
+
+
+# version of the cache format. Cache directories are keyed on this,
+# so it should be incremented if the contents of the cache change
+SNP_CACHE_VERSION = 1
+
+# SNPTable arrays that are stored in the cache, each as a .npy file
+SNP_TABLE_ARRAYS = ["snp_pos", "snp_allele1", "snp_allele2",
+                    "snp_code1", "snp_code2", "snp_is_indel"]
+
+# name of file in each chromosome directory that holds the
+# values that are not arrays
+META_FILENAME = "meta.json"
+
+
+
+def get_source_key(filenames):
+    """returns a hash that identifies the HDF5 files a cache is built
+    from, using their absolute paths, sizes and modification times.
+    A cache built from files that have since changed therefore has
+    a different key and is not used."""
+    md5 = hashlib.md5()
+    md5.update("version=%d\n" % SNP_CACHE_VERSION)
+    for filename in filenames:
+        st = os.stat(filename)
+        md5.update("%s\t%d\t%r\n" % (os.path.abspath(filename),
+                                     st.st_size, st.st_mtime))
+    return md5.hexdigest()
+
+
+
+def get_samples_key(samples):
+    """returns a hash that identifies a set of samples (the order
+    of samples does not matter)"""
+    md5 = hashlib.md5()
+    md5.update("\n".join(sorted(set(samples))))
+    return md5.hexdigest()
+
+
+
+class SNPTableCache(object):
+    """On-disk copy of the SNPTable for each chromosome, built from
+    snp_tab, snp_index and haplotype HDF5 files. The arrays of each
+    chromosome are written once as .npy files, and are then read
+    with np.load(mmap_mode='r'). Processes that read the same
+    chromosome therefore share a single copy of its arrays through
+    the OS page cache, rather than each holding its own copy.
+
+    Caches are kept in a subdirectory of cache_dir named by a hash
+    of the HDF5 files (see get_source_key). When a set of samples is
+    provided, only the SNPs that are polymorphic in these samples and
+    their haplotypes are cached, in a further subdirectory named by a
+    hash of the sample names, so that all BAM files from the same
+    cohort reuse the same filtered tables. If several processes
+    need a chromosome that is not in the cache yet, a lock file
+    ensures that only one of them builds it."""
+
+    def __init__(self, cache_dir, snp_tab_h5, snp_index_h5, hap_h5):
+        self.snp_tab_h5 = snp_tab_h5
+        self.snp_index_h5 = snp_index_h5
+        self.hap_h5 = hap_h5
+
+        key = get_source_key([snp_tab_h5.filename, snp_index_h5.filename,
+                              hap_h5.filename])
+        self.cache_dir = os.path.join(cache_dir, key)
+
+
+    def get_chrom_dir(self, chrom_name, samples=None):
+        if samples:
+            return os.path.join(self.cache_dir,
+                                "samples_" + get_samples_key(samples),
+                                chrom_name)
+        return os.path.join(self.cache_dir, chrom_name)
+
+
+    def read(self, snp_tab, chrom_name, samples=None):
+        """reads SNPs and haplotypes for a chromosome into snp_tab,
+        building the cache for the chromosome first if needed. If
+        samples are provided, SNPs are reduced to those that are
+        polymorphic in these samples (as by SNPTable.read_h5).
+        The arrays of snp_tab are read-only."""
+        chrom_dir = self.get_chrom_dir(chrom_name, samples)
+        try:
+            if not os.path.exists(chrom_dir):
+                self.build(chrom_name, samples)
+        except (IOError, OSError) as e:
+            sys.stderr.write("WARNING: unable to write SNP cache for "
+                             "chromosome %s to '%s': %s\n" %
+                             (chrom_name, self.cache_dir, str(e)))
+            snp_tab.read_h5(self.snp_tab_h5, self.snp_index_h5,
+                            self.hap_h5, chrom_name, samples=samples)
+            return
+
+        self.load(snp_tab, chrom_dir)
+
+
+    def build(self, chrom_name, samples=None):
+        """reads SNPs for chromosome from HDF5 files and writes them to
+        the cache. The files are written to a temporary directory that
+        is renamed once they are complete, so other processes never see
+        a partial cache."""
+        chrom_dir = self.get_chrom_dir(chrom_name, samples)
+        parent_dir = os.path.dirname(chrom_dir)
+        util.makedirs(parent_dir)
+
+        lock_f = open(chrom_dir + ".lock", "w")
+        try:
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+
+            if os.path.exists(chrom_dir):
+                # another process built cache while we waited for lock
+                return
+
+            sys.stderr.write("building SNP cache for chromosome %s in "
+                             "'%s'\n" % (chrom_name, self.cache_dir))
+            snp_tab = snptable.SNPTable()
+            snp_tab.read_h5(self.snp_tab_h5, self.snp_index_h5,
+                            self.hap_h5, chrom_name, samples=samples)
+
+            tmp_dir = tempfile.mkdtemp(prefix=chrom_name + ".tmp.",
+                                       dir=parent_dir)
+            try:
+                self.write(snp_tab, tmp_dir)
+                os.rename(tmp_dir, chrom_dir)
+            except:
+                shutil.rmtree(tmp_dir)
+                raise
+        finally:
+            lock_f.close()
+
+
+    def write(self, snp_tab, chrom_dir):
+        """writes arrays of snp_tab to .npy files in chrom_dir"""
+        for name in SNP_TABLE_ARRAYS:
+            np.save(os.path.join(chrom_dir, name + ".npy"),
+                    getattr(snp_tab, name))
+        np.save(os.path.join(chrom_dir, "index_pos.npy"), snp_tab.index.pos)
+        np.save(os.path.join(chrom_dir, "index_idx.npy"), snp_tab.index.idx)
+
+        if snp_tab.haplotypes is None:
+            n_hap = None
+        else:
+            n_hap = snp_tab.haplotypes.n_hap
+            np.save(os.path.join(chrom_dir, "haplotypes.npy"),
+                    snp_tab.haplotypes.packed)
+
+        meta = {'version' : SNP_CACHE_VERSION,
+                'index_length' : len(snp_tab.index),
+                'n_hap' : n_hap,
+                'samples' : list(snp_tab.samples)}
+        f = open(os.path.join(chrom_dir, META_FILENAME), "w")
+        json.dump(meta, f)
+        f.close()
+
+
+    def load(self, snp_tab, chrom_dir):
+        """sets arrays of snp_tab to memory-mapped arrays from chrom_dir"""
+        f = open(os.path.join(chrom_dir, META_FILENAME))
+        meta = json.load(f)
+        f.close()
+
+        def load_array(name):
+            return np.load(os.path.join(chrom_dir, name + ".npy"),
+                           mmap_mode="r")
+
+        for name in SNP_TABLE_ARRAYS:
+            setattr(snp_tab, name, load_array(name))
+        snp_tab.index = snptable.SNPIndex(load_array("index_pos"),
+                                          load_array("index_idx"),
+                                          meta['index_length'])
+
+        if meta['n_hap'] is None:
+            snp_tab.haplotypes = None
+        else:
+            snp_tab.haplotypes = snptable.PackedHaplotypes()
+            snp_tab.haplotypes.n_hap = meta['n_hap']
+            snp_tab.haplotypes.packed = load_array("haplotypes")
+
+        snp_tab.n_snp = snp_tab.snp_pos.shape[0]
+        snp_tab.samples = [str(s) for s in meta['samples']]
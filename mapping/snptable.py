@@ -1,4 +1,5 @@
 import sys
+import os
 import numpy as np
 import gzip
 import pysam
@@ -10,6 +11,50 @@ import util
 NUCLEOTIDES = set(['A', 'C', 'T', 'G'])
 SNP_UNDEF = -1
 
+# alleles and read bases are encoded as small integers, using the
+# index of the nucleotide in this string. Anything that is not
+# a single A, C, G or T is given the code for N
+NUCLEOTIDE_CODES = "ACGTN"
+NUC_UNDEF = 4
+
+# lookup table from ASCII value to nucleotide code
+NUC_CODE_LOOKUP = np.empty(256, dtype=np.uint8)
+NUC_CODE_LOOKUP[:] = NUC_UNDEF
+for i in range(len(NUCLEOTIDE_CODES)):
+    NUC_CODE_LOOKUP[ord(NUCLEOTIDE_CODES[i])] = i
+
+# ASCII value of nucleotide for each code
+NUC_ASCII = bytearray(NUCLEOTIDE_CODES.encode("ascii"))
+
+# approximate number of bytes of haplotypes to read from HDF5
+# file at a time
+HAPLOTYPE_CHUNK_BYTES = 32 * 1024 * 1024
+
+# number of elements of dense (per-base) SNP index to read from HDF5
+# file at a time
+SNP_INDEX_CHUNK_LEN = 4 * 1024 * 1024
+
+# SNP index keeps a bitset flagging which blocks of the chromosome
+# contain SNPs, so that most reads that do not overlap SNPs can be
+# rejected without looking at their alignment. Blocks are 
+# 2**SNP_BLOCK_SHIFT (64) bp. Reads spanning more than
+# SNP_BLOCK_MAX_SPAN blocks (e.g. spliced reads) are not checked
+# against the bitset.
+SNP_BLOCK_SHIFT = 6
+SNP_BLOCK_MAX_SPAN = 8
+
+
+# approximate number of bytes of SNP text file to parse at a time
+SNP_FILE_CHUNK_BYTES = 16 * 1024 * 1024
+
+# SNPs read from a text file can be cached in a binary file next
+# to it, named by adding this suffix. The cache is rewritten if the
+# size or modification time of the text file change, or if it has
+# a different version (which should be incremented if the contents
+# of the cache change)
+SNP_CACHE_SUFFIX = ".cache.npz"
+SNP_CACHE_VERSION = 1
+
 
 # codes for CIGAR string
 BAM_CMATCH     = 0   # M - match/mismatch to ref M
@@ -27,21 +72,34 @@ class SNPTable(object):
         self.clear()
 
     def clear(self):
-        # snp_index and indel_index are arrays of length
-        # max(snp_pos, indel_pos) that provide lookup
-        # into snp_pos, snp_allele1, etc. by chromosome position.
-        # For example, if the first and second snps on the chromosome are
-        # at positions 1234, 1455 then elements 1233 and 1444 of the
-        # snp_index array will be 0 and 1 (and can be used to lookup
-        # info for the SNP in snp_pos, snp_allele1, snp_allele2 arrays)
-        self.snp_index = np.array([], dtype=np.int32)
+        # index provides lookup into snp_pos, snp_allele1, etc. by
+        # chromosome position. For example, if the first and second
+        # snps on the chromosome are at positions 1234, 1455 then
+        # looking up these positions in the index gives 0 and 1 (which
+        # can be used to lookup info for the SNP in snp_pos,
+        # snp_allele1, snp_allele2 arrays). Only the sorted positions
+        # of the SNPs are stored, rather than an element for every base.
+        self.index = SNPIndex()
         self.snp_pos = np.array([], dtype=np.int32)
         self.snp_allele1 = np.array([], dtype="|S10")
         self.snp_allele2 = np.array([], dtype="|S10")
+        # nucleotide codes of alleles (NUC_UNDEF for indels) and
+        # flags indicating which alleles are indels rather than SNPs
+        self.snp_code1 = np.array([], dtype=np.uint8)
+        self.snp_code2 = np.array([], dtype=np.uint8)
+        self.snp_is_indel = np.array([], dtype=np.bool_)
         self.haplotypes = None
         self.n_snp = 0
         self.samples = []
-        
+
+
+    @property
+    def snp_index(self):
+        """dense array with an element for each chromosome position
+        (up to last SNP) giving the index of the SNP at that position,
+        or SNP_UNDEF. This is built from the sparse index each time it
+        is accessed, and is only intended for small SNP tables."""
+        return self.index.to_dense()
 
 
     def read_h5(self, snp_tab_h5, snp_index_h5, hap_h5, chrom_name,
@@ -58,20 +116,25 @@ class SNPTable(object):
             return
             
         else:
-            # get numpy array of SNP idices
+            # get index of SNPs, which may be compact or dense
             node = snp_index_h5.getNode(node_name)
-            self.snp_index = node[:]
+            self.index = SNPIndex.from_h5(node)
 
-            # get numpy array of SNP positions
-            node = snp_tab_h5.getNode(node_name)
-            self.snp_pos = node[:]['pos']
-            self.snp_allele1 = node[:]['allele1']
-            self.snp_allele2 = node[:]['allele2']
+            # get numpy arrays of SNP positions and alleles, reading
+            # the table once rather than once for each column
+            snp_data = snp_tab_h5.getNode(node_name)[:]
+            self.snp_pos = snp_data['pos']
+            self.snp_allele1 = snp_data['allele1']
+            self.snp_allele2 = snp_data['allele2']
+            self.set_allele_codes()
             self.n_snp = self.snp_pos.shape[0]
             self.samples = self.get_h5_samples(hap_h5, chrom_name)
-            self.haplotypes = hap_h5.getNode(node_name)
+            hap_node = hap_h5.getNode(node_name)
             
-            if samples:
+            if not samples:
+                # read all haplotypes into memory
+                self.haplotypes = PackedHaplotypes.from_h5(hap_node)
+            else:
                 # reduce set of SNPs and indels to ones that are
                 # polymorphic in provided list of samples
                 samp_idx_dict, samp_idx = self.get_h5_sample_indices(hap_h5, chrom_name, samples)
@@ -90,12 +153,11 @@ class SNPTable(object):
                 hap_idx = np.empty(samp_idx.shape[0]*2, dtype=np.int)
                 hap_idx[0::2] = samp_idx*2
                 hap_idx[1::2] = samp_idx*2 + 1
-                haps = self.haplotypes[:,hap_idx]
+                haps = PackedHaplotypes.from_h5(hap_node, hap_idx)
 
                 # count number of ref and non-ref alleles,
                 # ignoring undefined (-1s)
-                nonref_count = np.apply_along_axis(np.sum, 1, haps == 1)
-                ref_count = np.apply_along_axis(np.sum, 1, haps == 0)
+                ref_count, nonref_count = haps.count_alleles()
                 total_count = nonref_count + ref_count
                 is_polymorphic = (ref_count > 0) & (ref_count < total_count)
 
@@ -112,16 +174,18 @@ class SNPTable(object):
                                       key=operator.itemgetter(1))
                 self.samples = [x[0] for x in sorted_samps]
                 
-                self.haplotypes = haps[is_polymorphic,]
+                self.haplotypes = haps.take_rows(is_polymorphic)
                 self.snp_pos = self.snp_pos[is_polymorphic]
                 self.snp_allele1 = self.snp_allele1[is_polymorphic]
                 self.snp_allele2 = self.snp_allele2[is_polymorphic]
+                self.snp_code1 = self.snp_code1[is_polymorphic]
+                self.snp_code2 = self.snp_code2[is_polymorphic]
+                self.snp_is_indel = self.snp_is_indel[is_polymorphic]
                 self.n_snp = self.snp_pos.shape[0]
 
                 # regenerate index to point to reduced set of polymorphic SNPs
-                self.snp_index[:] = -1                
-                self.snp_index[self.snp_pos-1] = np.arange(self.n_snp,
-                                                           dtype=np.int32)
+                self.index = SNPIndex.from_snp_pos(self.snp_pos,
+                                                   len(self.index))
                 
 
     
@@ -134,7 +198,7 @@ class SNPTable(object):
         
         if node_name in h5f:
             node = h5f.getNode(node_name)
-            samples = [row["name"] for row in node]
+            samples = list(node.col("name"))
         else:
             raise ValueError("Cannot retrieve haplotypes for "
                              "specified samples, because haplotype "
@@ -183,6 +247,37 @@ class SNPTable(object):
 
         
 
+    def set_allele_codes(self):
+        """Sets nucleotide codes for alleles, and flags indicating
+        whether each allele pair is a SNP or indel. This is done
+        once when SNPs are read, so that alleles do not need to
+        be checked with string comparisons for every read"""
+        self.snp_code1 = get_allele_codes(self.snp_allele1)
+        self.snp_code2 = get_allele_codes(self.snp_allele2)
+
+        # SNPs have single nucleotide A, C, G or T alleles,
+        # everything else is treated as an indel
+        self.snp_is_indel = (self.snp_code1 == NUC_UNDEF) | \
+                            (self.snp_code2 == NUC_UNDEF)
+
+        # single characters that are not nucleotides or '-'
+        # (which denotes a 1bp indel) are unexpected
+        len1 = np.char.str_len(self.snp_allele1)
+        len2 = np.char.str_len(self.snp_allele2)
+        unexpected = self.snp_is_indel & (len1 == 1) & (len2 == 1) & \
+                     (np.char.find(self.snp_allele1, b"-") == -1) & \
+                     (np.char.find(self.snp_allele2, b"-") == -1)
+        n_unexpected = np.sum(unexpected)
+        if n_unexpected > 0:
+            i = np.where(unexpected)[0][0]
+            sys.stderr.write("WARNING: unexpected character in alleles "
+                             "of %d SNPs, treating them as indels. "
+                             "First example:\n%s/%s\n" %
+                             (n_unexpected, self.snp_allele1[i],
+                              self.snp_allele2[i]))
+
+
+    
     def is_snp(self, allele1, allele2):
         """returns True if alleles appear to be 
         single-nucleotide polymorphism, returns false
@@ -207,8 +302,15 @@ class SNPTable(object):
 
 
         
-    def read_file(self, filename):
-        """read in SNPs and indels from text input file"""
+    def read_file(self, filename, use_cache=False):
+        """read in SNPs and indels from text input file. The file is
+        parsed a chunk of lines at a time. If use_cache is True, SNPs
+        are read from a binary cache file next to the text file if it
+        is up to date, otherwise the cache file is (re)written after
+        reading the text file"""
+        if use_cache and self.read_cache(filename):
+            return
+        
         try:
             if util.is_gzipped(filename):
                 f = gzip.open(filename)
@@ -221,55 +323,120 @@ class SNPTable(object):
             self.clear()
             return
         
-        snp_pos_list = []
-        snp_allele1_list = []
-        snp_allele2_list = []
-        max_pos = 0
+        snp_pos_chunks = []
+        snp_allele1_chunks = []
+        snp_allele2_chunks = []
 
-        for line in f:
-            words = line.split()
+        while True:
+            lines = f.readlines(SNP_FILE_CHUNK_BYTES)
+            if not lines:
+                break
+            pos, a1, a2 = parse_snp_lines(lines)
+            snp_pos_chunks.append(pos)
+            snp_allele1_chunks.append(a1)
+            snp_allele2_chunks.append(a2)
 
-            if(len(words) < 3):
-                raise ValueError("expected at least 3 values per SNP "
-              			 "file line but got %d:\n"
-                                 "%s\n" % (len(words), line))
+        f.close()
 
-            pos = int(words[0])
-            a1 = words[1].upper().replace("-", "")
-            a2 = words[2].upper().replace("-", "")
+        if snp_pos_chunks:
+            self.snp_pos = np.concatenate(snp_pos_chunks)
+            self.snp_allele1 = np.concatenate(snp_allele1_chunks)
+            self.snp_allele2 = np.concatenate(snp_allele2_chunks)
+        else:
+            self.snp_pos = np.array([], dtype=np.int32)
+            self.snp_allele1 = np.array([], dtype="|S10")
+            self.snp_allele2 = np.array([], dtype="|S10")
+        self.set_allele_codes()
 
-            if pos <= 0:
-                raise ValueError("expected SNP position to be >= 1:\n%s\n" %
-                                 line)
+        # make index that makes it easy to lookup SNPs by their position
+        # on the chromosome
+        self.index = SNPIndex.from_snp_pos(self.snp_pos)
 
-            if pos > max_pos:
-                max_pos = pos
+        self.n_snp = self.snp_pos.shape[0]
 
-            snp_pos_list.append(pos)
-            snp_allele1_list.append(a1)
-            snp_allele2_list.append(a2)
+        # currently haplotypes can only be read from HDF5 file
+        self.haplotypes = None
 
-        f.close()
+        if use_cache:
+            self.write_cache(filename)
 
-        # convert lists to numpy arrays, which allow for faster
-        # lookups and use less memory
-        self.snp_pos = np.array(snp_pos_list, dtype=np.int32)
-        del snp_pos_list
-        self.snp_allele1 = np.array(snp_allele1_list, dtype="|S10")
-        del snp_allele1_list
-        self.snp_allele2 = np.array(snp_allele2_list, dtype="|S10")
-        del snp_allele2_list
 
-        # make another array that makes it easy to lookup SNPs by their position
-        # on the chromosome
-        self.snp_index = np.empty(max_pos, dtype=np.int32)
-        self.snp_index[:] = SNP_UNDEF
-        self.snp_index[self.snp_pos-1] = np.arange(self.snp_pos.shape[0])
 
-        self.n_snp = self.snp_pos.shape[0]
+    def read_cache(self, filename):
+        """reads SNPs from binary cache file for SNP text file, if it
+        exists and is up to date. Returns True if SNPs were read"""
+        cache_filename = filename + SNP_CACHE_SUFFIX
 
-        # currently haplotypes can only be read from HDF5 file
+        if not os.path.exists(cache_filename):
+            return False
+
+        try:
+            st = os.stat(filename)
+            data = np.load(cache_filename)
+        except (IOError, OSError, ValueError):
+            return False
+
+        try:
+            if (int(data['version']) != SNP_CACHE_VERSION or
+                int(data['src_size']) != st.st_size or
+                float(data['src_mtime']) != st.st_mtime):
+                # text file has changed since cache was written
+                return False
+            
+            self.snp_pos = data['snp_pos']
+            self.snp_allele1 = data['snp_allele1']
+            self.snp_allele2 = data['snp_allele2']
+            self.snp_code1 = data['snp_code1']
+            self.snp_code2 = data['snp_code2']
+            self.snp_is_indel = data['snp_is_indel']
+            self.index = SNPIndex(data['index_pos'], data['index_idx'],
+                                  int(data['index_length']))
+        except (IOError, ValueError, KeyError):
+            # cache is corrupt or from older version
+            self.clear()
+            return False
+        finally:
+            data.close()
+
+        self.n_snp = self.snp_pos.shape[0]
         self.haplotypes = None
+        sys.stderr.write("read %d SNPs from cache file '%s'\n" %
+                         (self.n_snp, cache_filename))
+        return True
+
+
+
+    def write_cache(self, filename):
+        """writes SNPs read from text file to binary cache file next to
+        it. The cache is written to a temporary file and then renamed,
+        so that processes reading the cache at the same time never see
+        a partial file. If the cache cannot be written (e.g. because
+        the directory is read-only) a warning is given."""
+        cache_filename = filename + SNP_CACHE_SUFFIX
+        tmp_filename = "%s.tmp%d" % (cache_filename, os.getpid())
+
+        try:
+            st = os.stat(filename)
+            f = open(tmp_filename, "wb")
+            np.savez(f, version=SNP_CACHE_VERSION,
+                     src_size=st.st_size, src_mtime=st.st_mtime,
+                     snp_pos=self.snp_pos,
+                     snp_allele1=self.snp_allele1,
+                     snp_allele2=self.snp_allele2,
+                     snp_code1=self.snp_code1,
+                     snp_code2=self.snp_code2,
+                     snp_is_indel=self.snp_is_indel,
+                     index_pos=self.index.pos,
+                     index_idx=self.index.idx,
+                     index_length=self.index.length)
+            f.close()
+            os.rename(tmp_filename, cache_filename)
+        except (IOError, OSError) as e:
+            sys.stderr.write("WARNING: unable to write SNP cache file "
+                             "'%s': %s\n" % (cache_filename, str(e)))
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+
 
     
     def get_overlapping_snps(self, read):
@@ -319,25 +486,20 @@ class SNPTable(object):
                 genome_end = genome_start + op_len - 1
 
                 # check for SNP in this genome segment
-                s = genome_start - 1
-                e = min(genome_end, self.snp_index.shape[0])
-                s_idx = self.snp_index[s:e]
-                offsets = np.where(s_idx != SNP_UNDEF)[0]
+                s_pos, s_idx = self.index.lookup(genome_start, genome_end)
                 
-                if offsets.shape[0] > 0:
+                if s_pos.shape[0] > 0:
                     # there are overlapping SNPs and/or indels
                     
-                    for offset in offsets:
-                        read_pos = offset + read_start
+                    for pos, i in zip(s_pos, s_idx):
+                        read_pos = pos - genome_start + read_start
                         
-                        allele1 = self.snp_allele1[s_idx[offset]]
-                        allele2 = self.snp_allele2[s_idx[offset]]
-                        if self.is_snp(allele1, allele2):
-                            snp_idx.append(s_idx[offset])
-                            snp_read_pos.append(read_pos)
-                        else:
-                            indel_idx.append(s_idx[offset])
+                        if self.snp_is_indel[i]:
+                            indel_idx.append(i)
                             indel_read_pos.append(read_pos)
+                        else:
+                            snp_idx.append(i)
+                            snp_read_pos.append(read_pos)
 
             elif op == BAM_CINS:
                 # insert in read relative to reference
@@ -363,24 +525,17 @@ class SNPTable(object):
                 # by flanking match segment, but there could be
                 # nested indels
 
-                s = genome_start - 1
-                e = min(genome_end, self.snp_index.shape[0])
-                
                 # check for INDEL in this genome segment
-                s_idx = self.snp_index[s:e]
-                offsets = np.where(s_idx != SNP_UNDEF)[0]
+                s_pos, s_idx = self.index.lookup(genome_start, genome_end)
                 
-                if offsets.shape[0] > 0:
+                if s_pos.shape[0] > 0:
                     # there are overlapping SNPs and/or indels
-                    for offset in offsets:
-                        read_pos = offset + read_start
-                        allele1 = self.snp_allele1[s_idx[offset]]
-                        allele2 = self.snp_allele2[s_idx[offset]]
-                        if self.is_snp(allele1, allele2):
+                    for i in s_idx:
+                        if not self.snp_is_indel[i]:
                             # ignore SNP
                             pass
                         else:
-                            indel_idx.append(s_idx[offset])
+                            indel_idx.append(i)
                             # position in read is where we last left off
                             # in read sequence
                             indel_read_pos.append(read_end)
@@ -413,9 +568,10 @@ class SNPTable(object):
             elif op == BAM_CPAD:
                 # like an insert, likely only used in multiple-sequence
                 # alignment where inserts may be of different lengths
-                # in different seqs
-                read_start += read_end + 1
-                read_end = read_start + op_len - 1
+                # in different seqs. Padding is a silent deletion from
+                # the padded reference, so neither the read nor the
+                # genome position advances
+                pass
 
             else:
                 raise ValueError("unknown CIGAR code %d" % op)
@@ -427,3 +583,588 @@ class SNPTable(object):
         
         
         return snp_idx, snp_read_pos, indel_idx, indel_read_pos
+
+
+
+    def get_overlapping_snps_batch(self, read_start, cigar_count,
+                                   cigar_op, cigar_len, query_len):
+        """Finds SNPs and indels that overlap a block of reads at
+        once. Arguments are arrays describing the reads:
+          read_start - 0-based genome start position of each read
+          cigar_count - number of CIGAR operations for each read
+          cigar_op, cigar_len - codes and lengths of CIGAR operations for
+            all reads, concatenated in the same order as the reads
+          query_len - length of each read sequence
+
+        Returns six arrays:
+        [1] index of read (in block) for each overlapping SNP,
+        [2] indices of overlapping SNPs,
+        [3] positions in read sequence that overlap SNPs,
+        [4] index of read (in block) for each overlapping indel,
+        [5] indices of overlapping indels,
+        [6] positions in read sequence that overlap indels.
+        First base of read is position 1. Results are ordered by read,
+        and within each read are in the same order as they are returned
+        by get_overlapping_snps."""
+        read_start = np.asarray(read_start, dtype=np.int64)
+        cigar_count = np.asarray(cigar_count, dtype=np.int64)
+        cigar_op = np.asarray(cigar_op, dtype=np.int64)
+        cigar_len = np.asarray(cigar_len, dtype=np.int64)
+        query_len = np.asarray(query_len, dtype=np.int64)
+        
+        n_read = read_start.shape[0]
+
+        if cigar_count.shape[0] != n_read or query_len.shape[0] != n_read:
+            raise ValueError("expected read_start, cigar_count and "
+                             "query_len arrays to all be same length")
+
+        if (cigar_op.shape[0] != cigar_len.shape[0]) or \
+           (cigar_op.shape[0] != np.sum(cigar_count)):
+            raise ValueError("expected total number of CIGAR operations "
+                             "(%d) to match length of cigar_op (%d) and "
+                             "cigar_len (%d) arrays" %
+                             (np.sum(cigar_count), cigar_op.shape[0],
+                              cigar_len.shape[0]))
+
+        unknown = (cigar_op < BAM_CMATCH) | (cigar_op > BAM_CDIFF)
+        if np.any(unknown):
+            raise ValueError("unknown CIGAR code %d" % cigar_op[unknown][0])
+
+        # index of read that each CIGAR operation comes from
+        op_read = np.repeat(np.arange(n_read), cigar_count)
+        
+        is_match = (cigar_op == BAM_CMATCH) | (cigar_op == BAM_CEQUAL) | \
+                   (cigar_op == BAM_CDIFF)
+        is_del = (cigar_op == BAM_CDEL)
+
+        # number of bases that each operation advances in read sequence
+        # and in genome (see get_overlapping_snps for details about
+        # how each operation is handled)
+        read_adv = np.where(is_match | (cigar_op == BAM_CINS) |
+                            (cigar_op == BAM_CSOFT_CLIP), cigar_len, 0)
+        genome_adv = np.where(is_match | is_del |
+                              (cigar_op == BAM_CREF_SKIP), cigar_len, 0)
+
+        # cumulative sums over all operations, with a leading 0, so
+        # that offsets relative to start of each read can be obtained
+        read_cum = np.concatenate(([0], np.cumsum(read_adv)))
+        genome_cum = np.concatenate(([0], np.cumsum(genome_adv)))
+        first_op = np.cumsum(cigar_count) - cigar_count
+
+        read_len = read_cum[first_op + cigar_count] - read_cum[first_op]
+        bad_len = (read_len != query_len)
+        if np.any(bad_len):
+            raise ValueError("length of read segments in CIGAR %d "
+                             "does not add up to query length (%d)" %
+                             (read_len[bad_len][0], query_len[bad_len][0]))
+
+        # number of read bases before each operation, and 0-based
+        # genome coordinates of each operation
+        read_offset = read_cum[:-1] - read_cum[first_op][op_read]
+        genome_start = read_start[op_read] + genome_cum[:-1] - \
+                       genome_cum[first_op][op_read]
+        genome_end = genome_start + genome_adv
+
+        # only match and deletion segments can overlap SNPs and indels
+        ops = np.where(is_match | is_del)[0]
+
+        # SNP positions in index are 1-based, so SNPs overlapping
+        # an operation are those with genome_start < pos <= genome_end
+        snp_pos = self.index.pos
+        snp_idx = self.index.idx
+        snp_is_indel = self.snp_is_indel
+        lo = np.searchsorted(snp_pos, genome_start[ops], side="right")
+        hi = np.searchsorted(snp_pos, genome_end[ops], side="right")
+
+        # expand to one element per (operation, SNP) overlap
+        n_hit = hi - lo
+        hit_op = np.repeat(ops, n_hit)
+        hit_sorted_idx = np.arange(np.sum(n_hit)) + \
+                         np.repeat(lo - (np.cumsum(n_hit) - n_hit), n_hit)
+        hit_idx = snp_idx[hit_sorted_idx]
+        hit_read = op_read[hit_op]
+        hit_is_match = is_match[hit_op]
+        hit_is_indel = snp_is_indel[hit_idx]
+        
+        # In match segments position in read is offset from start of
+        # segment. In deletions position in read is where we last left
+        # off in read sequence
+        hit_read_pos = np.where(hit_is_match,
+                                snp_pos[hit_sorted_idx] - genome_start[hit_op] +
+                                read_offset[hit_op],
+                                read_offset[hit_op])
+
+        # SNPs that overlap deletions are ignored
+        is_snp = hit_is_match & ~hit_is_indel
+        
+        return (hit_read[is_snp], hit_idx[is_snp], hit_read_pos[is_snp],
+                hit_read[hit_is_indel], hit_idx[hit_is_indel],
+                hit_read_pos[hit_is_indel])
+
+
+    
+    def may_overlap_snps(self, reads):
+        """Returns boolean array indicating which reads may overlap 
+        SNPs or indels. This is a quick check that uses the genome span
+        of each read and the bitset of blocks containing SNPs (see 
+        SNPIndex.in_snp_blocks). Reads flagged False definitely 
+        do not overlap any SNPs or indels."""
+        read_start = np.empty(len(reads), dtype=np.int64)
+        read_end = np.empty(len(reads), dtype=np.int64)
+        for i in range(len(reads)):
+            read_start[i] = reads[i].reference_start
+            read_end[i] = reads[i].reference_end
+
+        return self.index.in_snp_blocks(read_start, read_end)
+        
+
+        
+    def get_overlapping_snps_reads(self, reads):
+        """Looks up SNPs and indels that overlap a list of reads using
+        get_overlapping_snps_batch. Returns a list with a tuple
+        for each read containing the same four lists that are
+        returned by get_overlapping_snps"""
+        read_start, cigar_count, cigar_op, cigar_len, query_len = \
+            get_read_arrays(reads)
+
+        snp_read, snp_idx, snp_read_pos, \
+            indel_read, indel_idx, indel_read_pos = \
+            self.get_overlapping_snps_batch(read_start, cigar_count,
+                                            cigar_op, cigar_len, query_len)
+
+        # split results into separate lists for each read, results are
+        # ordered by read so boundaries can be found with searchsorted
+        read_num = np.arange(len(reads) + 1)
+        snp_bound = np.searchsorted(snp_read, read_num).tolist()
+        indel_bound = np.searchsorted(indel_read, read_num).tolist()
+
+        snp_idx = snp_idx.tolist()
+        snp_read_pos = snp_read_pos.tolist()
+        indel_idx = indel_idx.tolist()
+        indel_read_pos = indel_read_pos.tolist()
+        
+        overlaps = []
+        for i in range(len(reads)):
+            s, e = snp_bound[i], snp_bound[i+1]
+            indel_s, indel_e = indel_bound[i], indel_bound[i+1]
+            overlaps.append((snp_idx[s:e], snp_read_pos[s:e],
+                             indel_idx[indel_s:indel_e],
+                             indel_read_pos[indel_s:indel_e]))
+
+        return overlaps
+                 
+
+
+class SNPIndex(object):
+    """Lookup from chromosome position to index of SNP/indel in
+    snp_pos, snp_allele1, etc. Rather than holding an array with an
+    element for every base of the chromosome, only the positions of
+    the SNPs are kept (in sorted order) and lookups are done by
+    binary search."""
+
+    def __init__(self, pos=None, idx=None, length=None):
+        # sorted 1-based chromosome positions of SNPs and
+        # corresponding SNP indices
+        if pos is None:
+            pos = []
+        if idx is None:
+            idx = []
+        self.pos = np.asarray(pos, dtype=np.int32)
+        self.idx = np.asarray(idx, dtype=np.int32)
+
+        if self.pos.shape != self.idx.shape:
+            raise ValueError("expected same number of SNP positions (%d) "
+                             "and SNP indices (%d)" %
+                             (self.pos.shape[0], self.idx.shape[0]))
+
+        # length of dense index that this index is equivalent to
+        if length is None:
+            length = self.pos[-1] if self.pos.shape[0] else 0
+        self.length = int(length)
+
+        # bitset of blocks that contain SNPs, see get_snp_blocks
+        self.snp_blocks = None
+
+
+    @classmethod
+    def from_snp_pos(cls, snp_pos, length=None):
+        """Creates index from array of SNP positions. If there are
+        multiple SNPs at the same position the last one is used
+        (as it would be with a dense index)."""
+        snp_pos = np.asarray(snp_pos)
+        order = np.argsort(snp_pos, kind="mergesort")
+        pos = snp_pos[order]
+        # keep last of each run of duplicate positions
+        is_last = np.ones(pos.shape[0], dtype=np.bool_)
+        is_last[:-1] = pos[1:] != pos[:-1]
+        return cls(pos[is_last], order[is_last], length)
+
+
+    @classmethod
+    def from_dense(cls, snp_index, offset=0):
+        """Creates index from a dense array with an element for each
+        base, which is SNP_UNDEF where there is no SNP"""
+        snp_index = np.asarray(snp_index)
+        pos = np.where(snp_index != SNP_UNDEF)[0]
+        return cls(pos + offset + 1, snp_index[pos], snp_index.shape[0])
+
+
+    @classmethod
+    def from_h5(cls, node):
+        """Reads index from HDF5 array node. The node can either
+        be a compact index, which is a matrix with a row of 
+        (position, index) for each SNP, or a dense index with an 
+        element for each base of the chromosome. Dense indices
+        are read a chunk at a time, to limit memory usage."""
+        if len(node.shape) == 2:
+            data = node[:]
+            if data.shape[0] == 0:
+                return cls()
+            return cls(data[:, 0], data[:, 1])
+
+        length = node.shape[0]
+        pos_list = []
+        idx_list = []
+        for start in range(0, length, SNP_INDEX_CHUNK_LEN):
+            chunk = cls.from_dense(node[start:start+SNP_INDEX_CHUNK_LEN],
+                                   offset=start)
+            pos_list.append(chunk.pos)
+            idx_list.append(chunk.idx)
+
+        if pos_list:
+            return cls(np.concatenate(pos_list), np.concatenate(idx_list),
+                       length)
+        return cls(length=length)
+
+
+    def __len__(self):
+        return self.length
+
+
+    def lookup(self, start, end):
+        """Returns arrays of positions and indices of SNPs
+        in 1-based chromosome region start-end (inclusive)"""
+        lo = np.searchsorted(self.pos, start, side="left")
+        hi = np.searchsorted(self.pos, end, side="right")
+        return self.pos[lo:hi], self.idx[lo:hi]
+
+
+    def get_snp_blocks(self):
+        """Returns bitset (packed into uint8 array, highest bit first)
+        with a bit for each block of 2**SNP_BLOCK_SHIFT bases, which is
+        set if the block contains a SNP. The bitset is created the 
+        first time it is needed."""
+        if self.snp_blocks is None:
+            n_block = 0
+            if self.pos.shape[0]:
+                n_block = ((self.pos[-1] - 1) >> SNP_BLOCK_SHIFT) + 1
+            is_occupied = np.zeros(n_block, dtype=np.bool_)
+            is_occupied[(self.pos - 1) >> SNP_BLOCK_SHIFT] = True
+            self.snp_blocks = np.packbits(is_occupied)
+
+        return self.snp_blocks
+
+
+    def in_snp_blocks(self, start, end):
+        """Takes arrays of 0-based start and end (exclusive) genome
+        coordinates of regions and returns a boolean array indicating
+        whether each region touches any block containing a SNP. Regions
+        for which False is returned do not overlap any SNPs. Regions 
+        spanning many blocks are always flagged as True."""
+        snp_blocks = self.get_snp_blocks()
+        n_block = snp_blocks.shape[0] * 8
+
+        first_block = np.asarray(start) >> SNP_BLOCK_SHIFT
+        last_block = (np.maximum(np.asarray(end), 1) - 1) >> SNP_BLOCK_SHIFT
+        n_span = last_block - first_block + 1
+
+        touches_snp = n_span > SNP_BLOCK_MAX_SPAN
+        for i in range(SNP_BLOCK_MAX_SPAN):
+            block = first_block + i
+            check = (i < n_span) & (block < n_block)
+            block = block[check]
+            bits = snp_blocks[block >> 3] >> (7 - (block & 7))
+            touches_snp[check] |= (bits & 1).astype(np.bool_)
+
+        return touches_snp
+
+
+    def to_dense(self):
+        """Returns dense index, with an element for every base
+        (up to length), that is SNP_UNDEF where there is no SNP"""
+        snp_index = np.empty(self.length, dtype=np.int32)
+        snp_index[:] = SNP_UNDEF
+        snp_index[self.pos-1] = self.idx
+        return snp_index
+
+
+
+class PackedHaplotypes(object):
+    """Matrix of haplotypes (one row per SNP, one column per haplotype)
+    held in memory using 2 bits per allele. Values in the matrix are
+    0 (reference allele), 1 (alternate allele) or -1 (undefined).
+    Rows and columns can be obtained with numpy-style indexing, e.g.
+    haps[snp_idx,:] or haps[:,hap_idx], which return int8 arrays."""
+
+    # number of alleles stored in each byte
+    ALLELES_PER_BYTE = 4
+
+    # 2-bit code used for undefined alleles. Codes are the lowest 2
+    # bits of the allele value, so that -1 has the highest code (this
+    # gives same sort order as raw bytes of signed int8 values)
+    CODE_UNDEF = 3
+
+    # lookup tables giving the 4 allele values and the number of
+    # reference and alternate alleles for each possible byte
+    UNPACK_TABLE = np.array([[(b >> (2*i)) & 3 for i in range(4)]
+                             for b in range(256)], dtype=np.int8)
+    UNPACK_TABLE[UNPACK_TABLE == CODE_UNDEF] = -1
+    REF_COUNT_TABLE = np.sum(UNPACK_TABLE == 0, axis=1).astype(np.uint8)
+    ALT_COUNT_TABLE = np.sum(UNPACK_TABLE == 1, axis=1).astype(np.uint8)
+
+
+    def __init__(self, haplotypes=None):
+        self.n_hap = 0
+        self.packed = np.empty((0, 0), dtype=np.uint8)
+
+        if haplotypes is not None:
+            haplotypes = np.asarray(haplotypes)
+            self.n_hap = haplotypes.shape[1]
+            self.packed = self.pack(haplotypes)
+
+        
+
+    @classmethod
+    def from_h5(cls, node, hap_idx=None):
+        """Reads haplotypes from HDF5 array node, a chunk of rows 
+        at a time. If hap_idx is provided, only these columns 
+        (haplotypes) are kept"""
+        n_snp = node.shape[0]
+        n_hap = node.shape[1] if len(node.shape) > 1 else 0
+
+        haps = cls()
+        if hap_idx is None:
+            haps.n_hap = n_hap
+        else:
+            haps.n_hap = len(hap_idx)
+
+        chunk_size = max(1, HAPLOTYPE_CHUNK_BYTES // max(1, n_hap))
+        chunks = []
+        for start in range(0, n_snp, chunk_size):
+            chunk = node[start:start+chunk_size]
+            if hap_idx is not None:
+                chunk = chunk[:, hap_idx]
+            chunks.append(haps.pack(chunk))
+
+        n_byte = (haps.n_hap + cls.ALLELES_PER_BYTE - 1) // cls.ALLELES_PER_BYTE
+        if chunks:
+            haps.packed = np.concatenate(chunks)
+        else:
+            haps.packed = np.empty((0, n_byte), dtype=np.uint8)
+
+        return haps
+
+
+    
+    def pack(self, haplotypes):
+        """Returns array of packed bytes for matrix of haplotypes"""
+        haplotypes = np.asarray(haplotypes)
+        if haplotypes.size and ((np.min(haplotypes) < -1) or
+                                (np.max(haplotypes) > 1)):
+            raise ValueError("expected haplotype values to be "
+                             "-1, 0 or 1")
+
+        # pad columns to multiple of 4 with undefined alleles
+        n_row, n_col = haplotypes.shape
+        n_byte = (n_col + self.ALLELES_PER_BYTE - 1) // self.ALLELES_PER_BYTE
+        codes = np.empty((n_row, n_byte * self.ALLELES_PER_BYTE),
+                         dtype=np.uint8)
+        codes[:, n_col:] = self.CODE_UNDEF
+        codes[:, :n_col] = haplotypes.astype(np.int8).view(np.uint8) & 3
+
+        codes = codes.reshape((n_row, n_byte, self.ALLELES_PER_BYTE))
+        return (codes[:,:,0] | (codes[:,:,1] << 2) |
+                (codes[:,:,2] << 4) | (codes[:,:,3] << 6)).astype(np.uint8)
+
+
+    
+    def unpack(self, packed):
+        """Returns int8 array of haplotypes for rows of packed bytes"""
+        haps = self.UNPACK_TABLE[packed]
+        haps = haps.reshape(packed.shape[:-1] + (-1,))
+        return haps[..., :self.n_hap]
+
+    
+    @property
+    def shape(self):
+        return (self.packed.shape[0], self.n_hap)
+
+    
+
+    def __len__(self):
+        return self.packed.shape[0]
+
+
+    
+    def __getitem__(self, key):
+        """Returns unpacked haplotypes for rows (SNPs) and
+        columns (haplotypes) specified by key"""
+        if isinstance(key, tuple):
+            rows, cols = key
+        else:
+            rows, cols = key, slice(None)
+
+        packed = self.packed[rows]
+        
+        if isinstance(cols, slice) and cols == slice(None):
+            return self.unpack(packed)
+
+        # only unpack requested columns
+        col_idx = np.arange(self.n_hap)[cols]
+        byte_idx = col_idx // self.ALLELES_PER_BYTE
+        shift = (col_idx % self.ALLELES_PER_BYTE) * 2
+        codes = (packed[..., byte_idx] >> shift.astype(np.uint8)) & 3
+        haps = codes.astype(np.int8)
+        haps[codes == self.CODE_UNDEF] = -1
+        return haps
+
+
+    
+    def take_rows(self, rows):
+        """Returns new PackedHaplotypes containing only specified rows"""
+        haps = PackedHaplotypes()
+        haps.n_hap = self.n_hap
+        haps.packed = self.packed[rows]
+        return haps
+
+    
+
+    def count_alleles(self):
+        """Returns arrays with number of reference and alternate
+        alleles in each row, ignoring undefined alleles"""
+        ref_count = np.sum(self.REF_COUNT_TABLE[self.packed], axis=1,
+                           dtype=np.int64)
+        alt_count = np.sum(self.ALT_COUNT_TABLE[self.packed], axis=1,
+                           dtype=np.int64)
+        return ref_count, alt_count
+
+
+    
+    def get_unique_columns(self, rows):
+        """Returns unique haplotypes (columns) for a set of rows (SNPs), 
+        as a 2D array with one row per unique haplotype. Unique
+        haplotypes are ordered in the same way as np.unique would
+        order the raw bytes of each haplotype."""
+        haps = self[rows,:].T
+        n_row = haps.shape[1]
+
+        if n_row > 31:
+            # too many SNPs to make integer keys, compare 
+            # haplotypes as raw bytes instead
+            h = np.ascontiguousarray(haps).view(np.dtype((np.void,
+                                                          n_row)))
+            _, idx = np.unique(h, return_index=True)
+            return haps[idx,:]
+        
+        # make an integer key for each haplotype from the 2-bit codes,
+        # with the first SNP most significant
+        codes = haps.view(np.uint8) & 3
+        shifts = 2 * np.arange(n_row - 1, -1, -1, dtype=np.int64)
+        keys = np.sum(codes.astype(np.int64) << shifts, axis=1)
+
+        _, idx = np.unique(keys, return_index=True)
+        return haps[idx,:]
+        
+                 
+
+def parse_snp_lines(lines):
+    """Parses lines from SNP text file, which have three
+    whitespace-delimited columns (position, allele1, allele2).
+    Returns arrays of positions and of alleles, in upper case and
+    with '-' characters removed. When every line has exactly three
+    values they are converted all at once, otherwise each line is
+    checked, so that a useful error is raised for bad lines"""
+    words = "".join(lines).split()
+    
+    snp_pos = None
+    if len(words) == 3 * len(lines):
+        try:
+            snp_pos = np.array(words[0::3]).astype(np.int64)
+            allele1 = words[1::3]
+            allele2 = words[2::3]
+        except ValueError:
+            # values are not lined up in columns
+            snp_pos = None
+    
+    if snp_pos is None:
+        snp_pos = []
+        allele1 = []
+        allele2 = []
+        for line in lines:
+            words = line.split()
+            if(len(words) < 3):
+                raise ValueError("expected at least 3 values per SNP "
+                                 "file line but got %d:\n"
+                                 "%s\n" % (len(words), line))
+            snp_pos.append(int(words[0]))
+            allele1.append(words[1])
+            allele2.append(words[2])
+        snp_pos = np.array(snp_pos, dtype=np.int64)
+
+    bad_pos = np.where(snp_pos <= 0)[0]
+    if bad_pos.shape[0] > 0:
+        raise ValueError("expected SNP position to be >= 1:\n%s\n" %
+                         lines[bad_pos[0]])
+
+    allele1 = np.char.replace(np.char.upper(np.array(allele1, dtype="|S")),
+                              "-", "")
+    allele2 = np.char.replace(np.char.upper(np.array(allele2, dtype="|S")),
+                              "-", "")
+
+    return (snp_pos.astype(np.int32), allele1.astype("|S10"),
+            allele2.astype("|S10"))
+
+
+
+def get_allele_codes(alleles):
+    """Returns array of nucleotide codes for an array of alleles.
+    Alleles that are not a single nucleotide are given code NUC_UNDEF"""
+    alleles = np.asarray(alleles)
+    
+    # take ASCII value of first character of each allele
+    # (empty alleles give 0)
+    first = np.frombuffer(alleles.astype("|S1").tobytes(), dtype=np.uint8)
+    codes = NUC_CODE_LOOKUP[first]
+    codes[np.char.str_len(alleles) != 1] = NUC_UNDEF
+
+    return codes
+
+
+
+def get_seq_codes(seq):
+    """Returns array of nucleotide codes for a sequence string"""
+    return NUC_CODE_LOOKUP[np.frombuffer(seq.encode("ascii"),
+                                         dtype=np.uint8)]
+
+
+
+def get_read_arrays(reads):
+    """Returns arrays describing the alignments of a list of reads, that
+    can be passed to SNPTable.get_overlapping_snps_batch"""
+    read_start = np.empty(len(reads), dtype=np.int64)
+    cigar_count = np.empty(len(reads), dtype=np.int64)
+    query_len = np.empty(len(reads), dtype=np.int64)
+    cigars = []
+    
+    for i in range(len(reads)):
+        read = reads[i]
+        # unmapped reads do not have CIGAR
+        cigar = read.cigar or []
+        read_start[i] = read.pos
+        query_len[i] = read.query_length
+        cigar_count[i] = len(cigar)
+        cigars.extend(cigar)
+
+    cigars = np.array(cigars, dtype=np.int64).reshape((len(cigars), 2))
+    
+    return read_start, cigar_count, cigars[:,0], cigars[:,1], query_len
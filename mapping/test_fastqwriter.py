@@ -0,0 +1,72 @@
+import os
+import gzip
+import shutil
+
+import fastqwriter
+
+
+def make_records(n):
+    return ["@read%d\nACGTACGTAC\n+read%d\nIIIIIIIIII\n" % (i, i)
+            for i in range(n)]
+
+
+
+class TestFastqWriter:
+
+    def setup_method(self, method):
+        self.data_dir = "test_data/fastqwriter"
+        if not os.path.exists(self.data_dir):
+            os.makedirs(self.data_dir)
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.data_dir)
+
+
+    def test_compressed(self):
+        """Test that records compressed as several gzip members
+        by several threads are written in order"""
+        records = make_records(1000)
+
+        for threads in (0, 1, 3):
+            filename = "%s/test%d.fq.gz" % (self.data_dir, threads)
+            writer = fastqwriter.FastqWriter(filename, compress_level=1,
+                                             threads=threads,
+                                             block_size=1000)
+            for record in records:
+                writer.write(record)
+            writer.close()
+
+            # block size is small so should be many blocks
+            assert writer.n_block > 10
+
+            f = gzip.open(filename)
+            assert f.read() == "".join(records)
+            f.close()
+
+
+    def test_uncompressed(self):
+        """Test that records are written as plain text with
+        compression level 0"""
+        records = make_records(10)
+        filename = "%s/test.fq" % self.data_dir
+        writer = fastqwriter.FastqWriter(filename, compress_level=0,
+                                         threads=2, block_size=100)
+        for record in records:
+            writer.write(record)
+        writer.close()
+
+        f = open(filename)
+        assert f.read() == "".join(records)
+        f.close()
+
+
+    def test_empty(self):
+        """Test that file with no records is valid gzip file"""
+        filename = "%s/empty.fq.gz" % self.data_dir
+        writer = fastqwriter.FastqWriter(filename)
+        writer.close()
+
+        f = gzip.open(filename)
+        assert f.read() == ""
+        f.close()
@@ -1,5 +1,6 @@
 import glob
 import gzip
+import json
 import os
 import os.path
 import subprocess
@@ -8,6 +9,8 @@ import tables
 import numpy as np
 
 import find_intersecting_snps
+import remapdedup
+import flipcache
 
 def read_bam(bam):
     """
@@ -81,10 +84,14 @@ class Data(object):
         self.fastq_remap_filename = self.output_prefix + ".remap.fq.gz"
         self.fastq1_remap_filename = self.output_prefix + ".remap.fq1.gz"
         self.fastq2_remap_filename = self.output_prefix + ".remap.fq2.gz"
+        self.dups_filename = self.output_prefix + ".remap.dups.txt.gz"
+        self.flip_keys_filename = self.output_prefix + ".remap.flips.txt.gz"
         
         self.snp_tab_filename = self.prefix + "_snp_tab.h5"
         self.snp_index_filename = self.prefix + "_snp_index.h5"
         self.haplotype_filename = self.prefix + "_haplotype.h5"
+
+        self.flip_cache_dir = self.prefix + "_flip_cache"
         
 
 
@@ -108,11 +115,15 @@ class Data(object):
             self.sam_filename,
             self.bam_filename,
             self.bam_sort_filename,
+            self.bam_sort_filename + ".bai",
+            self.bam_sort_filename + find_intersecting_snps.CHECKPOINT_SUFFIX,
             self.bam_keep_filename,
             self.bam_remap_filename,
             self.fastq_remap_filename,
             self.fastq1_remap_filename,
             self.fastq2_remap_filename,
+            self.dups_filename,
+            self.flip_keys_filename,
             self.snp_index_filename,
             self.snp_tab_filename,
             self.haplotype_filename]
@@ -120,9 +131,13 @@ class Data(object):
         index_filenames = glob.glob(self.genome_prefix + "*.bt2")
         filenames.extend(index_filenames)
 
-        snp_filenames = glob.glob(self.snp_dir + "/*.snps.txt.gz")
+        snp_filenames = glob.glob(self.snp_dir + "/*.snps.txt.gz*")
         filenames.extend(snp_filenames)
 
+        flip_cache_filenames = glob.glob(self.flip_cache_dir + "/*") + \
+                               glob.glob(self.flip_cache_dir + "/.lock")
+        filenames.extend(flip_cache_filenames)
+
         for fname in filenames:
             if os.path.exists(fname):
                 os.remove(fname)
@@ -130,6 +145,9 @@ class Data(object):
         if os.path.exists(self.snp_dir):
             os.rmdir(self.snp_dir)
 
+        if os.path.exists(self.flip_cache_dir):
+            os.rmdir(self.flip_cache_dir)
+
 
     def write_ref_genome(self):
         f = open(self.genome_filename, "w")
@@ -449,6 +467,82 @@ class TestSingleEnd:
 
 
 
+    def test_single_one_read_one_snp_stream_sort(self):
+        """Test that reads can be read directly from the sort,
+        without writing a sorted BAM file"""
+        test_data = Data()
+        test_data.setup()
+        test_data.index_genome_bowtie2()
+        test_data.map_single_bowtie2()
+        test_data.sam2bam()
+
+        find_intersecting_snps.main(test_data.bam_filename,
+                                    is_paired_end=False,
+                                    is_sorted=False,
+                                    stream_sort=True, sort_threads=2,
+                                    snp_dir=test_data.snp_dir)
+
+        # sorted BAM file should not be written, and named
+        # pipe should be removed
+        assert not os.path.exists(test_data.bam_sort_filename)
+        assert len(glob.glob(test_data.data_dir + "/sort_pipe.*")) == 0
+
+        with gzip.open(test_data.fastq_remap_filename) as f:
+            lines = [x.strip() for x in f.readlines()]
+        assert len(lines) == 4
+
+        l = list(test_data.read1_seqs[0])
+        l[0] = 'C'
+        assert lines[1] == "".join(l)
+        assert lines[3] == test_data.read1_quals[0]
+
+        old_lines = read_bam(test_data.bam_filename)
+        new_lines = read_bam(test_data.bam_remap_filename)
+        assert old_lines == new_lines
+
+        test_data.cleanup()
+
+
+
+    def test_single_one_read_one_snp_metrics(self):
+        """Test that per-chromosome metrics are written as JSON"""
+        test_data = Data()
+        test_data.setup()
+        test_data.index_genome_bowtie2()
+        test_data.map_single_bowtie2()
+        test_data.sam2bam()
+
+        metrics_filename = test_data.output_prefix + ".metrics.json"
+        find_intersecting_snps.main(test_data.bam_filename,
+                                    is_paired_end=False,
+                                    is_sorted=False,
+                                    snp_dir=test_data.snp_dir,
+                                    metrics_filename=metrics_filename,
+                                    progress=1)
+
+        with open(metrics_filename) as f:
+            metrics = json.load(f)
+        os.remove(metrics_filename)
+
+        assert list(metrics['chromosomes'].keys()) == ['test_chrom']
+        chrom_metrics = metrics['chromosomes']['test_chrom']
+        assert chrom_metrics['n_read'] == 1
+        assert chrom_metrics['remap_single'] == 1
+        # one new read is generated for the one SNP
+        assert chrom_metrics['remap_seqs'] == 1
+        assert chrom_metrics['remap_fanout'] == 1.0
+        assert chrom_metrics['time_snp_load'] >= 0.0
+
+        assert metrics['total']['n_read'] == 1
+        assert metrics['total']['remap_single'] == 1
+
+        assert metrics['settings']['processes'] == 1
+        assert metrics['settings']['bam_threads'] == 1
+
+        test_data.cleanup()
+
+
+
     def test_single_two_read_two_snp_two_chrom(self):
         """Test whether having two chromosomes works, with reads
         and SNPs on both works correctly"""
@@ -514,6 +608,151 @@ class TestSingleEnd:
 
         test_data.cleanup()
 
+
+
+    def test_single_two_read_two_snp_two_chrom_processes(self):
+        """Test that using multiple processes gives same output
+        as using a single process, with reads and SNPs on two
+        chromosomes"""
+                        
+        test_data = Data(read1_seqs = ["AAAAAAAAAAAAAAAAAAAAAAAAAAAAAA",
+                                       "GGGGGGGGGGGGGGGGGGGGGGGGGGGGGG"],
+                         read1_quals = ["BBBBBBBBBBBBBBBBBBBBBBBBBBBBBB",
+                                        "BBBBBBBBBBBBBBBBBBBBBBBBBBBBBB"],
+                         genome_seqs = ["AAAAAAAAAAAAAAAAAAAAAAAAAAAAAA\n" +
+                                         "TTTTTTTTTTATTTTTTTTTTTTTTTTTTT",
+                                         "GGGGGGGGGGGGGGGGGGGGGGGGGGGGGG\n" +
+                                         "CCCCCCCCCCGCCCCCCCCCCCCCCCCCCC"],
+                         chrom_names = ['test_chrom1', 'test_chrom2'],
+                         snp_list = [['test_chrom1', 1, "A", "C"],
+                                     ['test_chrom2', 3, "G", "C"]])
+        
+        test_data.setup()
+        test_data.index_genome_bowtie2()
+        test_data.map_single_bowtie2()
+        test_data.sam2bam()
+
+        find_intersecting_snps.main(test_data.bam_filename,
+                                    snp_dir=test_data.snp_dir, is_paired_end=False,
+                                    is_sorted=False)
+
+        with gzip.open(test_data.fastq_remap_filename) as f:
+            fastq_lines = [x.strip() for x in f.readlines()]
+        remap_lines = read_bam(test_data.bam_remap_filename)
+        keep_lines = read_bam(test_data.bam_keep_filename)
+
+        # run again, using two processes
+        find_intersecting_snps.main(test_data.bam_filename,
+                                    snp_dir=test_data.snp_dir, is_paired_end=False,
+                                    is_sorted=False, processes=2)
+
+        #
+        # Verify that output files are the same, and that reads from
+        # both chromosomes are written in the order of the input BAM
+        #
+        with gzip.open(test_data.fastq_remap_filename) as f:
+            lines = [x.strip() for x in f.readlines()]
+        assert len(lines) == 8
+        assert lines == fastq_lines
+        
+        assert read_bam(test_data.bam_remap_filename) == remap_lines
+        assert read_bam(test_data.bam_keep_filename) == keep_lines
+
+        # temporary per-chromosome files should have been removed
+        assert glob.glob(test_data.output_prefix + ".part*") == []
+
+        test_data.cleanup()
+
+
+
+    def test_single_two_read_two_snp_two_chrom_resume(self):
+        """Test that chromosomes completed by an interrupted run are
+        skipped when the run is resumed, and that output is the same
+        as an uninterrupted run"""
+        test_data = Data(read1_seqs = ["AAAAAAAAAAAAAAAAAAAAAAAAAAAAAA",
+                                       "GGGGGGGGGGGGGGGGGGGGGGGGGGGGGG"],
+                         read1_quals = ["BBBBBBBBBBBBBBBBBBBBBBBBBBBBBB",
+                                        "BBBBBBBBBBBBBBBBBBBBBBBBBBBBBB"],
+                         genome_seqs = ["AAAAAAAAAAAAAAAAAAAAAAAAAAAAAA\n" +
+                                         "TTTTTTTTTTATTTTTTTTTTTTTTTTTTT",
+                                         "GGGGGGGGGGGGGGGGGGGGGGGGGGGGGG\n" +
+                                         "CCCCCCCCCCGCCCCCCCCCCCCCCCCCCC"],
+                         chrom_names = ['test_chrom1', 'test_chrom2'],
+                         snp_list = [['test_chrom1', 1, "A", "C"],
+                                     ['test_chrom2', 3, "G", "C"]])
+
+        test_data.setup()
+        test_data.index_genome_bowtie2()
+        test_data.map_single_bowtie2()
+        test_data.sam2bam()
+
+        find_intersecting_snps.main(test_data.bam_filename,
+                                    snp_dir=test_data.snp_dir, is_paired_end=False,
+                                    is_sorted=False)
+
+        with gzip.open(test_data.fastq_remap_filename) as f:
+            fastq_lines = [x.strip() for x in f.readlines()]
+        remap_lines = read_bam(test_data.bam_remap_filename)
+        keep_lines = read_bam(test_data.bam_keep_filename)
+        os.remove(test_data.bam_sort_filename)
+
+        def fail(*args, **kwargs):
+            raise RuntimeError("interrupted")
+
+        merge_part_files = find_intersecting_snps.merge_part_files
+        filter_reads_chrom = find_intersecting_snps.filter_reads_chrom
+        try:
+            # interrupt run after both chromosomes are complete,
+            # but before their output files are merged
+            find_intersecting_snps.merge_part_files = fail
+            try:
+                find_intersecting_snps.main(test_data.bam_filename,
+                                            snp_dir=test_data.snp_dir,
+                                            is_paired_end=False,
+                                            is_sorted=False, resume=True)
+                assert False, "expected run to be interrupted"
+            except RuntimeError:
+                pass
+            find_intersecting_snps.merge_part_files = merge_part_files
+
+            checkpoints = glob.glob(test_data.output_prefix + ".part*" +
+                                    find_intersecting_snps.CHECKPOINT_SUFFIX)
+            assert len(checkpoints) == 2
+
+            # checkpoints should be ignored by a run with settings
+            # that change the output files
+            find_intersecting_snps.filter_reads_chrom = fail
+            try:
+                find_intersecting_snps.main(test_data.bam_filename,
+                                            snp_dir=test_data.snp_dir,
+                                            is_paired_end=False,
+                                            is_sorted=False, resume=True,
+                                            compress_level=0)
+                assert False, "expected chromosomes to be processed again"
+            except RuntimeError:
+                pass
+
+            # resumed run should not process either chromosome again
+            find_intersecting_snps.main(test_data.bam_filename,
+                                        snp_dir=test_data.snp_dir,
+                                        is_paired_end=False,
+                                        is_sorted=False, resume=True)
+        finally:
+            find_intersecting_snps.merge_part_files = merge_part_files
+            find_intersecting_snps.filter_reads_chrom = filter_reads_chrom
+
+        with gzip.open(test_data.fastq_remap_filename) as f:
+            lines = [x.strip() for x in f.readlines()]
+        assert lines == fastq_lines
+        assert read_bam(test_data.bam_remap_filename) == remap_lines
+        assert read_bam(test_data.bam_keep_filename) == keep_lines
+
+        # per-chromosome files and their checkpoints should have
+        # been removed
+        assert glob.glob(test_data.output_prefix + ".part*") == []
+
+        test_data.cleanup()
+
         
 
     def test_single_gapD_read_two_snps(self):
@@ -782,6 +1021,95 @@ class TestSingleEnd:
         assert old_lines[1] == new_lines[0]
 
 
+    def test_single_duplicate_reads_dedup_remap(self):
+        """Test that sequences of a duplicate read are not written
+        for remapping again, and that the duplicate is recorded"""
+        read1_seqs = ["AAAAAAAAAAAAAAAAAAAAAAAAAAAAAA",
+                      "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"]
+        read1_quals = ["BBBBBBBBBBBBBBBBBBBBBBBBBBBBBB",
+                       "BBBBBBBBBBBBBBBBBBBBBBBBBBBBBB"]
+
+        test_data = Data(read1_seqs=read1_seqs,
+                         read1_quals=read1_quals)
+
+        test_data.setup()
+        test_data.index_genome_bowtie2()
+        test_data.map_single_bowtie2()
+        test_data.sam2bam()
+
+        find_intersecting_snps.main(test_data.bam_filename,
+                                    snp_dir=test_data.snp_dir,
+                                    is_paired_end=False, is_sorted=False,
+                                    dedup_remap=True)
+
+        # only one read is written for remapping
+        with gzip.open(test_data.fastq_remap_filename) as f:
+            lines = [x.strip() for x in f.readlines()]
+        assert len(lines) == 4
+        remap_name = lines[0].split(".")[0][1:]
+
+        # but both reads are written to TO.REMAP bam
+        lines = read_bam(test_data.bam_remap_filename)
+        assert len(lines) == 2
+
+        # other read is recorded as duplicate of remapped read
+        with gzip.open(test_data.dups_filename) as f:
+            dup_lines = [x.strip().split("\t") for x in f.readlines()]
+        assert len(dup_lines) == 1
+        assert dup_lines[0][1] == remap_name
+        assert set(dup_lines[0]) == set(["read1", "read2"])
+
+        # duplicate gets same result as read that was remapped
+        keep_reads = set([remap_name])
+        bad_reads = set([])
+        dups = remapdedup.read_dups(test_data.dups_filename)
+        remapdedup.apply_dups(dups, keep_reads, bad_reads)
+        assert keep_reads == set(["read1", "read2"])
+        
+        test_data.cleanup()
+
+
+    def test_single_flip_cache(self):
+        """Test that reads are remapped until the flip cache records
+        that reads like them map back to the same location, and are
+        then kept without remapping"""
+        test_data = Data()
+        test_data.setup()
+        test_data.index_genome_bowtie2()
+        test_data.map_single_bowtie2()
+        test_data.sam2bam()
+
+        for i in range(flipcache.FLIP_CACHE_MIN_PASS + 1):
+            find_intersecting_snps.main(test_data.bam_filename,
+                                        snp_dir=test_data.snp_dir,
+                                        is_paired_end=False, is_sorted=False,
+                                        flip_cache_dir=test_data.flip_cache_dir)
+
+            with gzip.open(test_data.flip_keys_filename) as f:
+                flip_lines = [x.strip().split("\t") for x in f.readlines()]
+
+            if i < flipcache.FLIP_CACHE_MIN_PASS:
+                # read is remapped, and its keys are recorded
+                lines = read_bam(test_data.bam_remap_filename)
+                assert len(lines) == 1
+                assert len(flip_lines) == 1
+                assert flip_lines[0][:2] == ["read1", "test_chrom"]
+
+                # record that remapped read mapped back to same location
+                flipcache.update_flip_cache(test_data.flip_cache_dir,
+                                            test_data.flip_keys_filename,
+                                            set(["read1"]))
+            else:
+                # read is now known to be safe, so is kept
+                lines = read_bam(test_data.bam_keep_filename)
+                assert len(lines) == 1
+                assert lines[0].split("\t")[0] == "read1"
+                assert read_bam(test_data.bam_remap_filename) == ['']
+                assert flip_lines == []
+
+        test_data.cleanup()
+        
+
     def test_single_one_read_two_snps(self):
         """Test whether 1 read overlapping 2 SNPs works correctly"""
         test_data = Data(snp_list = [['test_chrom', 1, "A", "C"],
@@ -1348,6 +1676,65 @@ class TestPairedEnd:
 
 
         
+    def test_paired_collated_two_reads_one_snp(self):
+        """Test that PE reads in name-collated order (as output by
+        the aligner) are processed without sorting"""
+        read1_seqs = ["AACGAAAAGGAGAA",
+                      "AAAAAAATTTAAAA"]
+        read2_seqs = ["AAGAAACAACACAA",
+                      "AAGAAACAACACAA"]
+        read1_quals = ["B" * len(read1_seqs[0]),
+                       "C" * len(read1_seqs[1])]
+        read2_quals = ["D" * len(read2_seqs[0]),
+                       "E" * len(read2_seqs[1])]
+        genome_seq =  ["AAAAAACGAAAAGGAGAAAAAAATTTAAAA\n"
+                       "TTTATTTTTTATTTTTTTGTGTTGTTTCTT"]
+        snp_list = [['test_chrom', 18, "A", "C"]]
+        
+        test_data = Data(genome_seqs=genome_seq,
+                         read1_seqs=read1_seqs,
+                         read2_seqs=read2_seqs,
+                         read1_quals=read1_quals,
+                         read2_quals=read2_quals,
+                         snp_list=snp_list)
+        
+        test_data.setup()
+        test_data.index_genome_bowtie2()
+        test_data.map_paired_bowtie2()
+        test_data.sam2bam()
+
+        find_intersecting_snps.main(test_data.bam_filename,
+                                    snp_dir=test_data.snp_dir, 
+                                    is_paired_end=True, is_collated=True)
+
+        # input should not have been sorted
+        assert not os.path.exists(test_data.bam_sort_filename)
+
+        # same reads should be written as when input is sorted
+        with gzip.open(test_data.fastq1_remap_filename) as f:
+            lines = [x.strip() for x in f.readlines()]
+        assert len(lines) == 8
+        assert lines[1] == "AACGAAAAGGAGAC"
+        assert lines[5] == "ACAAAAATTTAAAA"
+
+        with gzip.open(test_data.fastq2_remap_filename) as f:
+            lines = [x.strip() for x in f.readlines()]
+        assert len(lines) == 8
+        assert lines[1] == test_data.read2_seqs[0]
+        assert lines[5] == test_data.read2_seqs[1]
+
+        old_lines = read_bam(test_data.bam_filename)
+        new_lines = read_bam(test_data.bam_remap_filename)
+        assert old_lines == new_lines
+
+        lines = read_bam(test_data.bam_keep_filename)
+        assert len(lines) == 1
+        assert lines[0] == ''
+
+        test_data.cleanup()
+
+
+        
     def test_paired_two_interleaved_reads_one_snp(self):
         """Test whether PE reads still work correctly 
         when read pairs are interleaved"""
@@ -1428,6 +1815,32 @@ class TestPairedEnd:
         assert len(lines) == 1
         assert lines[0] == ''
 
+        #
+        # Run again with room for only one read in the pair cache,
+        # so that the read waiting for the second mate is spilled
+        # to disk. The same reads should be written, and the spill
+        # should be reported in the metrics
+        #
+        metrics_filename = test_data.output_prefix + ".metrics.json"
+        find_intersecting_snps.main(test_data.bam_filename,
+                                    snp_dir=test_data.snp_dir,
+                                    is_paired_end=True, is_sorted=False,
+                                    pair_cache_size=1,
+                                    metrics_filename=metrics_filename)
+
+        with open(metrics_filename) as f:
+            metrics = json.load(f)
+        os.remove(metrics_filename)
+
+        assert metrics['total']['pair_cache_spill'] > 0
+        assert metrics['chromosomes']['test_chrom']['pair_cache_spill'] > 0
+        assert metrics['total']['discard_missing_pair'] == 0
+
+        with gzip.open(test_data.fastq1_remap_filename) as f:
+            assert [x.strip() for x in f.readlines()] == lines1
+        with gzip.open(test_data.fastq2_remap_filename) as f:
+            assert [x.strip() for x in f.readlines()] == lines2
+
         test_data.cleanup()
 
 
@@ -2608,8 +3021,12 @@ class TestHaplotypesPairedEnd:
                                     haplotype_filename=test_data.haplotype_filename,
                                     is_paired_end=True, is_sorted=False)
 
+        # the second read pair is only generated with the haplotypes
+        # observed across the SNPs of both reads. In particular there is
+        # no haplotype with the reference allele at the first two SNPs
+        # and the alternate allele at the third SNP, so the pair
+        # ("AAAAAAATTTAAAA", "AAAAATACAAAATA") is not generated
         expect_reads = set([("AACGAAAAGGAGAC", "AAGAAACAACACAA"),
-                            ("AAAAAAATTTAAAA", "AAAAATACAAAATA"),
                             ("ACAAAAAGTTAAAA", "AAAAATACAAAATA"),
                             ("ACAAAAAGTTAAAA", "AAAAATAAAAAATA")])
 
@@ -2716,3 +3133,101 @@ class TestHaplotypesPairedEnd:
 
 
 
+
+
+
+
+class TestGenerateReads:
+    """tests for generation of reads with allelic combinations"""
+
+    def test_generate_reads_order(self):
+        """Test that all combinations of alleles are generated, with
+        first SNP varying slowest"""
+        # A->C at position 1, G->T at position 3
+        read_seqs = find_intersecting_snps.generate_reads("AAGAA", [1, 3],
+                                                          [0, 2], [1, 3])
+        assert list(read_seqs) == ["AAGAA", "AATAA", "CAGAA", "CATAA"]
+
+
+    def test_generate_reads_lazy(self):
+        """Test that reads can be obtained without generating
+        all combinations of alleles"""
+        n_snp = 40
+        read_seq = "A" * n_snp
+        read_pos = list(range(1, n_snp+1))
+        ref_alleles = np.zeros(n_snp, dtype=np.uint8)
+        alt_alleles = np.ones(n_snp, dtype=np.uint8)
+
+        read_seqs = find_intersecting_snps.generate_reads(read_seq, read_pos,
+                                                          ref_alleles,
+                                                          alt_alleles)
+        assert next(read_seqs) == "A" * n_snp
+        assert next(read_seqs) == "A" * (n_snp - 1) + "C"
+        assert next(read_seqs) == "A" * (n_snp - 2) + "CA"
+
+
+    def test_generate_haplo_pairs(self):
+        """Test that read pairs are only generated for haplotypes
+        observed across the SNPs of both reads"""
+        # SNPs 0 and 1 overlap first read, SNP 2 overlaps second read.
+        # Last haplotype has unknown allele and is skipped.
+        haplotypes = np.array([[0, 1, 1, 0, 1],
+                               [0, 1, 1, 0, 1],
+                               [0, 1, 1, 0, -1]], dtype=np.int8)
+        ref_alleles = [np.array([0, 0], dtype=np.uint8),
+                       np.array([0], dtype=np.uint8)]
+        alt_alleles = [np.array([1, 1], dtype=np.uint8),
+                       np.array([2], dtype=np.uint8)]
+
+        pairs = find_intersecting_snps.generate_haplo_pairs(
+            ("AAAA", "TTT"), [[0, 1], [2]], [[1, 3], [2]],
+            ref_alleles, alt_alleles, haplotypes)
+
+        # the cross product of the reads generated for each end
+        # would also include ("AAAA", "TGT") and ("CACA", "TAT")
+        assert set(pairs) == set([("AAAA", "TAT"), ("CACA", "TGT")])
+
+        # a read without SNPs is unchanged in every pair
+        pairs = find_intersecting_snps.generate_haplo_pairs(
+            ("AAAA", "TTT"), [[0, 1], []], [[1, 3], []],
+            [ref_alleles[0], ref_alleles[1][:0]],
+            [alt_alleles[0], alt_alleles[1][:0]], haplotypes)
+        assert set(pairs) == set([("AAAA", "TTT"), ("CACA", "TTT")])
+
+
+
+
+
+class TestHaplotypeCache:
+    """tests for cache of unique haplotypes"""
+
+    def test_haplotype_cache(self):
+        haplotypes = np.array([[0, 1, 0, 1],
+                               [0, 0, 0, 0],
+                               [1, 1, 0, 0]], dtype=np.int8)
+
+        hap_cache = find_intersecting_snps.HaplotypeCache(max_size=2)
+
+        haps = hap_cache.get_unique_haplotypes(haplotypes, [0, 1])
+        expected = find_intersecting_snps.get_unique_haplotypes(haplotypes,
+                                                                [0, 1])
+        assert np.array_equal(haps, expected)
+        assert hap_cache.misses == 1
+        assert hap_cache.hits == 0
+
+        # second lookup of same SNPs should come from cache
+        haps = hap_cache.get_unique_haplotypes(haplotypes, [0, 1])
+        assert np.array_equal(haps, expected)
+        assert hap_cache.hits == 1
+
+        # adding two more sets of SNPs should evict [0, 1] from the cache
+        hap_cache.get_unique_haplotypes(haplotypes, [1, 2])
+        hap_cache.get_unique_haplotypes(haplotypes, [0, 2])
+        assert (0, 1) not in hap_cache.cache
+        assert len(hap_cache.cache) == 2
+        assert hap_cache.misses == 3
+
+        hap_cache.clear()
+        assert len(hap_cache.cache) == 0
+        assert hap_cache.hits == 0
+        assert hap_cache.misses == 0
@@ -0,0 +1,94 @@
+import os
+import glob
+
+import numpy as np
+
+import flipcache
+
+
+class TestFlipCache:
+
+    def setup_method(self, method):
+        self.cache_dir = "test_data/flip_cache"
+        self.flip_keys_filename = "test_data/test.remap.flips.txt.gz"
+        if not os.path.exists("test_data"):
+            os.makedirs("test_data")
+
+
+    def teardown_method(self, method):
+        filenames = glob.glob(self.cache_dir + "/*") + \
+                    glob.glob(self.cache_dir + "/.lock") + \
+                    [self.flip_keys_filename]
+        for filename in filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
+        if os.path.exists(self.cache_dir):
+            os.rmdir(self.cache_dir)
+
+
+    def test_get_flip_keys(self):
+        """Test that keys differ by SNP, read length, offset and allele,
+        and that reads that cannot be cached get no keys"""
+        keys = flipcache.get_flip_keys([100], [3], ["AACAA", "AAGAA"])
+        assert len(keys) == 2
+        assert keys == sorted(keys)
+
+        assert flipcache.get_flip_keys([100], [3], ["AAGAA"])[0] == keys[1]
+        assert flipcache.get_flip_keys([101], [3], ["AACAA"])[0] != keys[0]
+        assert flipcache.get_flip_keys([100], [3], ["AACAAA"])[0] != keys[0]
+        assert flipcache.get_flip_keys([100], [2], ["ACAAA"])[0] != keys[0]
+
+        assert flipcache.get_flip_keys([100, 102], [3, 5],
+                                       ["AACAG"]) is None
+        assert flipcache.get_flip_keys([100], [3], ["AANAA"]) is None
+
+
+    def test_update(self):
+        """Test that keys are safe once they have passed enough times,
+        unless they have ever failed"""
+        cache = flipcache.FlipCache(self.cache_dir, min_pass=2)
+        assert not cache.is_safe("chr1", [10])
+
+        cache.update({"chr1" : ([10, 20, 30], [True, True, False]),
+                      "chr2" : ([10], [True])})
+        assert not cache.is_safe("chr1", [10])
+
+        cache.update({"chr1" : ([10, 20, 30, 20], [True, False, True, True])})
+        assert cache.is_safe("chr1", [10])
+        assert not cache.is_safe("chr1", [20])
+        assert not cache.is_safe("chr1", [30])
+        assert not cache.is_safe("chr1", [10, 40])
+        assert not cache.is_safe("chr2", [10])
+
+        # new cache object reads counts from files
+        cache = flipcache.FlipCache(self.cache_dir, min_pass=2)
+        keys, n_pass, n_fail = cache.read_chrom("chr1")
+        assert list(keys) == [10, 20, 30]
+        assert list(n_pass) == [2, 2, 1]
+        assert list(n_fail) == [0, 1, 1]
+        assert cache.is_safe("chr1", [10])
+
+
+    def test_update_flip_cache(self):
+        """Test that reads that were kept pass, and other reads fail"""
+        writer = flipcache.FlipKeyWriter(self.flip_keys_filename)
+        writer.write("read1", "chr1", [10, 11])
+        writer.write("read2", "chr1", [20])
+        writer.write("read3", "chr2", [10])
+        writer.close()
+
+        assert list(flipcache.read_flip_keys(self.flip_keys_filename)) == \
+            [("read1", "chr1", [10, 11]), ("read2", "chr1", [20]),
+             ("read3", "chr2", [10])]
+
+        flipcache.update_flip_cache(self.cache_dir, self.flip_keys_filename,
+                                    set(["read1", "read3"]))
+
+        cache = flipcache.FlipCache(self.cache_dir, min_pass=1)
+        assert cache.is_safe("chr1", [10, 11])
+        assert not cache.is_safe("chr1", [20])
+        assert cache.is_safe("chr2", [10])
+
+        keys, n_pass, n_fail = cache.read_chrom("chr1")
+        assert keys.dtype == np.uint64
+        assert list(n_fail) == [0, 0, 1]
@@ -0,0 +1,176 @@
+import os
+
+import numpy as np
+
+import snptable
+import kmerindex
+
+
+# genome sequence without repeated 5-mers
+GENOME_SEQ = "TCGCCTGATACGAGTCGGTTATCTTCGGAT"
+
+# read from genome, with A>C SNP at read position 8
+READ_SEQ = GENOME_SEQ[5:21]
+ALT_READ_SEQ = READ_SEQ[:7] + "C" + READ_SEQ[8:]
+READ_POS = [8]
+REF_ALLELES = snptable.get_seq_codes("A")
+ALT_ALLELES = snptable.get_seq_codes("C")
+
+
+class TestKmerIndex:
+
+    def setup_method(self, method):
+        self.index_filename = "test_data/test.kmi"
+        if not os.path.exists("test_data"):
+            os.makedirs("test_data")
+
+
+    def teardown_method(self, method):
+        if os.path.exists(self.index_filename):
+            os.remove(self.index_filename)
+
+
+    def build_index(self, seqs, k=5):
+        """builds index of sequences, and returns it read from file"""
+        builder = kmerindex.KmerIndexBuilder(k=k, tmp_dir="test_data",
+                                             bucket_bits=3)
+        for seq in seqs:
+            builder.add_seq(seq)
+        builder.write(self.index_filename)
+        return kmerindex.KmerIndex.read(self.index_filename)
+
+
+    def test_get_kmers(self):
+        """Test that k-mers and their reverse complements are the same,
+        and that k-mers containing N are flagged"""
+        codes = snptable.get_seq_codes("ACGTTNCAACGT").reshape((1, -1))
+        kmers, valid = kmerindex.get_kmers(codes, 4)
+
+        assert kmers.shape == (1, 9)
+        # ACGT is its own reverse complement, CGTT is reverse
+        # complement of AACG
+        assert kmers[0, 0] == kmers[0, 8]
+        assert kmers[0, 1] == kmers[0, 7]
+        assert kmers[0, 0] != kmers[0, 1]
+        assert list(valid[0]) == [True, True, False, False,
+                                  False, False, True, True, True]
+
+
+    def test_build(self):
+        """Test that k-mers seen more than once (on either strand)
+        are stored as repeated, and other k-mers as unique"""
+        codes = snptable.get_seq_codes(GENOME_SEQ).reshape((1, -1))
+        kmers, valid = kmerindex.get_kmers(codes, 5)
+        kmers = kmers[0]
+
+        index = self.build_index([GENOME_SEQ])
+        assert list(index.unique) == sorted(kmers)
+        assert index.repeated.shape[0] == 0
+
+        # lower case sequence is the same, and reverse complement
+        # of first k-mer should be found on a new chromosome
+        index = self.build_index([GENOME_SEQ, GENOME_SEQ[10:20].lower(),
+                                  "NNGGCGA"])
+        is_repeated = kmerindex.in_sorted(index.repeated, kmers)
+        assert list(np.where(is_repeated)[0]) == [0, 10, 11, 12, 13, 14, 15]
+        assert list(index.repeated) == sorted(set(kmers[is_repeated]))
+        assert not np.any(kmerindex.in_sorted(index.unique, kmers[is_repeated]))
+
+        # temporary files should have been removed
+        assert [x for x in os.listdir("test_data")
+                if x.startswith("kmerindex.")] == []
+
+
+    def test_is_unique(self):
+        """Test that reads are unique if k-mers overlapping alternate
+        alleles are absent and other k-mers are not repeated"""
+        index = self.build_index([GENOME_SEQ])
+        assert index.k == 5
+
+        assert index.is_unique([READ_SEQ, ALT_READ_SEQ], READ_POS,
+                               REF_ALLELES, ALT_ALLELES)
+        assert index.is_unique([], READ_POS, REF_ALLELES, ALT_ALLELES)
+
+        # reads containing Ns or shorter than k-mers are not unique
+        n_read_seq = READ_SEQ[:3] + "N" + READ_SEQ[4:]
+        assert not index.is_unique([n_read_seq], READ_POS,
+                                   REF_ALLELES, ALT_ALLELES)
+        assert not index.is_unique([ALT_READ_SEQ[:4]], [], [], [])
+
+        # k-mer of flipped read that overlaps SNP is on another
+        # chromosome, so flipped read could map there
+        index = self.build_index([GENOME_SEQ, ALT_READ_SEQ[5:10]])
+        assert not index.is_unique([READ_SEQ, ALT_READ_SEQ], READ_POS,
+                                   REF_ALLELES, ALT_ALLELES)
+        # but original read would still only map to its location
+        assert index.is_unique([READ_SEQ], READ_POS,
+                               REF_ALLELES, ALT_ALLELES)
+
+        # repeated k-mers away from SNP
+        index = self.build_index([GENOME_SEQ, READ_SEQ[10:]])
+        assert not index.is_unique([ALT_READ_SEQ], READ_POS,
+                                   REF_ALLELES, ALT_ALLELES)
+
+
+    def test_is_unique_short_read(self):
+        """Test that a flipped read is not unique when there is a
+        location that differs from it at a single base, even though
+        they share no k-mers"""
+        np.random.seed(2)
+        genome_seq = "".join(np.random.choice(list("ACGT"), 2000))
+
+        # 36bp read with SNP at read position 18, so every 25-mer of
+        # the read overlaps the SNP
+        read_seq = genome_seq[100:136]
+        ref, alt = read_seq[17], {"A" : "C", "C" : "G",
+                                  "G" : "T", "T" : "A"}[read_seq[17]]
+        alt_read_seq = read_seq[:17] + alt + read_seq[18:]
+        ref_alleles = snptable.get_seq_codes(ref)
+        alt_alleles = snptable.get_seq_codes(alt)
+
+        # paralog that differs from flipped read at read position 21,
+        # which is also covered by every 25-mer of the read
+        other = {"A" : "G", "C" : "T", "G" : "A", "T" : "C"}
+        paralog_seq = alt_read_seq[:20] + other[alt_read_seq[20]] + \
+                      alt_read_seq[21:]
+        index = self.build_index([genome_seq, paralog_seq], k=25)
+
+        codes = snptable.get_seq_codes(alt_read_seq).reshape((1, -1))
+        kmers, valid = kmerindex.get_kmers(codes, 25)
+        assert not np.any(kmerindex.in_sorted(index.unique, kmers))
+        assert not np.any(kmerindex.in_sorted(index.repeated, kmers))
+
+        # flipped read has one mismatch with both the paralog and the
+        # original location, so it must be remapped
+        assert not index.is_unique([read_seq, alt_read_seq], [18],
+                                   ref_alleles, alt_alleles)
+        # original read has no mismatches with its location
+        assert index.is_unique([read_seq], [18], ref_alleles, alt_alleles)
+
+
+    def test_is_unique_large_genome(self):
+        """Test that reads from a genome with many k-mers skip
+        remapping, unless they are from a repeated region. Unlike
+        a hashed index, exact k-mers are never mistaken for present
+        or repeated as the number of k-mers grows"""
+        np.random.seed(1)
+        genome_seq = "".join(np.random.choice(list("ACGT"), 1000000))
+        # copy of first 1000bp at end of genome
+        genome_seq += genome_seq[:1000]
+        index = self.build_index([genome_seq], k=25)
+
+        # reads of length 100 with a SNP in the middle
+        alt_base = {"A" : "C", "C" : "G", "G" : "T", "T" : "A"}
+        def is_unique(start):
+            read_seq = genome_seq[start:start+100]
+            ref, alt = read_seq[49], alt_base[read_seq[49]]
+            alt_read_seq = read_seq[:49] + alt + read_seq[50:]
+            return index.is_unique([read_seq, alt_read_seq], [50],
+                                   snptable.get_seq_codes(ref),
+                                   snptable.get_seq_codes(alt))
+
+        starts = np.random.randint(1000, 1000000 - 100, 200)
+        assert sum(is_unique(start) for start in starts) == 200
+
+        # reads from repeated region must be remapped
+        assert not any(is_unique(start) for start in range(0, 900, 100))
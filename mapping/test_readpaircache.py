@@ -0,0 +1,99 @@
+import os
+import shutil
+
+import readpaircache
+import testreads
+
+
+class TestReadPairCache:
+
+    def test_add_pop(self):
+        """Test that reads can be retrieved from cache by name"""
+        header = testreads.make_header()
+        cache = readpaircache.ReadPairCache(header)
+
+        cache.add(testreads.make_read(header, "pair1", 100, 200))
+        cache.add(testreads.make_read(header, "pair2", 150, 300))
+        assert len(cache) == 2
+        assert "pair1" in cache
+
+        read = cache.pop("pair1")
+        assert read.query_name == "pair1"
+        assert read.reference_start == 100
+        assert cache.pop("pair1") is None
+        assert len(cache) == 1
+        assert cache.peak_size == 2
+
+
+    def test_evict(self):
+        """Test that reads are evicted once their mate position has
+        passed"""
+        header = testreads.make_header()
+        cache = readpaircache.ReadPairCache(header)
+
+        cache.add(testreads.make_read(header, "pair1", 100, 200))
+        cache.add(testreads.make_read(header, "pair2", 150, 300))
+        cache.add(testreads.make_read(header, "pair3", 160, 250))
+
+        # mate of pair1 found, so should not be counted as evicted
+        cache.pop("pair1")
+
+        # mate can still be at position 250
+        assert cache.evict(250) == []
+        assert cache.evict(251) == ["pair3"]
+        assert "pair3" not in cache
+        assert "pair2" in cache
+        assert cache.n_evict == 1
+
+
+    def test_evict_reused_name(self):
+        """Test that a read is not evicted by the heap entry of an
+        earlier read with the same name that was already retrieved"""
+        header = testreads.make_header()
+        cache = readpaircache.ReadPairCache(header)
+
+        cache.add(testreads.make_read(header, "pair1", 100, 200))
+        cache.pop("pair1")
+        cache.add(testreads.make_read(header, "pair1", 300, 400))
+
+        # mate of new read can still be at position 400
+        assert cache.evict(201) == []
+        assert "pair1" in cache
+        assert cache.n_evict == 0
+
+        assert cache.evict(401) == ["pair1"]
+        assert "pair1" not in cache
+
+
+    def test_spill(self):
+        """Test that reads beyond max_size are spilled to disk
+        and can be retrieved"""
+        header = testreads.make_header()
+        tmp_dir = "test_data/pair_cache"
+        if not os.path.exists(tmp_dir):
+            os.makedirs(tmp_dir)
+
+        cache = readpaircache.ReadPairCache(header, max_size=2,
+                                            tmp_dir=tmp_dir)
+        reads = [testreads.make_read(header, "pair%d" % i, 100+i, 200+i)
+                 for i in range(5)]
+        for read in reads:
+            cache.add(read)
+
+        assert len(cache.reads) == 2
+        assert cache.n_spill == 3
+        assert cache.n_spill_total == 3
+        assert len(cache) == 5
+        assert len(os.listdir(tmp_dir)) == 1
+
+        read = cache.pop("pair4")
+        assert read.compare(reads[4]) == 0
+        assert len(cache) == 4
+
+        assert cache.evict(203) == ["pair0", "pair1", "pair2"]
+        assert len(cache) == 1
+
+        assert cache.clear() == 1
+        assert len(os.listdir(tmp_dir)) == 0
+
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,79 @@
+import os
+import glob
+import gzip
+import shutil
+import hashlib
+
+import util
+import refcache
+
+
+class TestRefCache:
+
+    def setup_method(self, method):
+        self.cache_dir = "test_data/ref_cache"
+        self.fasta_filename = "test_data/test_ref.fa.gz"
+        if not os.path.exists("test_data"):
+            os.makedirs("test_data")
+
+        f = gzip.open(self.fasta_filename, "wb")
+        f.write(">chr1 first chromosome\nACGTacgt\nNNAC\n"
+                ">chr2\nTTTT\n")
+        f.close()
+
+        self.env = dict((name, os.environ.get(name))
+                        for name in ["REF_PATH", "REF_CACHE"])
+
+
+    def teardown_method(self, method):
+        for name, value in self.env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+        os.remove(self.fasta_filename)
+
+
+    def test_read_fasta(self):
+        """Test that sequences are read from gzipped FASTA file"""
+        seqs = list(util.read_fasta(self.fasta_filename))
+        assert seqs == [("chr1", "ACGTacgtNNAC"), ("chr2", "TTTT")]
+
+
+    def test_populate_ref_cache(self):
+        """Test that sequences are written in upper case to files
+        named by their MD5"""
+        refcache.populate_ref_cache(self.fasta_filename, self.cache_dir)
+
+        md5 = hashlib.md5("ACGTACGTNNAC").hexdigest()
+        assert refcache.get_seq_md5("ACGTacgtNNAC") == md5
+        seq_filename = os.path.join(self.cache_dir, md5[:2], md5[2:4],
+                                    md5[4:])
+        assert open(seq_filename).read() == "ACGTACGTNNAC"
+
+        md5 = hashlib.md5("TTTT").hexdigest()
+        assert open(refcache.get_seq_filename(self.cache_dir, md5)).read() \
+            == "TTTT"
+
+        # no temporary files are left behind
+        assert glob.glob(self.cache_dir + "/*/*/.tmp.*") == []
+
+        # cache is not populated again from the same file
+        os.remove(seq_filename)
+        refcache.populate_ref_cache(self.fasta_filename, self.cache_dir)
+        assert not os.path.exists(seq_filename)
+
+
+    def test_use_ref_cache(self):
+        """Test that htslib is pointed at the reference cache"""
+        refcache.use_ref_cache(self.cache_dir, self.fasta_filename)
+
+        ref_path = os.path.abspath(self.cache_dir) + "/%2s/%2s/%s"
+        assert os.environ["REF_PATH"] == ref_path
+        assert os.environ["REF_CACHE"] == ref_path
+
+        md5 = hashlib.md5("TTTT").hexdigest()
+        assert os.path.exists(refcache.get_seq_filename(self.cache_dir, md5))
@@ -0,0 +1,93 @@
+import os
+import shutil
+
+import pysam
+
+import remapindex
+import filter_remapped_reads
+import testreads
+
+
+class TestRemapIndex:
+
+    def setup_method(self, method):
+        self.data_dir = "test_data/remapindex"
+        if not os.path.exists(self.data_dir):
+            os.makedirs(self.data_dir)
+
+        # write input BAM with many reads, so that they span
+        # several BGZF blocks
+        self.bam_filename = self.data_dir + "/input.bam"
+        header = testreads.make_header()
+        bam = pysam.AlignmentFile(self.bam_filename, "wb", header=header)
+        self.n_read = 20000
+        for i in range(self.n_read):
+            bam.write(testreads.make_read(header, "read%d" % i, i))
+        bam.close()
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.data_dir)
+
+
+    def write_index(self, index_filename, names):
+        """writes index for reads with provided names, getting offsets
+        in same way as find_intersecting_snps.filter_reads"""
+        writer = remapindex.RemapIndexWriter(index_filename,
+                                             self.bam_filename)
+        bam = pysam.AlignmentFile(self.bam_filename, "rb")
+        next_offset = bam.tell()
+        for read in bam:
+            offset = next_offset
+            next_offset = bam.tell()
+            writer.set_offset(read, offset)
+            if read.query_name in names:
+                writer.write(read)
+            writer.discard_offsets([read])
+        bam.close()
+        writer.close()
+
+
+    def test_read_write(self):
+        """Test that offsets written to index retrieve the right reads"""
+        index_filename = self.data_dir + "/test.to.remap.idx"
+        names = ["read0", "read5000", "read19999"]
+        self.write_index(index_filename, set(names))
+
+        assert remapindex.is_remap_index(index_filename)
+        assert not remapindex.is_remap_index(self.bam_filename)
+
+        bam_filename, records = remapindex.read_remap_index(index_filename)
+        assert bam_filename == os.path.abspath(self.bam_filename)
+        assert len(records) == 3
+
+        bam = pysam.AlignmentFile(bam_filename, "rb")
+        for name, record in zip(names, records):
+            assert record['name_hash'] == remapindex.name_hash(name)
+            bam.seek(int(record['offset']))
+            assert next(bam).query_name == name
+        bam.close()
+
+
+    def test_write_reads_from_index(self):
+        """Test that kept reads are written using the index"""
+        index_filename = self.data_dir + "/test.to.remap.idx"
+        self.write_index(index_filename,
+                         set(["read10", "read11", "read12", "read15000"]))
+
+        keep_filename = self.data_dir + "/keep.bam"
+        template = pysam.AlignmentFile(self.bam_filename, "rb")
+        keep_bam = pysam.AlignmentFile(keep_filename, "wb", template=template)
+        template.close()
+
+        # read12 is both kept and bad (e.g. a duplicate read whose
+        # canonical read mapped elsewhere), so it should not be written
+        filter_remapped_reads.write_reads_from_index(
+            index_filename, keep_bam, set(["read10", "read12", "read15000"]),
+            set(["read11", "read12"]))
+        keep_bam.close()
+
+        keep_bam = pysam.AlignmentFile(keep_filename, "rb")
+        names = [read.query_name for read in keep_bam]
+        keep_bam.close()
+        assert names == ["read10", "read15000"]
@@ -0,0 +1,151 @@
+import os
+import sys
+import shutil
+
+import pytest
+
+import remapstream
+
+
+# Stub aligner that reads fastq files and writes SAM to stdout. Each
+# read is 'mapped' to the coordinate given in its name (see
+# find_intersecting_snps.write_fastq), unless its name starts with
+# 'bad', in which case it is mapped to position 1
+STUB_ALIGNER = r'''
+import sys
+
+def read_fastq(path):
+    f = open(path)
+    while True:
+        lines = [f.readline().strip() for i in range(4)]
+        if not lines[0]:
+            break
+        yield lines[0][1:], lines[1], lines[3]
+    f.close()
+
+def get_pos(name):
+    if name.startswith("bad"):
+        return [1, 1]
+    return [int(x) for x in name.split(".")[-3].split("-")]
+
+sys.stdout.write("@HD\tVN:1.0\n@SQ\tSN:chr1\tLN:100000\n")
+
+if len(sys.argv) == 2:
+    for name, seq, qual in read_fastq(sys.argv[1]):
+        pos = get_pos(name)[0]
+        sys.stdout.write("%s\t0\tchr1\t%d\t30\t%dM\t*\t0\t0\t%s\t%s\n" %
+                         (name, pos, len(seq), seq, qual))
+else:
+    for rec1, rec2 in zip(read_fastq(sys.argv[1]), read_fastq(sys.argv[2])):
+        pos = get_pos(rec1[0])
+        for flag, rec, p1, p2 in ((99, rec1, pos[0], pos[-1]),
+                                  (147, rec2, pos[-1], pos[0])):
+            sys.stdout.write("%s\t%d\tchr1\t%d\t30\t%dM\t=\t%d\t0\t%s\t%s\n" %
+                             (rec[0], flag, p1, len(rec[1]), p2,
+                              rec[1], rec[2]))
+'''
+
+
+def fastq_record(name, seq="ACGTACGTAC"):
+    return "@%s\n%s\n+%s\n%s\n" % (name, seq, name, "I" * len(seq))
+
+
+
+class TestRemapStream:
+
+    def setup_method(self, method):
+        self.data_dir = "test_data/remapstream"
+        if not os.path.exists(self.data_dir):
+            os.makedirs(self.data_dir)
+
+        self.aligner = self.data_dir + "/stub_aligner.py"
+        f = open(self.aligner, "w")
+        f.write(STUB_ALIGNER)
+        f.close()
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.data_dir)
+
+
+    def test_single(self):
+        """Test that single-end reads are streamed to aligner and
+        its output is filtered"""
+        command = "%s %s {fastq}" % (sys.executable, self.aligner)
+        stream = remapstream.RemapStream(command, False,
+                                         tmp_dir=self.data_dir)
+
+        # write enough reads that several blocks are written to pipe
+        n_read = remapstream.PIPE_BLOCK_RECORDS * 3
+        for i in range(n_read):
+            stream.fastq_single.write(fastq_record("read%d.%d.1.1" %
+                                                   (i, i+100)))
+        stream.fastq_single.write(fastq_record("bad1.100.1.2"))
+        stream.fastq_single.write(fastq_record("bad1.100.2.2"))
+        stream.fastq_single.close()
+
+        keep_reads, bad_reads = stream.finish()
+
+        assert len(keep_reads) == n_read
+        assert "read0" in keep_reads
+        assert bad_reads == set(["bad1"])
+
+        # named pipes should be removed
+        assert not os.path.exists(stream.pipe_dir)
+
+
+    def test_paired(self):
+        """Test that read pairs are streamed to aligner through
+        two pipes"""
+        command = "%s %s {fastq1} {fastq2}" % (sys.executable, self.aligner)
+        stream = remapstream.RemapStream(command, True,
+                                         tmp_dir=self.data_dir)
+
+        n_read = remapstream.PIPE_BLOCK_RECORDS * 2 + 1
+        for i in range(n_read):
+            name = "pair%d.%d-%d.1.1" % (i, i+100, i+300)
+            stream.fastq1.write(fastq_record(name))
+            stream.fastq2.write(fastq_record(name))
+        stream.fastq1.close()
+        stream.fastq2.close()
+
+        keep_reads, bad_reads = stream.finish()
+
+        assert len(keep_reads) == n_read
+        assert len(bad_reads) == 0
+
+
+    def test_no_reads(self):
+        """Test that aligner receives end of file when no
+        reads are written"""
+        command = "%s %s {fastq}" % (sys.executable, self.aligner)
+        stream = remapstream.RemapStream(command, False,
+                                         tmp_dir=self.data_dir)
+        stream.fastq_single.close()
+
+        keep_reads, bad_reads = stream.finish()
+        assert len(keep_reads) == 0
+        assert len(bad_reads) == 0
+
+
+    def test_aligner_fails(self):
+        """Test that an error is raised if aligner fails"""
+        command = "cat {fastq} > /dev/null; exit 3"
+        stream = remapstream.RemapStream(command, False,
+                                         tmp_dir=self.data_dir)
+        stream.fastq_single.write(fastq_record("read1.100.1.1"))
+        stream.fastq_single.close()
+
+        with pytest.raises(Exception):
+            stream.finish()
+
+
+    def test_missing_placeholder(self):
+        """Test that command without pipe placeholders is rejected"""
+        with pytest.raises(ValueError):
+            remapstream.RemapStream("bowtie2 -U reads.fq", False,
+                                    tmp_dir=self.data_dir)
+
+        with pytest.raises(ValueError):
+            remapstream.RemapStream("bowtie2 -U {fastq}", True,
+                                    tmp_dir=self.data_dir)
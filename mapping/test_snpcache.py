@@ -0,0 +1,117 @@
+import os
+import shutil
+
+import numpy as np
+import tables
+
+import snptable
+import snpcache
+from test_find_intersecting_snps import Data
+
+
+class TestSNPTableCache:
+
+    def setup_method(self, method):
+        self.data = Data(snp_list=[['test_chrom', 1, "A", "C"],
+                                   ['test_chrom', 15, "T", "-"]],
+                         hap_samples=["samp1", "samp2", "samp3"],
+                         haplotypes=[[0, 1, 0, 0, 1, 1],
+                                     [1, 1, -1, 0, 1, 1]])
+        self.data.setup()
+        self.cache_dir = self.data.data_dir + "/snp_cache"
+
+        self.snp_tab_h5 = tables.openFile(self.data.snp_tab_filename, "r")
+        self.snp_index_h5 = tables.openFile(self.data.snp_index_filename, "r")
+        self.hap_h5 = tables.openFile(self.data.haplotype_filename, "r")
+
+
+    def teardown_method(self, method):
+        self.snp_tab_h5.close()
+        self.snp_index_h5.close()
+        self.hap_h5.close()
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+        self.data.cleanup()
+
+
+    def test_read(self):
+        """Test that SNPs read through the cache match those read
+        from the HDF5 files, and that cached arrays are memory-mapped"""
+        h5_tab = snptable.SNPTable()
+        h5_tab.read_h5(self.snp_tab_h5, self.snp_index_h5, self.hap_h5,
+                       "test_chrom")
+
+        cache = snpcache.SNPTableCache(self.cache_dir, self.snp_tab_h5,
+                                       self.snp_index_h5, self.hap_h5)
+        assert not os.path.exists(cache.get_chrom_dir("test_chrom"))
+
+        # first read builds cache, second reads existing cache
+        for i in range(2):
+            snp_tab = snptable.SNPTable()
+            cache.read(snp_tab, "test_chrom")
+            assert os.path.exists(cache.get_chrom_dir("test_chrom"))
+
+            assert isinstance(snp_tab.snp_pos, np.memmap)
+            assert isinstance(snp_tab.haplotypes.packed, np.memmap)
+            assert snp_tab.n_snp == 2
+            assert list(snp_tab.snp_pos) == list(h5_tab.snp_pos)
+            assert list(snp_tab.snp_allele2) == list(h5_tab.snp_allele2)
+            assert list(snp_tab.snp_is_indel) == [False, True]
+            assert snp_tab.samples == h5_tab.samples
+            assert len(snp_tab.index) == len(h5_tab.index)
+            assert np.all(snp_tab.haplotypes[:,:] == h5_tab.haplotypes[:,:])
+
+            # lookups should work on memory-mapped index
+            pos, idx = snp_tab.index.lookup(10, 20)
+            assert list(pos) == [15]
+            assert list(idx) == [1]
+
+        # chromosome without SNPs is cached as empty
+        snp_tab = snptable.SNPTable()
+        cache.read(snp_tab, "no_chrom")
+        assert snp_tab.n_snp == 0
+        assert snp_tab.haplotypes is None
+
+
+    def test_read_samples(self):
+        """Test that SNPs polymorphic in a set of samples are cached
+        separately, keyed on the set of samples"""
+        samples = ["samp3", "samp1"]
+        h5_tab = snptable.SNPTable()
+        h5_tab.read_h5(self.snp_tab_h5, self.snp_index_h5, self.hap_h5,
+                       "test_chrom", samples=samples)
+        # second SNP is not polymorphic in samp1 and samp3
+        assert h5_tab.n_snp == 1
+
+        cache = snpcache.SNPTableCache(self.cache_dir, self.snp_tab_h5,
+                                       self.snp_index_h5, self.hap_h5)
+        chrom_dir = cache.get_chrom_dir("test_chrom", samples)
+        assert chrom_dir != cache.get_chrom_dir("test_chrom")
+        assert chrom_dir == cache.get_chrom_dir("test_chrom",
+                                                ["samp1", "samp3"])
+
+        snp_tab = snptable.SNPTable()
+        cache.read(snp_tab, "test_chrom", samples=samples)
+        assert os.path.exists(chrom_dir)
+        assert not os.path.exists(cache.get_chrom_dir("test_chrom"))
+
+        assert list(snp_tab.snp_pos) == list(h5_tab.snp_pos)
+        assert snp_tab.samples == ["samp1", "samp3"]
+        assert snp_tab.haplotypes.shape == (1, 4)
+        assert np.all(snp_tab.haplotypes[:,:] == h5_tab.haplotypes[:,:])
+        assert len(snp_tab.index) == len(h5_tab.index)
+
+
+    def test_source_key(self):
+        """Test that cache is keyed on HDF5 files, so it is not used
+        once they change"""
+        cache = snpcache.SNPTableCache(self.cache_dir, self.snp_tab_h5,
+                                       self.snp_index_h5, self.hap_h5)
+
+        st = os.stat(self.data.haplotype_filename)
+        os.utime(self.data.haplotype_filename,
+                 (st.st_atime, st.st_mtime + 10))
+
+        new_cache = snpcache.SNPTableCache(self.cache_dir, self.snp_tab_h5,
+                                           self.snp_index_h5, self.hap_h5)
+        assert new_cache.cache_dir != cache.cache_dir
@@ -128,6 +128,87 @@ class TestReadFile(object):
         assert snp_tab.snp_pos[3] == 3
 
 
+    def test_allele_codes(self):
+        data = Data()
+        data.snp_list = [(10, "A", "C"),
+                         (20, "A", "ATTG"), # 3bp insertion
+                         (21, "G", "T"), # not an indel
+                         (30, "T", "-")] # 1bp deletion
+        data.setup()
+
+        snp_tab = snptable.SNPTable()
+        snp_tab.read_file(data.snp_filename)
+
+        # check that indels are flagged
+        assert list(snp_tab.snp_is_indel) == [False, True, False, True]
+
+        # check that alleles are encoded as nucleotide codes,
+        # with indels given undefined code
+        assert list(snp_tab.snp_code1) == [0, 0, 2, 3]
+        assert list(snp_tab.snp_code2) == [1, snptable.NUC_UNDEF, 3,
+                                           snptable.NUC_UNDEF]
+
+        assert list(snptable.get_seq_codes("ACGTNa")) == \
+            [0, 1, 2, 3, snptable.NUC_UNDEF, snptable.NUC_UNDEF]
+
+
+    def test_read_extra_columns(self):
+        """Test that lines with more than 3 values are still read"""
+        data = Data()
+        data.setup()
+
+        snp_file = gzip.open(data.snp_filename, "wb")
+        snp_file.write("10 a C extra\n20 T - \n100 A T extra more\n")
+        snp_file.close()
+
+        snp_tab = snptable.SNPTable()
+        snp_tab.read_file(data.snp_filename)
+
+        assert list(snp_tab.snp_pos) == [10, 20, 100]
+        assert list(snp_tab.snp_allele1) == ["A", "T", "A"]
+        assert list(snp_tab.snp_allele2) == ["C", "", "T"]
+
+
+    def test_read_cache(self):
+        """Test that binary cache is written, used and replaced
+        when the text file changes"""
+        data = Data(snp_filename="test_data/snp_tab_cache.txt.gz")
+        data.setup()
+        cache_filename = data.snp_filename + snptable.SNP_CACHE_SUFFIX
+        if os.path.exists(cache_filename):
+            os.remove(cache_filename)
+
+        try:
+            snp_tab = snptable.SNPTable()
+            snp_tab.read_file(data.snp_filename, use_cache=True)
+            assert os.path.exists(cache_filename)
+
+            # SNPs read from cache should be same as from text file
+            cache_tab = snptable.SNPTable()
+            assert cache_tab.read_cache(data.snp_filename)
+            assert list(cache_tab.snp_pos) == list(snp_tab.snp_pos)
+            assert list(cache_tab.snp_allele2) == list(snp_tab.snp_allele2)
+            assert list(cache_tab.snp_code1) == list(snp_tab.snp_code1)
+            assert cache_tab.snp_index[19] == 1
+
+            # cache should not be used once text file changes
+            data.snp_list = [(15, "G", "A")]
+            data.setup()
+            st = os.stat(data.snp_filename)
+            os.utime(data.snp_filename, (st.st_atime, st.st_mtime + 10))
+            assert not cache_tab.read_cache(data.snp_filename)
+
+            snp_tab.read_file(data.snp_filename, use_cache=True)
+            assert list(snp_tab.snp_pos) == [15]
+            assert cache_tab.read_cache(data.snp_filename)
+            assert list(cache_tab.snp_pos) == [15]
+        finally:
+            for filename in [cache_filename, data.snp_filename]:
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+        
+
 class TestGetOverlappingSNPs:
         
     def test_get_overlapping_snps_simple(self):
@@ -251,3 +332,176 @@ class TestGetOverlappingSNPs:
 
     
 
+
+
+
+class TestGetOverlappingSNPsBatch:
+
+    def test_batch_matches_single_read(self):
+        """Test that looking up overlapping SNPs for a block of reads
+        gives same results as looking them up one read at a time"""
+        data = Data()
+        data.snp_list = [(10, "A", "C"),
+                         (12, "A", "-"), # 1bp deletion
+                         (20, "T", "G"),
+                         (25, "AAA", "A"), # 2bp deletion
+                         (100, "A", "T")]
+        data.setup()
+
+        sam_file = open(data.sam_filename, "w")
+        data.write_sam_header(sam_file)
+        data.write_sam_read(sam_file, read_name="read1", cigar="30M")
+        data.write_sam_read(sam_file, read_name="read2", cigar="10M85N20M")
+        data.write_sam_read(sam_file, read_name="read3", cigar="10S20M")
+        data.write_sam_read(sam_file, read_name="read4", cigar="11M3D19M")
+        data.write_sam_read(sam_file, read_name="read5", cigar="5M2I23M",
+                            pos=5)
+        data.write_sam_read(sam_file, read_name="read6", cigar="30M",
+                            pos=40)
+        sam_file.close()
+
+        sam_file = pysam.Samfile(data.sam_filename)
+        reads = [read for read in sam_file]
+
+        snp_tab = snptable.SNPTable()
+        snp_tab.read_file(data.snp_filename)
+
+        overlaps = snp_tab.get_overlapping_snps_reads(reads)
+        assert len(overlaps) == len(reads)
+
+        for read, read_overlaps in zip(reads, overlaps):
+            expected = snp_tab.get_overlapping_snps(read)
+            assert [list(x) for x in expected] == \
+                [list(x) for x in read_overlaps]
+
+        # check a couple of results explicitly
+        # read4 has SNP at 10 before deletion and indels at 12, 25
+        snp_idx, snp_read_pos, indel_idx, indel_read_pos = overlaps[3]
+        assert snp_idx == [0, 2]
+        assert snp_read_pos == [10, 17]
+        assert indel_idx == [1, 3]
+        assert indel_read_pos == [11, 22]
+
+        # read6 does not overlap any SNPs
+        assert overlaps[5] == ([], [], [], [])
+
+
+        
+    def test_batch_bad_query_length(self):
+        """Test that error is raised when CIGAR does not add up
+        to length of read"""
+        data = Data()
+        data.setup()
+
+        snp_tab = snptable.SNPTable()
+        snp_tab.read_file(data.snp_filename)
+
+        try:
+            snp_tab.get_overlapping_snps_batch([0, 0], [1, 1],
+                                               [snptable.BAM_CMATCH,
+                                                snptable.BAM_CMATCH],
+                                               [30, 20], [30, 30])
+            assert False, "expected ValueError"
+        except ValueError:
+            pass
+
+
+
+class TestSNPIndex:
+
+    def test_lookup(self):
+        """Test that sparse index gives same SNPs as a dense index"""
+        dense = np.array([-1, 0, -1, -1, 2, 1, -1, -1], dtype=np.int32)
+        index = snptable.SNPIndex.from_dense(dense)
+
+        assert len(index) == 8
+        assert list(index.pos) == [2, 5, 6]
+        assert list(index.idx) == [0, 2, 1]
+        assert np.array_equal(index.to_dense(), dense)
+
+        for start in range(1, 9):
+            for end in range(start, 9):
+                pos, idx = index.lookup(start, end)
+                offsets = np.where(dense[start-1:end] != -1)[0]
+                assert list(pos) == list(offsets + start)
+                assert list(idx) == list(dense[start-1:end][offsets])
+
+
+    def test_from_snp_pos(self):
+        """Test that index made from unsorted SNP positions is sorted
+        and that last SNP is used where positions are duplicated"""
+        index = snptable.SNPIndex.from_snp_pos(np.array([20, 10, 20, 5]))
+
+        assert list(index.pos) == [5, 10, 20]
+        assert list(index.idx) == [3, 1, 2]
+        assert len(index) == 20
+
+        
+
+    def test_in_snp_blocks(self):
+        """Test that regions not flagged by SNP block bitset 
+        do not overlap SNPs, and that regions overlapping SNPs
+        are flagged"""
+        index = snptable.SNPIndex.from_snp_pos(np.array([70, 1000, 1001]))
+
+        start = np.arange(0, 1100, 7)
+        end = start + 50
+        touches = index.in_snp_blocks(start, end)
+
+        for s, e, t in zip(start, end, touches):
+            pos, idx = index.lookup(s+1, e)
+            if not t:
+                assert len(pos) == 0
+            if len(pos) > 0:
+                assert t
+
+        # blocks 1 (64-127) and 15 (960-1023) contain SNPs
+        assert list(index.in_snp_blocks(np.array([0, 64, 128, 900]),
+                                        np.array([64, 65, 640, 961]))) == \
+            [False, True, False, True]
+
+        # regions spanning many blocks are always flagged
+        assert index.in_snp_blocks(np.array([128]), np.array([900]))[0]
+
+        
+
+class TestPackedHaplotypes:
+
+    def test_pack_unpack(self):
+        """Test that packed haplotypes give back original values"""
+        haps = np.array([[0, 1, -1, 1, 0],
+                         [1, 1, 1, 1, 1],
+                         [-1, 0, 0, 1, -1]], dtype=np.int8)
+        packed = snptable.PackedHaplotypes(haps)
+
+        assert packed.shape == (3, 5)
+        assert packed.packed.shape == (3, 2)
+        assert np.array_equal(packed[:, :], haps)
+        assert np.array_equal(packed[[2, 0], :], haps[[2, 0], :])
+        assert np.array_equal(packed[:, np.array([4, 0, 2])],
+                              haps[:, np.array([4, 0, 2])])
+        assert np.array_equal(packed[1], haps[1])
+
+        ref_count, alt_count = packed.count_alleles()
+        assert list(ref_count) == [2, 0, 2]
+        assert list(alt_count) == [2, 5, 1]
+
+        rows = packed.take_rows(np.array([True, False, True]))
+        assert np.array_equal(rows[:, :], haps[[0, 2], :])
+
+
+    def test_unique_columns(self):
+        """Test that unique haplotypes are same, and in same order,
+        as those obtained with np.unique on raw bytes"""
+        haps = np.array([[0, 1, -1, 1, 0, 0],
+                         [1, 1, 1, 1, 1, -1],
+                         [-1, 0, 0, 0, -1, 0]], dtype=np.int8)
+        packed = snptable.PackedHaplotypes(haps)
+        
+        for snp_idx in ([0], [0, 1], [2, 1], [0, 1, 2]):
+            h = haps[snp_idx,:].T
+            v = np.ascontiguousarray(h).view(np.dtype((np.void,
+                                                       h.shape[1])))
+            _, idx = np.unique(v, return_index=True)
+            assert np.array_equal(packed.get_unique_columns(snp_idx),
+                                  h[idx,:])
@@ -0,0 +1,36 @@
+import pysam
+
+
+# length of the single chromosome in headers made by make_header
+TEST_CHROM_LEN = 100000
+
+
+def make_header(chrom_len=TEST_CHROM_LEN):
+    """returns header of coordinate-sorted BAM file with a single
+    chromosome, chr1, for tests that make their own reads"""
+    return pysam.AlignmentHeader.from_dict({'HD' : {'VN' : '1.0',
+                                                    'SO' : 'coordinate'},
+                                            'SQ' : [{'SN' : 'chr1',
+                                                     'LN' : chrom_len}]})
+
+
+def make_read(header, name, pos, mate_pos=None, flag=None):
+    """returns read of length 10 on chr1 starting at pos (0-based).
+    If mate_pos is provided, the read is the first read of a proper
+    pair (flag 99 unless another flag is given) with its mate on
+    chr1 at mate_pos. Otherwise it is an unpaired read (flag 0)"""
+    read = pysam.AlignedSegment(header)
+    read.query_name = name
+    read.reference_id = 0
+    read.reference_start = pos
+    if mate_pos is None:
+        read.flag = 0 if flag is None else flag
+    else:
+        read.flag = 99 if flag is None else flag
+        read.next_reference_id = 0
+        read.next_reference_start = mate_pos
+    read.mapping_quality = 30
+    read.cigartuples = [(0, 10)]
+    read.query_sequence = "ACGTACGTAC"
+    read.query_qualities = pysam.qualitystring_to_array("IIIIIIIIII")
+    return read
@@ -1,7 +1,10 @@
 import sys
+import gzip
 import string
-import subprocess
 import os
+import errno
+import tempfile
+import multiprocessing
 
 
 DNA_COMP = None
@@ -21,45 +24,140 @@ def revcomp(seq_str):
     return comp(seq_str)[::-1]
 
         
-def sort_bam(input_bam, output_prefix):
-    """Calls samtools sort on input_bam filename and writes to
-    output_bam. Takes into account that the command line arguments 
-    for samtools sort have changed between versions."""
+# default number of threads and maximum memory per thread used
+# to sort BAM files
+SORT_THREADS_DEFAULT = 1
+SORT_MEMORY_DEFAULT = "768M"
+
+
+def get_sort_args(input_bam, output_bam, tmp_prefix,
+                  threads=SORT_THREADS_DEFAULT, memory=SORT_MEMORY_DEFAULT,
+                  reference=None):
+    """returns arguments for samtools sort (as called through pysam).
+    A reference FASTA file is needed to sort CRAM files"""
+    # samtools -@ option gives number of threads in addition to main thread
+    args = ["-@", str(max(threads - 1, 0)), "-m", memory,
+            "-T", tmp_prefix]
+    if reference:
+        args.extend(["--reference", reference])
+    return args + ["-o", output_bam, input_bam]
+
+
+def sort_bam(input_bam, output_prefix, threads=SORT_THREADS_DEFAULT,
+             memory=SORT_MEMORY_DEFAULT, reference=None):
+    """Sorts input_bam filename by coordinate using the samtools
+    sort bindings in pysam, and writes to output_prefix.sort.bam.
+    memory is the maximum memory per thread (e.g. 768M or 2G).
+    Returns name of sorted BAM file."""
+    import pysam
 
     output_bam = output_prefix + ".sort.bam"
-    
-    # first try new way of using samtools sort
-    failed = False
-    cmd = "samtools sort -o " + output_bam + " " + input_bam
-    sys.stderr.write("running command: %s\n" % cmd)
-    try:
-        subprocess.check_call(cmd, shell=True)
-    except Exception as e:
-        sys.stderr.write("samtools sort command failed:\n%s\n" %
-                         str(e))
-        failed = True
+    args = get_sort_args(input_bam, output_bam, output_prefix + ".sort.tmp",
+                         threads, memory, reference)
+    sys.stderr.write("sorting BAM file: samtools sort %s\n" % " ".join(args))
+    pysam.sort(*args)
+
     if not os.path.exists(output_bam):
-        sys.stderr.write("output file %s does not exist\n" % output_bam)
-        failed = True
-        
-    if failed:
-        # OLD way of calling samtools (changed in newer versions)
-        sys.stderr.write("samtools sort command failed, trying old samtools "
-                         "syntax\n")
-        
-        cmd = "samtools sort " + input_bam + " " + output_prefix
-        sys.stderr.write("running command: %s\n" % cmd)
-
-        try:
-            subprocess.check_call(cmd, shell=True)
-        except Exception as e:
-            sys.stderr.write("samtools sort command failed:\n%s\n" %
-                             str(e))
-            exit(1)
-        
-        if not os.path.exists(paths.sorted_output_bam):
-            raise IOError("Failed to create sorted BAM file '%s'" %
-                          paths.sorted_output_bam)
+        raise IOError("Failed to create sorted BAM file '%s'" % output_bam)
+
+    return output_bam
+
+
+
+def sort_to_pipe(args, pipe_path):
+    """runs samtools sort with provided arguments, which write output
+    to a named pipe (run in child process by start_sort_bam)"""
+    import pysam
+
+    try:
+        pysam.sort(*args)
+    except:
+        # open and close the pipe so that the reader
+        # sees end of file rather than waiting forever
+        f = open(pipe_path, "wb")
+        f.close()
+        raise
+
+
+
+def start_sort_bam(input_bam, output_prefix, threads=SORT_THREADS_DEFAULT,
+                   memory=SORT_MEMORY_DEFAULT, reference=None):
+    """Starts sorting input_bam in a child process, which writes the
+    sorted reads to a named pipe instead of a file. Returns the path
+    to the pipe and the multiprocessing.Process that is sorting. The
+    sorted reads should be read from the pipe, then the process
+    joined and its exitcode checked. The pipe is in a temporary
+    directory, which should be removed afterwards."""
+    pipe_dir = tempfile.mkdtemp(prefix="sort_pipe.",
+                                dir=os.path.dirname(output_prefix) or None)
+    pipe_path = os.path.join(pipe_dir, "sort.bam")
+    os.mkfifo(pipe_path)
+
+    args = get_sort_args(input_bam, pipe_path, output_prefix + ".sort.tmp",
+                         threads, memory, reference)
+    sys.stderr.write("sorting BAM file: samtools sort %s\n" % " ".join(args))
+    proc = multiprocessing.Process(target=sort_to_pipe,
+                                   args=(args, pipe_path))
+    proc.start()
+
+    return pipe_path, proc
+
+
+
+# default number of threads used by htslib to decompress or
+# compress each BAM file
+BAM_THREADS_DEFAULT = 1
+
+
+def is_cram(filename):
+    """returns True if filename has CRAM extension"""
+    return filename.endswith(".cram")
+
+
+def open_bam(filename, mode="r", template=None, threads=BAM_THREADS_DEFAULT,
+             reference=None):
+    """Opens SAM, BAM or CRAM file with pysam. Files with names ending
+    in .cram are read or written as CRAM (a binary mode such as "rb"
+    or "wb" is changed to the CRAM mode), which requires the reference
+    FASTA file to be provided (unless it is found through the reference
+    cache set up by refcache.use_ref_cache). If threads is greater than
+    1, htslib uses this many threads to decompress or compress the
+    file, rather than doing this on the main thread (this requires
+    pysam 0.10.0 or later)."""
+    import pysam
+
+    if is_cram(filename) and mode in ("rb", "wb"):
+        mode = mode[0] + "c"
+
+    kwargs = {}
+    if template is not None:
+        kwargs['template'] = template
+    if threads > 1:
+        kwargs['threads'] = threads
+    if reference:
+        kwargs['reference_filename'] = reference
+    return pysam.Samfile(filename, mode, **kwargs)
+
+
+def add_bam_threads_option(parser):
+    """adds --threads option, giving number of threads used to
+    decompress and compress each input and output BAM file, to an
+    argparse parser"""
+    parser.add_argument("--threads", type=int, default=BAM_THREADS_DEFAULT,
+                        help="Number of threads used by htslib to "
+                        "decompress and compress each input and output BAM "
+                        "file (default=%d)." % BAM_THREADS_DEFAULT)
+
+
+
+def makedirs(path):
+    """creates directory (and parents) if it does not exist. Does not
+    fail if another process creates it at the same time"""
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
 
 
 
@@ -79,7 +177,32 @@ def is_gzipped(filename):
 
 
 
-def check_pysam_version(min_pysam_ver="0.8.4"):
+def read_fasta(filename):
+    """Generator that yields (name, sequence) for each sequence in
+    a (possibly gzipped) FASTA file"""
+    if is_gzipped(filename):
+        f = gzip.open(filename)
+    else:
+        f = open(filename)
+
+    name = None
+    lines = []
+    for line in f:
+        if line.startswith(">"):
+            if name is not None:
+                yield name, "".join(lines)
+            name = line[1:].split()[0]
+            lines = []
+        else:
+            lines.append(line.strip())
+    if name is not None:
+        yield name, "".join(lines)
+
+    f.close()
+
+
+
+def check_pysam_version(min_pysam_ver="0.15.0"):
     """Checks that the imported version of pysam is greater than
     or equal to provided version. Returns 0 if version is high enough,
     raises ImportWarning otherwise."""
@@ -48,6 +48,7 @@ typedef struct {
   char *geno_prob_file; /* genotype probabilities */ 
   char *haplotype_file; /* haplotypes & phase */
   char *snp_index_file; /* base position => SNP table row lookup */
+  int compact_snp_index; /* write compact rather than per-base SNP index */
   char *snp_tab_file; /* SNP table with id, alleles, etc */
 
   char *sample_file;
@@ -160,6 +161,13 @@ void usage(char **argv) {
 	  "     corresponding row in the geno_prob, haplotype and snp_tab\n"
 	  "     HDF5 files.\n"
 	  "\n"
+	  "  --compact_snp_index [optional]\n"
+	  "     Write a compact SNP index instead of an index with an\n"
+	  "     element for every base of each chromosome. The compact\n"
+	  "     index is a matrix with a row of (position, SNP table row)\n"
+	  "     for each SNP, sorted by position. Positions are 1-based.\n"
+	  "     The compact index is much smaller on disk and in memory.\n"
+	  "\n"
 	  "  --snp_tab SNP_TABLE_OUTPUT_FILE [optional]\n"
 	  "     Path to HDF5 file to write SNP table to. Each row of SNP\n"
 	  "     table contains SNP name (rs_id), position, allele1, allele2.\n"
@@ -207,6 +215,7 @@ void parse_args(Arguments *args, int argc, char **argv) {
      {"geno_prob", required_argument, 0, 'p'},
      {"haplotype", required_argument, 0, 'h'},
      {"snp_index", required_argument, 0, 'i'},
+     {"compact_snp_index", no_argument, 0, 'x'},
      {"snp_tab", required_argument, 0, 't'},
      {"samples", required_argument, 0, 's'},
      {0,0,0,0}
@@ -216,11 +225,12 @@ void parse_args(Arguments *args, int argc, char **argv) {
    args->geno_prob_file = NULL;
    args->haplotype_file = NULL;
    args->snp_index_file = NULL;
+   args->compact_snp_index = 0;
    args->snp_tab_file = NULL;
    args->sample_file = NULL;
 
    while(1) {
-     c = getopt_long(argc, argv, "c:f:p:h:i:t:s:", loptions, NULL);
+     c = getopt_long(argc, argv, "c:f:p:h:i:xt:s:", loptions, NULL);
      
      if(c == -1) {
        break;
@@ -232,6 +242,7 @@ void parse_args(Arguments *args, int argc, char **argv) {
        case 'p': args->geno_prob_file = util_str_dup(optarg); break;
        case 'h': args->haplotype_file = util_str_dup(optarg); break;
        case 'i': args->snp_index_file = util_str_dup(optarg); break;
+       case 'x': args->compact_snp_index = 1; break;
        case 't': args->snp_tab_file = util_str_dup(optarg); break;
        case 's': args->sample_file = util_str_dup(optarg); break;
        default: usage(argv); break;
@@ -261,6 +272,12 @@ void parse_args(Arguments *args, int argc, char **argv) {
 	     "--snp_index should be specified\n");
      exit(-1);
    }
+   if(args->compact_snp_index && !args->snp_index_file) {
+     usage(argv);
+     fprintf(stderr, "Error: ");
+     fprintf(stderr, "--compact_snp_index requires --snp_index\n");
+     exit(-1);
+   }
 
    if(format_str == NULL) {
      usage(argv);
@@ -520,6 +537,89 @@ void write_snp_index(H5VectorInfo *info, long *data) {
 
 
 
+/**
+ * Writes compact SNP index for a chromosome. Rather than an element
+ * for every base of the chromosome, a matrix with a row of
+ * (position, SNP table row) for each SNP is written. Positions are
+ * 1-based and rows are in order of position.
+ */
+void write_compact_snp_index(hid_t h5file, const char *name,
+			     long *snp_index, long len) {
+  hid_t dataspace, dataset_prop, dataset;
+  hsize_t dim[2];
+  hsize_t chunk[2];
+  herr_t status;
+  long *data;
+  long i, n;
+
+  /* count number of SNPs in index */
+  n = 0;
+  for(i = 0; i < len; i++) {
+    if(snp_index[i] != SNP_INDEX_NONE) {
+      n++;
+    }
+  }
+
+  data = my_malloc(sizeof(long) * 2 * ((n > 0) ? n : 1));
+  n = 0;
+  for(i = 0; i < len; i++) {
+    if(snp_index[i] != SNP_INDEX_NONE) {
+      data[n*2] = i + 1;
+      data[n*2 + 1] = snp_index[i];
+      n++;
+    }
+  }
+
+  dim[0] = n;
+  dim[1] = 2;
+  dataspace = H5Screate_simple(2, dim, NULL);
+  if(dataspace < 0) {
+    my_err("%s:%d: failed to create file dataspace", __FILE__,
+	   __LINE__);
+  }
+
+  dataset_prop = H5Pcreate(H5P_DATASET_CREATE);
+  if(dataset_prop < 0) {
+    my_err("%s:%d: failed to create dataset property list",
+	   __FILE__, __LINE__);
+  }
+
+  if(n > 0) {
+    /* chunks cannot be empty, so only compress non-empty index */
+    chunk[0] = (VEC_CHUNK < n) ? VEC_CHUNK : n;
+    chunk[1] = 2;
+    status = H5Pset_chunk(dataset_prop, 2, chunk);
+    if(status < 0) {
+      my_err("%s:%d: failed to set chunksize", __FILE__, __LINE__);
+    }
+    status = H5Pset_deflate(dataset_prop, 6);
+    if(status < 0) {
+      my_err("%s:%d: failed to set compression filter",
+	     __FILE__, __LINE__);
+    }
+  }
+
+  dataset = H5Dcreate(h5file, name, SNP_INDEX_DATATYPE, dataspace,
+		      dataset_prop);
+  if(dataset < 0) {
+    my_err("%s:%d failed to create dataset\n", __FILE__, __LINE__);
+  }
+
+  if(n > 0) {
+    status = H5Dwrite(dataset, SNP_INDEX_DATATYPE, H5S_ALL, H5S_ALL,
+		      H5P_DEFAULT, data);
+    if(status < 0) {
+      my_err("%s:%d: failed to write data", __FILE__, __LINE__);
+    }
+  }
+
+  H5Pclose(dataset_prop);
+  H5Sclose(dataspace);
+  H5Dclose(dataset);
+  my_free(data);
+}
+
+
 
 void close_h5matrix(H5MatrixInfo *info) {
     H5Sclose(info->file_dataspace);
@@ -782,7 +882,7 @@ void parse_impute(Arguments *args, Chromosome *all_chroms, int n_chrom,
       snp_index[j] = SNP_INDEX_NONE;
     }
 
-    if(args->snp_index_file) {
+    if(args->snp_index_file && !args->compact_snp_index) {
       init_h5vector(snp_index_info, chrom->len,
 		    SNP_INDEX_DATATYPE, chrom->name);      
     }
@@ -956,8 +1056,13 @@ void parse_impute(Arguments *args, Chromosome *all_chroms, int n_chrom,
     
     /* write snp_index data */
     if(args->snp_index_file) {
-      write_snp_index(snp_index_info, snp_index);
-      close_h5vector(snp_index_info);
+      if(args->compact_snp_index) {
+	write_compact_snp_index(snp_index_info->h5file, chrom->name,
+				snp_index, chrom->len);
+      } else {
+	write_snp_index(snp_index_info, snp_index);
+	close_h5vector(snp_index_info);
+      }
     }
 
     /* cleanup snp_index and snp_tab memory for this chromosome */
@@ -1075,8 +1180,10 @@ void parse_vcf(Arguments *args, Chromosome *all_chroms, int n_chrom,
       for(j = 0; j < chrom->len; j++) {
 	snp_index[j] = SNP_INDEX_NONE;
       }
-      init_h5vector(snp_index_info, chrom->len,
-		    SNP_INDEX_DATATYPE, chrom->name);
+      if(!args->compact_snp_index) {
+	init_h5vector(snp_index_info, chrom->len,
+		      SNP_INDEX_DATATYPE, chrom->name);
+      }
     } else {
       snp_index = NULL;
     }
@@ -1134,7 +1241,12 @@ void parse_vcf(Arguments *args, Chromosome *all_chroms, int n_chrom,
 
     /* write snp_index data */
     if(snp_index) {
-      write_snp_index(snp_index_info, snp_index);
+      if(args->compact_snp_index) {
+	write_compact_snp_index(snp_index_info->h5file, chrom->name,
+				snp_index, chrom->len);
+      } else {
+	write_snp_index(snp_index_info, snp_index);
+      }
     }
         
     /* clean up memory etc. for this chromosome */
@@ -1148,7 +1260,9 @@ void parse_vcf(Arguments *args, Chromosome *all_chroms, int n_chrom,
     }
     if(snp_index) {
       my_free(snp_index);
-      close_h5vector(snp_index_info);
+      if(!args->compact_snp_index) {
+	close_h5vector(snp_index_info);
+      }
     }
     if(snp_tab) {
       snp_tab_free(snp_tab);
@@ -1191,7 +1305,8 @@ int main(int argc, char **argv) {
   }
   if(args.snp_index_file) {
     snp_index_info.h5file = create_h5file(args.snp_index_file);
-    fprintf(stderr, "writing SNP index to: %s\n", args.snp_index_file);
+    fprintf(stderr, "writing %sSNP index to: %s\n",
+	    args.compact_snp_index ? "compact " : "", args.snp_index_file);
   }
   if(args.snp_tab_file) {
     snp_tab_h5file = create_h5file(args.snp_tab_file);